@@ -0,0 +1,280 @@
+"""
+Микро-бенчмарки горячих путей crud напрямую против локального Postgres, без
+HTTP-сервера (для сквозной нагрузки есть locustfile.py).
+
+Запуск из корня репозитория (база пересоздается, по умолчанию это тестовая
+база из config.py - не указывайте рабочую):
+
+    PYTHONPATH=src python -m benchmarks.crud_bench run --total 10000 --depth 4 --fan-out 10 -o before.json
+    PYTHONPATH=src python -m benchmarks.crud_bench compare before.json after.json
+    PYTHONPATH=src python -m benchmarks.crud_bench statements --total 10000
+
+statements сравнивает накладные расходы на один запрос для горячих
+запросов crud: через databases (именованные параметры), неподготовленными
+(asyncpg без кэша выражений) и подготовленными при открытии соединения.
+
+Результат - JSON с перцентилями времени каждой операции в миллисекундах,
+пригодный для сравнения прогонов между коммитами.
+"""
+import asyncio
+import json
+import platform
+import random
+import re
+import subprocess
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import asyncpg
+import orjson
+from typer import Option, Typer
+
+from yadiskapi import crud, schemas
+from yadiskapi.config import settings
+from yadiskapi.database import configure_database, init_models
+from yadiskapi.prepared import PreparedConnection, statement_preparer
+
+from tests import _give_tree_import_batches
+
+
+PERCENTILES = (50, 90, 95, 99)
+
+cli = Typer()
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    """Перцентили (nearest-rank) и прочая статистика по замерам в секундах, результат в мс"""
+    ordered = sorted(timings)
+    result = {
+        'count': len(ordered),
+        'min': ordered[0] * 1000,
+        'mean': sum(ordered) / len(ordered) * 1000,
+        'max': ordered[-1] * 1000,
+    }
+    for p in PERCENTILES:
+        rank = max(1, -(-p * len(ordered) // 100))  # ceil без float
+        result['p{}'.format(p)] = ordered[rank - 1] * 1000
+    return result
+
+
+class Sample:
+    """Равномерная выборка (reservoir sampling) id без хранения всех 1M id"""
+
+    def __init__(self, size: int, rnd: random.Random) -> None:
+        self.size = size
+        self.seen = 0
+        self.items: List[str] = []
+        self.rnd = rnd
+
+    def add(self, item: str) -> None:
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            i = self.rnd.randrange(self.seen)
+            if i < self.size:
+                self.items[i] = item
+
+
+async def timed(timings: List[float], call: Callable[[], Awaitable[Any]]) -> Any:
+    started = perf_counter()
+    result = await call()
+    timings.append(perf_counter() - started)
+    return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+async def run_benchmark(
+    dsn: str, total: int, depth: int, fan_out: int, batch_size: int, samples: int, seed: int
+) -> Dict[str, Any]:
+    rnd = random.Random(seed)
+    random.seed(seed)  # генераторы из tests используют модуль random
+    await init_models(delete_all=True, dsn=dsn)
+    database = configure_database(my_force_rollback=False, dsn=dsn)
+    await database.connect()
+    timings: Dict[str, List[float]] = {}
+    folders, files = Sample(samples, rnd), Sample(samples, rnd)
+    root_id = None
+    dates: List[datetime] = []
+
+    async with database.connection() as db:
+        # импорт дерева батчами, разбор тела (как в POST /imports) и crud меряются отдельно
+        import_timings = timings.setdefault('bulk_create_items', [])
+        imported_started = perf_counter()
+        for batch in _give_tree_import_batches(total, depth=depth, fan_out=fan_out, batch_size=batch_size):
+            body = orjson.dumps(batch)
+            started = perf_counter()
+            request = schemas.validate_import_request(orjson.loads(body))
+            timings.setdefault('validate_import', []).append(perf_counter() - started)
+            await timed(import_timings, lambda: crud.bulk_create_items(db, request.items, request.updateDate))
+            dates.append(request.updateDate)
+            for item in batch['items']:
+                if root_id is None:
+                    root_id = item['id']
+                (folders if item['type'] == 'FOLDER' else files).add(item['id'])
+        import_seconds = perf_counter() - imported_started
+        imported = folders.seen + files.seen
+
+        for folder_id in folders.items:
+            await timed(timings.setdefault('get_item', []), lambda: crud.get_item(db, folder_id))
+            await timed(timings.setdefault('get_item_json', []), lambda: crud.get_item_json(db, folder_id))
+        # корень - самый тяжелый запрос, его меряем отдельно и меньше раз
+        for _ in range(3):
+            await timed(timings.setdefault('get_item_json_root', []), lambda: crud.get_item_json(db, root_id))
+
+        for file_id in files.items:
+            await timed(
+                timings.setdefault('get_item_history', []), lambda: crud.get_item_history(db, file_id, None, None)
+            )
+        for _ in range(samples):
+            date = rnd.choice(dates)
+            await timed(
+                timings.setdefault('get_history_daterange', []),
+                lambda: crud.get_history_daterange(db, date - timedelta(hours=24), date)
+            )
+
+        # удаление в конце: сначала файлы, потом папки (поддеревья)
+        for item_id in files.items + folders.items:
+            await timed(timings.setdefault('delete_item', []), lambda: crud.delete_item(db, item_id))
+
+        postgres_version = await db.fetch_val("SHOW server_version;")
+
+    await database.disconnect()
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'postgres': postgres_version,
+            'params': {
+                'total': total, 'depth': depth, 'fan_out': fan_out, 'batch_size': batch_size,
+                'samples': samples, 'seed': seed, 'copy_import_threshold': settings.db_copy_import_threshold,
+            },
+            'imported_items': imported,
+            'import_items_per_second': imported / import_seconds if import_seconds else None,
+        },
+        'results': {name: summarize(values) for name, values in timings.items() if values},
+    }
+
+
+@cli.command()
+def run(
+    total: int = Option(10000, help='Число элементов дерева (1k - 1M).'),
+    depth: int = Option(4, help='Глубина дерева, на последнем уровне файлы.'),
+    fan_out: int = Option(10, help='Число детей у каждой папки.'),
+    batch_size: int = Option(1000, help='Элементов в одном импорте.'),
+    samples: int = Option(100, help='Сколько раз замерять операции чтения и удаления.'),
+    seed: int = Option(1, help='Seed генератора, чтобы прогоны были сравнимы.'),
+    dsn: str = Option(settings.db_test_dsn, help='База для бенчмарка, будет пересоздана!'),
+    output: Optional[str] = Option(None, '--output', '-o', help='Файл для JSON, по умолчанию stdout.'),
+):
+    """Прогоняет бенчмарк crud и выводит JSON с перцентилями в мс"""
+    result = asyncio.run(run_benchmark(dsn, total, depth, fan_out, batch_size, samples, seed))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, 'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+
+
+def _named(query: str) -> str:
+    """$1, $2... -> :p1, :p2... для выполнения того же запроса через databases"""
+    return re.sub(r'\$(\d+)', r':p\1', query)
+
+
+async def run_statements_benchmark(dsn: str, total: int, samples: int, seed: int) -> Dict[str, Any]:
+    rnd = random.Random(seed)
+    random.seed(seed)
+    await init_models(delete_all=True, dsn=dsn)
+    database = configure_database(my_force_rollback=False, dsn=dsn)
+    await database.connect()
+    folders, files = Sample(samples, rnd), Sample(samples, rnd)
+    dates: List[datetime] = []
+    async with database.connection() as db:
+        for batch in _give_tree_import_batches(total, depth=4, fan_out=10, batch_size=1000):
+            request = schemas.validate_import_request(batch)
+            await crud.bulk_create_items(db, request.items, request.updateDate)
+            dates.append(request.updateDate)
+            for item in batch['items']:
+                (folders if item['type'] == 'FOLDER' else files).add(item['id'])
+
+    # (имя, текст запроса, аргументы для каждого замера)
+    queries = [
+        ('subtree', crud.SUBTREE_QUERY, [[item_id] for item_id in folders.items]),
+        ('item_history', crud._history_query(crud._item_history_conditions(False, False), None, None),
+         [[item_id] for item_id in files.items]),
+        ('updates_window', crud._history_query(crud.UPDATES_CONDITIONS, 100, None),
+         [[date - timedelta(hours=24), date, 100] for date in (rnd.choice(dates) for _ in range(samples))]),
+        ('recount_ancestors', crud.RECOUNT_ANCESTORS_QUERY, [[[item_id]] for item_id in files.items]),
+    ]
+    raw_dsn = dsn.replace('+asyncpg', '')
+    unprepared = await asyncpg.connect(raw_dsn, statement_cache_size=0)
+    prepared = await asyncpg.connect(raw_dsn, connection_class=PreparedConnection)
+    await statement_preparer(query for _, query, _ in queries)(prepared)
+    timings: Dict[str, List[float]] = {}
+    async with database.connection() as db:
+        for name, query, arg_lists in queries:
+            named = _named(query)
+            for args in arg_lists:
+                values = {'p{}'.format(n): value for n, value in enumerate(args, start=1)}
+                await timed(timings.setdefault(name + '/databases', []), lambda: db.fetch_all(named, values))
+                await timed(timings.setdefault(name + '/unprepared', []), lambda: unprepared.fetch(query, *args))
+                await timed(timings.setdefault(name + '/prepared', []), lambda: prepared.fetch(query, *args))
+    await unprepared.close()
+    await prepared.close()
+    await database.disconnect()
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'params': {'total': total, 'samples': samples, 'seed': seed},
+        },
+        'results': {name: summarize(values) for name, values in timings.items() if values},
+    }
+
+
+@cli.command()
+def statements(
+    total: int = Option(10000, help='Число элементов дерева.'),
+    samples: int = Option(500, help='Сколько раз замерять каждый запрос каждым способом.'),
+    seed: int = Option(1, help='Seed генератора, чтобы прогоны были сравнимы.'),
+    dsn: str = Option(settings.db_test_dsn, help='База для бенчмарка, будет пересоздана!'),
+    output: Optional[str] = Option(None, '--output', '-o', help='Файл для JSON.'),
+):
+    """Время горячих запросов crud через databases, без подготовки и подготовленными"""
+    result = asyncio.run(run_statements_benchmark(dsn, total, samples, seed))
+    if output:
+        with open(output, 'w') as fp:
+            fp.write(json.dumps(result, indent=2, ensure_ascii=False) + '\n')
+    results = result['results']
+    print('{:<20}{:>14}{:>14}{:>14}'.format('query, p50 ms', 'databases', 'unprepared', 'prepared'))
+    for name in dict.fromkeys(key.split('/')[0] for key in results):
+        print('{:<20}{:>14.3f}{:>14.3f}{:>14.3f}'.format(name, *(
+            results['{}/{}'.format(name, path)]['p50'] for path in ('databases', 'unprepared', 'prepared')
+        )))
+
+
+@cli.command()
+def compare(before: str, after: str, metric: str = Option('p95', help='Какой показатель сравнивать.')):
+    """Сравнивает два JSON-результата: изменение показателя по каждой операции"""
+    with open(before) as fp:
+        old = json.load(fp)['results']
+    with open(after) as fp:
+        new = json.load(fp)['results']
+    print('{:<28}{:>12}{:>12}{:>10}'.format('operation', 'before, ms', 'after, ms', 'change'))
+    for name in sorted(set(old) & set(new)):
+        was, now = old[name][metric], new[name][metric]
+        change = '{:+.1f}%'.format((now - was) / was * 100) if was else '-'
+        print('{:<28}{:>12.2f}{:>12.2f}{:>10}'.format(name, was, now, change))
+
+
+if __name__ == '__main__':
+    cli()
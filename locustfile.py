@@ -1,12 +1,72 @@
-from typing import Any, Dict, List
+"""
+Нагрузочное тестирование. Профиль выбирается именем класса пользователя:
 
-from locust import HttpUser, task
+    locust                                          # YaDiskAPIUser, как раньше
+    locust --headless -u 20 -r 5 -t 2m ReadHeavyUser
+    locust --headless -u 10 -r 10 -t 1m SharedRootWriterUser --min-import-items-per-minute 5000
 
-from tests import _give_2_folder_tree_import_batch
+В конце прогона (событие quitting) результаты сверяются с порогами профиля
+(THRESHOLDS, их можно переопределить опциями командной строки), при
+нарушении locust завершается с кодом 1. Пороги по умолчанию - из требований
+задания: импорт и удаление не меньше 1000 элементов в минуту, чтение
+(история, недавние изменения, информация об элементе) - 100 RPS.
+"""
+import logging
+from random import choice, randint
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
 
+from locust import HttpUser, constant, events, task
 
-class YaDiskAPIUser(HttpUser):
+from tests import (
+    _give_2_folder_tree_import_batch, _give_item_import, _give_item_import_batch, _give_tree_import_batches
+)
+
+
+# импортированные и удаленные элементы отчитываются в статистику locust как
+# псевдо-запросы этого типа (response_length = число элементов), так они
+# суммируются с воркеров на мастер вместе с остальной статистикой
+ITEMS_REQUEST_TYPE = 'ITEMS'
+
+
+class ProfileUser(HttpUser):
+    """Общая часть профилей: импорт и удаление с учетом элементов, пороги"""
+    abstract = True
+    # без пауз между задачами: меряем пропускную способность, а не имитируем человека
+    wait_time = constant(0)
+
+    # max_* - верхние пороги, min_* - нижние, 0 отключает порог
+    THRESHOLDS: Dict[str, float] = {
+        # при 10 пользователях чтение быстрее 100 мс как раз дает 100 RPS
+        'max_read_p95_ms': 100,
+        'max_fail_ratio': 0.01,
+        'min_import_items_per_minute': 1000,
+        'min_read_rps': 0,
+    }
+
+    def post_imports(self, batch: Dict[str, Any], name: str = "/imports") -> bool:
+        response = self.client.post("/imports", json=batch, name=name)
+        if response.ok:
+            self.count_written(len(batch['items']), name)
+        return response.ok
+
+    def delete_item(self, item_id: str, date: str) -> bool:
+        response = self.client.delete(f"/delete/{item_id}", params={"date": date}, name="/delete/id")
+        if response.ok:
+            self.count_written(1, "/delete/id")
+        return response.ok
+
+    def count_written(self, items: int, name: str) -> None:
+        self.environment.events.request.fire(
+            request_type=ITEMS_REQUEST_TYPE, name=name, response_time=0, response_length=items,
+            exception=None, context={}
+        )
+
+
+class YaDiskAPIUser(ProfileUser):
+    """Базовый сценарий: двухуровневая папка с 1000 файлов, все операции по очереди"""
     RUNS: int = 10
+    THRESHOLDS = dict(ProfileUser.THRESHOLDS, min_read_rps=100)
 
     def make_dataset(self):
         self.dataset: Dict[str, Any] = _give_2_folder_tree_import_batch(1000)
@@ -20,7 +80,7 @@ class YaDiskAPIUser(HttpUser):
 
             # Минимальные требования:
             # импорт и удаление данных не превосходит 1000 элементов в 1 минуту
-            self.post_imports()
+            self.post_imports(self.dataset)
 
             # RPS получения истории, недавних изменений и информации об элементе
             # суммарно не превосходит 100 запросов в секунду
@@ -32,9 +92,6 @@ class YaDiskAPIUser(HttpUser):
             self.delete_delete_id()
         self.environment.runner.quit()  # иначе он будет крутиться бесконечно
 
-    def post_imports(self):
-        self.client.post("/imports", json=self.dataset, name="/imports")
-
     def get_nodes_id(self):
         for node_id in self.dataset_ids:
             self.client.get(f"/nodes/{node_id}", name="/nodes/id")
@@ -55,8 +112,240 @@ class YaDiskAPIUser(HttpUser):
         # обходим с конца, чтобы сначала удалить все файлы и потом уже удалить
         # корневую папку, иначе первый запрос всё сотрет и потом будут 404
         for node_id in reversed(self.dataset_ids):
-            self.client.delete(
-                f"/delete/{node_id}",
-                params={"date": self.dataset_dt},
-                name="/delete/id"
-            )
+            self.delete_item(node_id, self.dataset_dt)
+
+
+class DeepTreeUser(ProfileUser):
+    """Цепочка из DEPTH вложенных папок: чтение с корня и запись в самый низ (пересчет всех предков)"""
+    DEPTH = 120
+    THRESHOLDS = dict(ProfileUser.THRESHOLDS, max_read_p95_ms=250)
+
+    def on_start(self):
+        batch = next(_give_tree_import_batches(self.DEPTH + 1, depth=self.DEPTH, fan_out=1, batch_size=self.DEPTH + 1))
+        self.post_imports(batch, name="/imports [deep seed]")
+        self.root_id = batch['items'][0]['id']
+        self.deepest_id = batch['items'][-2]['id']
+        self.file_ids = [batch['items'][-1]['id']]
+
+    @task(3)
+    def get_root(self):
+        self.client.get(f"/nodes/{self.root_id}", name="/nodes/id [deep root]")
+
+    @task(2)
+    def get_deepest(self):
+        self.client.get(f"/nodes/{self.deepest_id}", name="/nodes/id [deepest]")
+
+    @task(2)
+    def import_into_deepest(self):
+        batch = _give_item_import_batch(1, type='FILE', parent_id=self.deepest_id)
+        if self.post_imports(batch, name="/imports [deepest]"):
+            self.file_ids.append(batch['items'][0]['id'])
+
+    @task(1)
+    def get_deep_file_history(self):
+        self.client.get(f"/node/{choice(self.file_ids)}/history", name="/node/id/history")
+
+
+class WideFolderUser(ProfileUser):
+    """Одна папка с WIDTH файлами: большой ответ /nodes и обновления соседей"""
+    WIDTH = 5000
+    THRESHOLDS = dict(ProfileUser.THRESHOLDS, max_read_p95_ms=500)
+
+    def on_start(self):
+        self.file_ids: List[str] = []
+        for batch in _give_tree_import_batches(self.WIDTH + 1, depth=1, fan_out=self.WIDTH):
+            self.post_imports(batch, name="/imports [wide seed]")
+            self.file_ids += [item['id'] for item in batch['items'] if item['type'] == 'FILE']
+            self.update_date = batch['updateDate']
+            if batch['items'][0]['type'] == 'FOLDER':
+                self.root_id = batch['items'][0]['id']
+
+    @task(1)
+    def get_wide_root(self):
+        self.client.get(f"/nodes/{self.root_id}", name="/nodes/id [wide root]")
+
+    @task(3)
+    def update_file(self):
+        batch = _give_item_import_batch(0)
+        batch['items'] = [dict(_give_item_import(type='FILE', parent_id=self.root_id), id=choice(self.file_ids))]
+        self.post_imports(batch, name="/imports [wide update]")
+
+    @task(3)
+    def get_file(self):
+        self.client.get(f"/nodes/{choice(self.file_ids)}", name="/nodes/id")
+
+    @task(2)
+    def get_updates(self):
+        self.client.get("/updates", params={"date": self.update_date}, name="/updates")
+
+
+# корневая папка, в которую импортируют все пользователи SharedRootWriterUser (процесса locust)
+SHARED_ROOT_ID = 'shared-root-' + str(uuid4())
+
+
+class SharedRootWriterUser(ProfileUser):
+    """Много пользователей одновременно импортируют в одно дерево: общие предки у всех записей"""
+    FILES_PER_IMPORT = 10
+    THRESHOLDS = dict(ProfileUser.THRESHOLDS, max_read_p95_ms=200, min_import_items_per_minute=1000)
+
+    def on_start(self):
+        self.folder_id = str(uuid4())
+        self.file_ids: List[str] = []
+        # первый импорт до чтения, иначе GET корня может прийти раньше всех импортов
+        self.import_into_shared_root()
+
+    @task(5)
+    def import_into_shared_root(self):
+        # корень каждый раз импортируется заново, как сделал бы клиент, синхронизирующий все дерево
+        batch = _give_item_import_batch(self.FILES_PER_IMPORT, type='FILE', parent_id=self.folder_id)
+        batch['items'][:0] = [
+            dict(_give_item_import(type='FOLDER'), id=SHARED_ROOT_ID),
+            dict(_give_item_import(type='FOLDER', parent_id=SHARED_ROOT_ID), id=self.folder_id),
+        ]
+        if self.post_imports(batch, name="/imports [shared root]"):
+            self.file_ids += [item['id'] for item in batch['items'][2:]]
+            self.update_date = batch['updateDate']
+
+    @task(1)
+    def delete_own_file(self):
+        if self.file_ids:
+            self.delete_item(self.file_ids.pop(randint(0, len(self.file_ids) - 1)), self.update_date)
+
+    @task(2)
+    def get_shared_root(self):
+        self.client.get(f"/nodes/{SHARED_ROOT_ID}", params={'depth': 1}, name="/nodes/id [shared root]")
+
+
+class ReadHeavyUser(ProfileUser):
+    """Смесь 90% чтения и 10% записи поверх дерева на 1000 элементов"""
+    THRESHOLDS = dict(ProfileUser.THRESHOLDS, min_read_rps=100, min_import_items_per_minute=0)
+
+    def on_start(self):
+        self.folder_ids: List[str] = []
+        self.file_ids: List[str] = []
+        for batch in _give_tree_import_batches(1000, depth=3, fan_out=10, batch_size=500):
+            self.post_imports(batch, name="/imports [read-heavy seed]")
+            self.update_date = batch['updateDate']
+            for item in batch['items']:
+                (self.folder_ids if item['type'] == 'FOLDER' else self.file_ids).append(item['id'])
+        self.node_ids = self.folder_ids + self.file_ids
+        self.own_file_ids: List[str] = []
+
+    @task(45)
+    def get_node(self):
+        self.client.get(f"/nodes/{choice(self.node_ids)}", name="/nodes/id")
+
+    @task(25)
+    def get_history(self):
+        self.client.get(f"/node/{choice(self.file_ids)}/history", name="/node/id/history")
+
+    @task(20)
+    def get_updates(self):
+        self.client.get("/updates", params={"date": self.update_date}, name="/updates")
+
+    @task(5)
+    def import_files(self):
+        batch = _give_item_import_batch(10, type='FILE', parent_id=choice(self.folder_ids))
+        if self.post_imports(batch):
+            self.own_file_ids += [item['id'] for item in batch['items']]
+
+    @task(5)
+    def delete_file(self):
+        if self.own_file_ids:
+            self.delete_item(self.own_file_ids.pop(), self.update_date)
+
+
+class MoveUser(ProfileUser):
+    """Перенос папки с поддеревом между двумя родителями с проверкой размеров обоих"""
+    THRESHOLDS = dict(ProfileUser.THRESHOLDS, max_read_p95_ms=150)
+
+    def on_start(self):
+        batches = list(_give_tree_import_batches(111, depth=2, fan_out=10, batch_size=111))
+        self.post_imports(batches[0], name="/imports [move seed]")
+        # переезжает первая папка второго уровня с 10 файлами внутри
+        self.moved = dict(batches[0]['items'][1])
+        self.parents = [batches[0]['items'][0]['id'], _give_item_import(type='FOLDER')]
+        other_batch = _give_item_import_batch(0)
+        other_batch['items'] = [self.parents[1]]
+        self.post_imports(other_batch, name="/imports [move seed]")
+        self.parents[1] = self.parents[1]['id']
+        self.moved_size: Optional[int] = None
+
+    @task
+    def move_folder(self):
+        target = self.parents[1] if self.moved['parentId'] == self.parents[0] else self.parents[0]
+        batch = _give_item_import_batch(0)
+        batch['items'] = [dict(self.moved, parentId=target)]
+        if not self.post_imports(batch, name="/imports [move]"):
+            return
+        self.moved['parentId'] = target
+        if self.moved_size is None:
+            self.moved_size = self.client.get(f"/nodes/{self.moved['id']}", name="/nodes/id").json()['size']
+        with self.client.get(f"/nodes/{target}", name="/nodes/id [move target]", catch_response=True) as response:
+            # только этот пользователь трогает свои папки, так что размер обязан совпасть
+            if response.ok and response.json()['size'] < self.moved_size:
+                response.failure("Moved folder size is not accounted in the new parent")
+
+
+@events.init_command_line_parser.add_listener
+def add_threshold_arguments(parser):
+    parser.add_argument('--max-read-p95-ms', type=float, default=None, help='Порог p95 для GET-запросов, мс')
+    parser.add_argument('--max-fail-ratio', type=float, default=None, help='Допустимая доля ошибок')
+    parser.add_argument('--min-import-items-per-minute', type=float, default=None,
+                        help='Минимум импортированных и удаленных элементов в минуту')
+    parser.add_argument('--min-read-rps', type=float, default=None, help='Минимальный RPS GET-запросов')
+
+
+@events.init.add_listener
+def select_default_profile(environment, **kwargs):
+    # без явно указанных классов запускается только базовый сценарий, как раньше
+    if environment.parsed_options is not None and not environment.parsed_options.user_classes:
+        environment.user_classes[:] = [YaDiskAPIUser]
+
+
+def profile_thresholds(environment) -> Dict[str, float]:
+    """Пороги выбранных профилей (самые строгие из них) с учетом опций командной строки"""
+    thresholds: Dict[str, float] = {}
+    for user_class in environment.user_classes:
+        for key, value in getattr(user_class, 'THRESHOLDS', {}).items():
+            if not value:
+                continue
+            if key not in thresholds:
+                thresholds[key] = value
+            else:
+                thresholds[key] = min(thresholds[key], value) if key.startswith('max_') else max(thresholds[key], value)
+    options = environment.parsed_options
+    for key in ProfileUser.THRESHOLDS:
+        value = getattr(options, key, None) if options is not None else None
+        if value is not None:
+            thresholds[key] = value
+    return {key: value for key, value in thresholds.items() if value}
+
+
+@events.quitting.add_listener
+def check_thresholds(environment, **kwargs):
+    stats = environment.stats
+    if not stats.total.num_requests:
+        return
+    thresholds = profile_thresholds(environment)
+    elapsed = max(stats.total.last_request_timestamp - stats.total.start_time, 1e-9)
+    entries = [entry for entry in stats.entries.values() if entry.method != ITEMS_REQUEST_TYPE]
+    reads = [entry for entry in entries if entry.method == 'GET']
+    written = sum(entry.total_content_length for entry in stats.entries.values() if entry.method == ITEMS_REQUEST_TYPE)
+    requests = sum(entry.num_requests for entry in entries)
+    results = {
+        'max_fail_ratio': sum(entry.num_failures for entry in entries) / requests if requests else 0,
+        'min_import_items_per_minute': written / elapsed * 60,
+        'min_read_rps': sum(entry.num_requests for entry in reads) / elapsed,
+        'max_read_p95_ms': max((entry.get_response_time_percentile(0.95) for entry in reads), default=0),
+    }
+    failed = []
+    for key, limit in thresholds.items():
+        value = results[key]
+        if (key.startswith('max_') and value > limit) or (key.startswith('min_') and value < limit):
+            failed.append('{} = {:.2f} (limit {})'.format(key, value, limit))
+    if failed:
+        logging.error('Load test thresholds failed: %s', '; '.join(failed))
+        environment.process_exit_code = 1
+    else:
+        logging.info('Load test thresholds passed: %s', thresholds)
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, Union
+
+from yadiskapi.config import settings
+
+
+class SubtreeCache:
+    """
+    LRU-кэш сериализованных ответов GET /nodes/{id} внутри процесса,
+    ограниченный суммарным размером ответов в байтах.
+
+    Запись в кэш меняет поддерево элемента (и сам элемент), поэтому при
+    импорте/удалении инвалидируются все измененные элементы и вся цепочка их
+    предков. Чтобы чтение, начатое до коммита записи, не положило в кэш
+    устаревший ответ, каждая инвалидация увеличивает generation, а put()
+    принимает ответ только если generation не менялся с начала чтения.
+    """
+
+    # примерная цена служебных структур на одну запись
+    ENTRY_OVERHEAD = 100
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Union[bytes, None]:
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes, generation: int) -> None:
+        entry_size = self._entry_size(key, value)
+        if generation != self.generation or entry_size > self.max_bytes:
+            return
+        self._pop(key)
+        self._entries[key] = value
+        self._size += entry_size
+        while self._size > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, keys: Iterable[str]) -> None:
+        self.generation += 1
+        for key in keys:
+            if self._pop(key):
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'size_bytes': self._size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+    def _pop(self, key: str) -> bool:
+        value = self._entries.pop(key, None)
+        if value is None:
+            return False
+        self._size -= self._entry_size(key, value)
+        return True
+
+    def _entry_size(self, key: str, value: bytes) -> int:
+        return len(key) + len(value) + self.ENTRY_OVERHEAD
+
+
+nodes_cache = SubtreeCache(settings.nodes_cache_max_bytes)
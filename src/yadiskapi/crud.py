@@ -1,120 +1,626 @@
+import functools
 from datetime import datetime
-from typing import Dict, List, Union
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Collection, Dict, Iterable, List, Sequence, Set, Tuple,
+    TypeVar, Union, cast
+)
 
 from aiomisc.utils import chunk_list
+from asyncpg.exceptions import DeadlockDetectedError
 from databases.core import Connection
+from databases.interfaces import Record
+import orjson
 
-from yadiskapi import schemas
+from yadiskapi import invalidation, schemas
+from yadiskapi.metrics import CRUD_DURATION, DEADLOCK_RETRIES, IMPORT_ITEMS, RECOUNT_FOLDERS
+from yadiskapi.cache import nodes_cache
+from yadiskapi.config import settings
+from yadiskapi.updates_index import recent_updates
 
 
-async def bulk_create_items(db: Connection, items: List[schemas.SystemItemImport], date: datetime) -> bool:
+# первый ключ двухаргументного pg_advisory_xact_lock для lock'ов корневых папок,
+# второй - hashtext(id корня)
+ROOT_LOCK_CLASS = 7_412_003
+# сколько раз выполняется запись, которую Postgres прервал из-за deadlock (см. _items_lock_roots)
+DEADLOCK_ATTEMPTS = 3
+
+_F = TypeVar('_F', bound=Callable[..., Awaitable[Any]])
+
+
+def _retry_on_deadlock(func: _F) -> _F:
+    """
+    Повторяет транзакцию записи, если Postgres выбрал ее жертвой deadlock'а:
+    ее откат отпускает все lock'и, повтор обычно проходит. Годится только
+    для функций, которые целиком выполняются в своей транзакции и до
+    коммита ничего не меняют вне базы.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        for attempt in range(1, DEADLOCK_ATTEMPTS + 1):
+            try:
+                return await func(*args, **kwargs)
+            except DeadlockDetectedError:
+                if attempt == DEADLOCK_ATTEMPTS:
+                    raise
+                DEADLOCK_RETRIES.inc(func.__name__)
+
+    return cast(_F, wrapper)
+
+
+@_retry_on_deadlock
+async def bulk_create_items(db: Connection, items: Sequence[schemas.ImportItem], date: datetime) -> bool:
     async with db.transaction():
         # all fk constraints (including the one on parentId)
         # will be checked by postgres on commit of transaction
         # https://stackoverflow.com/a/2681413
         await db.execute("SET CONSTRAINTS ALL DEFERRED;")
+        item_ids, old_parent_ids = await _items_write(db, items, date, set())
+
+        # пересчитываем только цепочки предков затронутых элементов: и старых
+        # родителей (если элемент переехал), и новых (они есть в path)
+        recounted_ids = await _folders_recount_ancestors(db, item_ids + old_parent_ids)
+        history_rows = await _recent_history_rows(db, item_ids, date)
+        await invalidation.notify_changes(db, item_ids + recounted_ids)
+
+    # только после коммита, иначе параллельное чтение может закэшировать старые данные
+    nodes_cache.invalidate(item_ids + recounted_ids)
+    recent_updates.add(history_rows)
+    IMPORT_ITEMS.observe(len(items))
+    return True
+
+
+async def bulk_create_item_groups(
+    db: Connection, batches: Sequence[Tuple[Sequence[schemas.ImportItem], datetime]]
+) -> List[Union[Exception, None]]:
+    """
+    Несколько небольших импортов (group commit, см. group_commit.py) одной
+    транзакцией с одним общим пересчетом папок. Каждый батч пишется в своем
+    savepoint по порядку, ошибка откатывает только его. Возвращает для
+    каждого батча None или его ошибку.
+    """
+    results: List[Union[Exception, None]] = []
+    seed_ids: List[str] = []
+    written: List[Tuple[List[str], datetime]] = []
+    async with db.transaction():
+        # lock'и всех деревьев группы берутся сразу и по порядку, а не по батчам
+        locked_roots: Set[str] = set()
+        seeds = [_import_root_seeds(items) for items, _ in batches]
+        await _items_lock_roots(
+            db, [i for ids, _ in seeds for i in ids], [i for _, new_ids in seeds for i in new_ids], locked_roots
+        )
+        for items, date in batches:
+            try:
+                async with db.transaction():
+                    # внешние ключи проверяются в конце каждого батча, а не на коммите группы
+                    await db.execute("SET CONSTRAINTS ALL DEFERRED;")
+                    item_ids, old_parent_ids = await _items_write(db, items, date, locked_roots)
+            except Exception as e:
+                results.append(e)
+                continue
+            results.append(None)
+            seed_ids += item_ids + old_parent_ids
+            written.append((item_ids, date))
+
+        recounted_ids = await _folders_recount_ancestors(db, seed_ids)
+        history_rows: List[Record] = []
+        for item_ids, date in written:
+            history_rows += await _recent_history_rows(db, item_ids, date)
+        await invalidation.notify_changes(db, seed_ids + recounted_ids)
+
+    nodes_cache.invalidate(seed_ids + recounted_ids)
+    recent_updates.add(history_rows)
+    for (items, _), error in zip(batches, results):
+        if error is None:
+            IMPORT_ITEMS.observe(len(items))
+    return results
+
+
+async def _items_write(
+    db: Connection, items: Sequence[schemas.ImportItem], date: datetime, locked_roots: Set[str]
+) -> Tuple[List[str], List[str]]:
+    """
+    Запись элементов импорта с их path, без пересчета папок. Вызывается в
+    транзакции с отложенными ограничениями, locked_roots - см. _items_lock_roots.
+    Возвращает id элементов и id их прежних родителей.
+    """
+    item_ids = [item.id for item in items]
+    await _items_lock_roots(db, *_import_root_seeds(items), locked_roots)
+
+    # запоминаем старых родителей до обновления, их размеры тоже изменятся
+    query = 'SELECT "parentId" FROM items WHERE id = ANY(:ids) AND "parentId" IS NOT NULL;'
+    rows = await db.fetch_all(query=query, values={'ids': item_ids})
+    old_parent_ids = [row['parentId'] for row in rows]
+
+    with CRUD_DURATION.time('import_upsert'):
+        if settings.db_copy_import_threshold and len(items) >= settings.db_copy_import_threshold:
+            await _items_upsert_copy(db, items, date)
+        else:
+            await _items_upsert(db, items, date)
+
+        # заставляем Postgres проверить отложенные ключи прямо сейчас, т.к. нет
+        # смысла пересчитывать статистику, если все сломалось
+        await db.execute("SET CONSTRAINTS ALL IMMEDIATE;")
+
+    with CRUD_DURATION.time('update_paths'):
+        await _items_update_paths(db, item_ids)
+    return item_ids, old_parent_ids
+
+
+async def _recent_history_rows(db: Connection, item_ids: List[str], date: datetime) -> List[Record]:
+    # в индекс /updates берем ровно то, что легло в историю (при повторном
+    # импорте с той же датой ON CONFLICT оставляет старую запись)
+    if not recent_updates.accepts(date):
+        return []
+    query = """
+        SELECT id, url, "parentId", type, size, date
+            FROM items_history
+                WHERE id = ANY(:ids) AND date = :date AND type = 'FILE';
+    """
+    return await db.fetch_all(query=query, values={'ids': item_ids, 'date': date})
+
+
+def _import_root_seeds(items: Sequence[schemas.ImportItem]) -> Tuple[List[str], List[str]]:
+    """Аргументы _items_lock_roots для импорта: сами элементы с родителями и элементы без родителя"""
+    ids = [item.id for item in items] + [item.parentId for item in items if item.parentId is not None]
+    return ids, [item.id for item in items if item.parentId is None]
+
+
+async def _items_lock_roots(db: Connection, item_ids: List[str], new_root_ids: List[str], locked: Set[str]) -> None:
+    """
+    Берет advisory lock'и (до конца транзакции) на корневые папки деревьев,
+    в которых лежат item_ids, и на новые корни new_root_ids. Запись и
+    пересчет папок одного дерева так идут по очереди, а в непересекающихся
+    деревьях - параллельно, в том числе из разных процессов. locked - уже
+    взятые корни, дополняется.
+
+    Пока ждали lock, дерево могло переехать под другой корень, поэтому корни
+    перечитываются, пока не окажутся взяты все. За один проход корни берутся
+    в порядке сортировки, так что записи, которые берут все свои lock'и
+    одним вызовом, не ждут друг друга по кругу. Но корни, взятые позже
+    (после перечитывания или следующим куском потокового импорта), могут
+    нарушить этот порядок: тогда Postgres прерывает одну из транзакций с
+    DeadlockDetectedError. Импорт и удаление повторяются (_retry_on_deadlock),
+    потоковый импорт повторить нельзя - его клиент получает 503.
+    """
+    query = 'SELECT DISTINCT COALESCE(path[1], id) AS root FROM items WHERE id = ANY(:ids);'
+    lock_query = """
+        SELECT pg_advisory_xact_lock(:lock_class, hashtext(root))
+            FROM (SELECT root FROM unnest(CAST(:roots AS varchar[])) root ORDER BY root) r;
+    """
+    while True:
+        rows = await db.fetch_all(query=query, values={'ids': item_ids})
+        roots = {row['root'] for row in rows} | set(new_root_ids)
+        missing = list(roots - locked)
+        if not missing:
+            return
+        with CRUD_DURATION.time('lock_roots'):
+            await db.execute(query=lock_query, values={'lock_class': ROOT_LOCK_CLASS, 'roots': missing})
+        locked.update(missing)
+
+
+async def stream_create_items(
+    db: Connection, chunks: AsyncIterable[Sequence[schemas.ImportItem]], date: datetime
+) -> int:
+    """
+    Потоковый импорт (POST /imports/stream) одной транзакцией: каждый кусок
+    сразу пишется в items, в памяти только он. Проверки на весь поток
+    (уникальность id, родитель не файл) делает временная таблица items_stream,
+    по ней же после загрузки всего потока кусками строятся path и
+    пересчитываются папки. Возвращает число импортированных элементов.
+    """
+    total = 0
+    async with db.transaction():
+        await db.execute("SET CONSTRAINTS ALL DEFERRED;")
+        query = """
+            CREATE TEMP TABLE IF NOT EXISTS items_stream (
+                id character varying PRIMARY KEY,
+                "parentId" character varying,
+                type character varying,
+                old_parent_id character varying,
+                existed boolean
+            ) ON COMMIT DELETE ROWS;
+        """
+        await db.execute(query=query)
+        await db.execute(query="TRUNCATE items_stream;")
 
-        # https://stackoverflow.com/a/1109198
-        # Реализуем требование openapi для /imports:
-        # Элементы импортированные повторно обновляют текущие.
-        #
-        # COALESCE тк при импорте папок size обязательно null и это надо валидировать,
-        # а потом во всех моделях, читаемых из БД, уже обязательно 0+
+        # старый родитель запоминается до upsert, его размер тоже изменится
         query = """
-            WITH changed_item as (
-                INSERT INTO items(id, url, "parentId", type, size, date)
-                    VALUES (:id, :url, :parentId, :type, COALESCE(CAST(:size AS BIGINT), 0), :date)
-                ON CONFLICT (id) DO UPDATE
-                    SET url = excluded.url,
-                        "parentId" = excluded."parentId",
-                        size = excluded.size,
-                        date = excluded.date
-                RETURNING *
+            WITH added AS (
+                INSERT INTO items_stream(id, "parentId", type, old_parent_id, existed)
+                    SELECT s.id, s."parentId", s.type, i."parentId", i.id IS NOT NULL
+                        FROM unnest(
+                            CAST(:ids AS varchar[]), CAST(:parent_ids AS varchar[]), CAST(:types AS varchar[])
+                        ) s(id, "parentId", type)
+                        LEFT JOIN items i ON i.id = s.id
+                ON CONFLICT (id) DO NOTHING
+                RETURNING 1
             )
-            INSERT INTO items_history(id, url, "parentId", type, size, date)
-                SELECT id, url, "parentId", type, size, date FROM changed_item
-            ON CONFLICT (id, date) DO NOTHING;
+            SELECT COUNT(*) FROM added;
         """
-        for chunk in chunk_list(items, 1000):
-            values = []
-            for item in chunk:
-                values.append({
-                    'id': item.id,
-                    'url': item.url,
-                    'parentId': item.parentId,
-                    'type': item.type,
-                    'size': item.size,
-                    'date': date
-                })
-            await db.execute_many(query=query, values=values)
-
-    # вышли из транзакции, чтобы Postgres проверил дубликаты и валидность ключей
-    # т.к. нет смысла пересчитывать статистику, если все сломалось
-    await _folders_recount_stat(db)
+        locked_roots: Set[str] = set()
+        async for chunk in chunks:
+            await _items_lock_roots(db, *_import_root_seeds(chunk), locked_roots)
+            added = await db.fetch_val(query=query, values={
+                'ids': [item.id for item in chunk],
+                'parent_ids': [item.parentId for item in chunk],
+                'types': [item.type for item in chunk],
+            })
+            if added != len(chunk):
+                raise ValueError('ID of imported elements should be unique.')
+            with CRUD_DURATION.time('import_upsert'):
+                if settings.db_copy_import_threshold and len(chunk) >= settings.db_copy_import_threshold:
+                    await _items_upsert_copy(db, chunk, date)
+                else:
+                    await _items_upsert(db, chunk, date)
+            total += len(chunk)
 
-    return True
+        row = await db.fetch_one(query="""
+            SELECT c.id, c."parentId"
+                FROM items_stream c INNER JOIN items_stream p ON p.id = c."parentId"
+                WHERE p.type = 'FILE'
+                LIMIT 1;
+        """)
+        if row is not None:
+            raise ValueError("Parent ({}) of an element ({}) can't be file.".format(row['parentId'], row['id']))
+        await db.execute("SET CONSTRAINTS ALL IMMEDIATE;")
+
+        # path считается по "parentId" до корня, поэтому порядок кусков не важен:
+        # к этому моменту в items уже весь поток. Потомков переехавших папок
+        # переписываем один раз в конце, и только для папок, которые были в
+        # базе до импорта: у новых папок все потомки - из самого потока.
+        moved_folders: List[str] = []
+        async for rows in _stream_staging_chunks(db):
+            item_ids = [row['id'] for row in rows]
+            existed = {row['id'] for row in rows if row['existed']}
+            with CRUD_DURATION.time('update_paths'):
+                moved_folders += [item_id for item_id in await _items_set_paths(db, item_ids) if item_id in existed]
+        with CRUD_DURATION.time('update_paths'):
+            await _items_update_descendant_paths(db, moved_folders, [])
+
+        async for rows in _stream_staging_chunks(db):
+            seed_ids = [row['id'] for row in rows] + [row['old_parent_id'] for row in rows if row['old_parent_id']]
+            await _folders_recount_ancestors(db, seed_ids)
+        await invalidation.notify_changes(db, None)
+
+    # затронутых id может быть миллионы: кэш проще сбросить целиком, а индекс
+    # /updates перечитать, чем держать в памяти весь поток
+    nodes_cache.clear()
+    if recent_updates.accepts(date):
+        await recent_updates.warm_up(db)
+    IMPORT_ITEMS.observe(total)
+    return total
+
+
+async def _stream_staging_chunks(db: Connection) -> AsyncIterator[List[Record]]:
+    """Строки items_stream кусками по settings.import_stream_chunk_size (keyset по id)"""
+    query = """
+        SELECT id, old_parent_id, existed FROM items_stream
+            WHERE CAST(:after AS varchar) IS NULL OR id > :after
+            ORDER BY id
+            LIMIT :limit;
+    """
+    after = None
+    while True:
+        rows = await db.fetch_all(query=query, values={'after': after, 'limit': settings.import_stream_chunk_size})
+        if not rows:
+            return
+        yield rows
+        after = rows[-1]['id']
+
+
+# https://stackoverflow.com/a/1109198
+# Реализуем требование openapi для /imports:
+# Элементы импортированные повторно обновляют текущие.
+#
+# Батч приходит колонками-массивами и разворачивается unnest, так что это
+# один подготовленный запрос на батч, а не запрос на строку. id в батче
+# уникальны (проверяется при валидации).
+#
+# COALESCE тк при импорте папок size обязательно null и это надо валидировать,
+# а потом во всех моделях, читаемых из БД, уже обязательно 0+
+UPSERT_QUERY = """
+    WITH changed_item as (
+        INSERT INTO items(id, url, "parentId", type, size, date)
+            SELECT id, url, "parentId", CAST(type AS type), COALESCE(size, 0), $6
+                FROM unnest(
+                    CAST($1 AS varchar[]), CAST($2 AS varchar[]), CAST($3 AS varchar[]),
+                    CAST($4 AS varchar[]), CAST($5 AS bigint[])
+                ) AS batch(id, url, "parentId", type, size)
+        ON CONFLICT (id) DO UPDATE
+            SET url = excluded.url,
+                "parentId" = excluded."parentId",
+                size = excluded.size,
+                date = excluded.date
+        RETURNING *
+    )
+    INSERT INTO items_history(id, url, "parentId", type, size, date)
+        SELECT id, url, "parentId", type, size, date FROM changed_item
+    ON CONFLICT (id, date) DO NOTHING;
+"""
+
+
+async def _items_upsert(db: Connection, items: Sequence[schemas.ImportItem], date: datetime) -> None:
+    for chunk in chunk_list(items, 1000):
+        await db.raw_connection.execute(
+            UPSERT_QUERY,
+            [item.id for item in chunk],
+            [item.url for item in chunk],
+            [item.parentId for item in chunk],
+            [item.type for item in chunk],
+            [item.size for item in chunk],
+            date,
+        )
+
+
+async def _items_upsert_copy(db: Connection, items: Sequence[schemas.ImportItem], date: datetime) -> None:
+    """
+    То же, что _items_upsert, но для больших батчей: элементы одним бинарным
+    COPY (asyncpg) заливаются во временную staging-таблицу, а оттуда в items
+    и items_history уходят двумя set-based запросами вместо запроса на строку.
+    """
+    # временная таблица живет до конца сессии, чистим ее сами, т.к. при
+    # вложенных транзакциях (тесты) ON COMMIT не срабатывает
+    query = """
+        CREATE TEMP TABLE IF NOT EXISTS items_import (
+            id character varying,
+            url character varying(255),
+            "parentId" character varying,
+            type character varying,
+            size bigint
+        ) ON COMMIT DELETE ROWS;
+    """
+    await db.execute(query=query)
+    await db.execute(query="TRUNCATE items_import;")
+    await db.raw_connection.copy_records_to_table(
+        'items_import',
+        records=[(item.id, item.url, item.parentId, item.type, item.size) for item in items],
+        columns=['id', 'url', 'parentId', 'type', 'size']
+    )
+
+    query = """
+        WITH changed_item as (
+            INSERT INTO items(id, url, "parentId", type, size, date)
+                SELECT id, url, "parentId", CAST(type AS type), COALESCE(size, 0), :date
+                    FROM items_import
+            ON CONFLICT (id) DO UPDATE
+                SET url = excluded.url,
+                    "parentId" = excluded."parentId",
+                    size = excluded.size,
+                    date = excluded.date
+            RETURNING *
+        )
+        INSERT INTO items_history(id, url, "parentId", type, size, date)
+            SELECT id, url, "parentId", type, size, date FROM changed_item
+        ON CONFLICT (id, date) DO NOTHING;
+    """
+    await db.execute(query=query, values={'date': date})
 
 
+@_retry_on_deadlock
 async def delete_item(db: Connection, item_id: str) -> int:
     async with db.transaction():
-        # Удалением зависимых записей займется constraint ON DELETE CASCADE
+        await _items_lock_roots(db, [item_id], [], set())
+        # все поддерево находим по path одним индексным сканом, историю удалит
+        # constraint ON DELETE CASCADE
         query = """
-            WITH deleted AS(
-                DELETE FROM items WHERE id=:id RETURNING id
-            ) SELECT COUNT(*) AS cnt FROM deleted;
+            DELETE FROM items
+                WHERE id = :id OR path @> ARRAY[CAST(:id AS varchar)]
+                RETURNING id, "parentId";
         """
-        # в cnt считаются только удаленные нами напрямую записи, по факту получается 0 или 1
-        deleted = (await db.fetch_one(query, values={"id": item_id}))['cnt']  # type: ignore[index]
-        if deleted:
-            await _folders_recount_stat(db)
-        return deleted  # type: ignore[no-any-return]
+        with CRUD_DURATION.time('delete'):
+            rows = await db.fetch_all(query, values={"id": item_id})
+        # удаленный нами напрямую элемент, по факту 0 или 1
+        deleted = [row for row in rows if row['id'] == item_id]
+        recounted_ids = []
+        if deleted and deleted[0]['parentId'] is not None:
+            recounted_ids = await _folders_recount_ancestors(db, [deleted[0]['parentId']])
+        await invalidation.notify_changes(db, [row['id'] for row in rows] + recounted_ids)
+
+    nodes_cache.invalidate([row['id'] for row in rows] + recounted_ids)
+    recent_updates.discard(row['id'] for row in rows)
+    return len(deleted)
+
+
+@_retry_on_deadlock
+async def delete_items(db: Connection, item_ids: Sequence[str]) -> Set[str]:
+    """
+    Удаление нескольких элементов с поддеревьями одним запросом и один
+    пересчет папок над всеми удаленными поддеревьями. Возвращает те из
+    item_ids, которые были удалены (в том числе в составе поддерева другого
+    запрошенного элемента), остальных не было.
+    """
+    unique_ids = list(dict.fromkeys(item_ids))
+    async with db.transaction():
+        await _items_lock_roots(db, unique_ids, [], set())
+        query = """
+            DELETE FROM items
+                WHERE id = ANY(:ids) OR path && CAST(:ids AS varchar[])
+                RETURNING id, "parentId";
+        """
+        with CRUD_DURATION.time('delete'):
+            rows = await db.fetch_all(query, values={'ids': unique_ids})
+        deleted_ids = {row['id'] for row in rows}
+        # пересчитываются только папки над удаленными поддеревьями
+        parent_ids = {row['parentId'] for row in rows} - deleted_ids - {None}
+        recounted_ids = await _folders_recount_ancestors(db, parent_ids)
+        await invalidation.notify_changes(db, list(deleted_ids) + recounted_ids)
+
+    nodes_cache.invalidate(list(deleted_ids) + recounted_ids)
+    recent_updates.discard(deleted_ids)
+    return deleted_ids & set(unique_ids)
+
+
+async def _items_update_paths(db: Connection, item_ids: List[str]) -> None:
+    """
+    Поддерживаем materialized path (items.path - массив id предков от корня
+    до родителя) после вставки/обновления элементов item_ids.
+
+    Сначала вычисляем пути самих item_ids, поднимаясь по "parentId" (это
+    единственный источник правды, path предков может еще быть устаревшим,
+    если предок переехал в этом же импорте). Затем одним UPDATE переписываем
+    path у потомков переехавших папок: префикс до последнего переехавшего
+    предка заменяется на его новый путь, а хвост после него не менялся.
+    """
+    moved_folders = await _items_set_paths(db, item_ids)
+    await _items_update_descendant_paths(db, moved_folders, item_ids)
+
+
+async def _items_set_paths(db: Connection, item_ids: List[str]) -> List[str]:
+    """Первая часть _items_update_paths: path самих item_ids, возвращает папки, у которых он изменился"""
+    query = """
+        WITH RECURSIVE up AS (
+            SELECT id, "parentId" AS cur, CAST(ARRAY[] AS varchar[]) AS path
+                FROM items WHERE id = ANY(:ids)
+            UNION ALL
+            SELECT up.id, i."parentId", i.id || up.path
+                FROM up INNER JOIN items i ON i.id = up.cur
+                WHERE i.id <> up.id AND NOT i.id = ANY(up.path)
+        ), new_path AS (
+            SELECT id, path FROM up WHERE cur IS NULL
+        ), moved AS (
+            UPDATE items SET path = new_path.path
+                FROM new_path
+                WHERE items.id = new_path.id AND items.path IS DISTINCT FROM new_path.path
+                RETURNING items.id, items.type
+        )
+        SELECT (SELECT COUNT(*) FROM new_path) AS found,
+               ARRAY(SELECT id FROM moved WHERE type = 'FOLDER') AS moved_folders;
+    """
+    row = await db.fetch_one(query=query, values={'ids': item_ids})
+    if row['found'] != len(item_ids):  # type: ignore[index]
+        # до корня не дошли - элементы образуют цикл по "parentId"
+        raise ValueError("Imported items form a parentId cycle.")
+    return row['moved_folders']  # type: ignore[index, no-any-return]
+
+
+async def _items_update_descendant_paths(db: Connection, moved_folders: List[str], item_ids: List[str]) -> None:
+    """Переписывает path потомков переехавших папок, кроме самих item_ids (их path уже верный)"""
+    if not moved_folders:
+        return
+    query = """
+        UPDATE items d
+            SET path = m.path || m.id || d.path[last_moved.pos + 1:]
+            FROM (
+                SELECT d2.id, MAX(a.ord) AS pos
+                    FROM items d2, unnest(d2.path) WITH ORDINALITY a(id, ord)
+                    WHERE d2.path && CAST(:moved AS varchar[]) AND a.id = ANY(:moved)
+                    GROUP BY d2.id
+            ) last_moved, items m
+            WHERE d.id = last_moved.id
+                AND m.id = d.path[last_moved.pos]
+                AND NOT d.id = ANY(:ids);
+    """
+    await db.execute(query=query, values={'moved': moved_folders, 'ids': item_ids})
+
+
+async def _items_rebuild_paths(db: Connection) -> None:
+    """Полное перестроение items.path по "parentId" (миграция и режим починки)"""
+    query = """
+        WITH RECURSIVE tree AS (
+            SELECT id, CAST(ARRAY[] AS varchar[]) AS path
+                FROM items WHERE "parentId" IS NULL
+            UNION ALL
+            SELECT i.id, tree.path || tree.id
+                FROM items i INNER JOIN tree ON i."parentId" = tree.id
+        )
+        UPDATE items SET path = tree.path
+            FROM tree
+            WHERE items.id = tree.id AND items.path IS DISTINCT FROM tree.path;
+    """
+    await db.execute(query=query)
+
+
+async def _folders_recount_ancestors(db: Connection, seed_ids: Iterable[str]) -> List[str]:
+    """
+    Пересчитываем размеры и даты только тех папок, которые лежат на цепочках
+    предков seed_ids (включая сами seed_ids). Возвращает id обновленных папок.
+
+    Папки обновляются снизу вверх по глубине (длине path). Размер папки - сумма
+    размеров прямых детей, дата - максимум из своей даты и дат детей. У
+    незатронутых детей размер и дата и так верные, поэтому импорт 10 файлов в
+    дерево глубины 5 стоит 5 UPDATE, а не пересчета всей таблицы.
+    """
+    seed_ids = list(set(seed_ids))
+    if not seed_ids:
+        return []
+    with CRUD_DURATION.time('recount'):
+        recounted_ids = await _folders_recount_levels(db, seed_ids)
+    RECOUNT_FOLDERS.inc(amount=len(recounted_ids))
+    return recounted_ids
+
+
+# предков берем прямо из path, без рекурсии
+RECOUNT_ANCESTORS_QUERY = """
+    SELECT f.id, cardinality(f.path) AS depth
+        FROM items f
+        WHERE f.type = 'FOLDER' AND f.id IN (
+            SELECT unnest(s.path || s.id) FROM items s WHERE s.id = ANY($1)
+        );
+"""
+
+RECOUNT_LEVEL_QUERY = """
+    UPDATE items f
+        SET size = stat.size, date = GREATEST(f.date, stat.date)
+        FROM (
+            SELECT p.id, COALESCE(SUM(c.size), 0) AS size, MAX(c.date) AS date
+                FROM items p LEFT JOIN items c ON c."parentId" = p.id
+                WHERE p.id = ANY($1)
+                GROUP BY p.id
+        ) stat
+        WHERE f.id = stat.id;
+"""
+
+
+async def _folders_recount_levels(db: Connection, seed_ids: List[str]) -> List[str]:
+    rows = await db.raw_connection.fetch(RECOUNT_ANCESTORS_QUERY, seed_ids)
+    levels: Dict[int, List[str]] = {}
+    for folder_id, depth in rows:
+        levels.setdefault(depth, []).append(folder_id)
+
+    for depth in sorted(levels, reverse=True):
+        await db.raw_connection.execute(RECOUNT_LEVEL_QUERY, levels[depth])
+    return [row['id'] for row in rows]
 
 
 async def _folders_recount_stat(db: Connection) -> None:
-    """Пересчитываем размеры папок и их даты после добавления и удаления элементов"""
+    """
+    Полный пересчет path, размеров и дат всех папок в таблице. В обычной работе
+    не используется (см. _folders_recount_ancestors), оставлен как режим
+    починки: `python main.py recount-folders`.
+    """
     async with db.transaction():
+        await _items_rebuild_paths(db)
+
+        # каждый элемент учитывается во всех папках из своего path
         query = """
-            WITH RECURSIVE cte AS (
-                SELECT id, "parentId", type, date,
-                       CASE WHEN type='FILE' THEN size ELSE 0 END AS size
-                    FROM items
-                UNION ALL
-                SELECT i2.id, i2."parentId", i2.type, GREATEST(cte.date, i2.date) as date,
-                       CASE WHEN i2.type='FILE' THEN i2.size + cte.size ELSE cte.size END AS size
-                    FROM cte INNER JOIN items i2 ON cte."parentId" = i2.id
+            WITH stat AS (
+                SELECT a.id,
+                       SUM(CASE WHEN d.type = 'FILE' THEN d.size ELSE 0 END) AS size,
+                       MAX(d.date) AS date
+                    FROM items d, unnest(d.path) a(id)
+                    GROUP BY a.id
             )
-            SELECT id, "parentId", type, SUM(size) as new_size, MAX(date) as new_date
-                FROM cte
-                GROUP BY id, "parentId", type
-                HAVING cte.type = 'FOLDER';
+            UPDATE items f
+                SET size = COALESCE(stat.size, 0), date = GREATEST(f.date, stat.date)
+                FROM items f2 LEFT JOIN stat ON stat.id = f2.id
+                WHERE f.id = f2.id AND f.type = 'FOLDER';
         """
-        # я не смог вытащить эти данные сразу в update, приходится пропускать
-        # через python
-        rows = await db.fetch_all(query=query)
-        values_all = []
-        for row in rows:
-            values_all.append({
-                'id': row['id'],
-                'new_size': int(row['new_size']),
-                'new_date': row['new_date']
-            })
+        await db.execute(query=query)
+        await invalidation.notify_changes(db, None)
+
 
-        for chunk in chunk_list(values_all, 1000):
-            query = "UPDATE items SET size=CAST(:new_size AS BIGINT), date=:new_date WHERE id=:id;"
-            await db.execute_many(query=query, values=chunk)
+# все поддерево - это элементы, у которых item_id есть среди предков в path (GIN-индекс)
+SUBTREE_QUERY = """
+    SELECT id, url, "parentId", type, size, date
+        FROM items WHERE id = $1
+    UNION ALL
+    SELECT id, url, "parentId", type, size, date
+        FROM items WHERE path @> ARRAY[CAST($1 AS varchar)]
+"""
 
 
 async def get_item(db: Connection, item_id: str) -> Union[schemas.SystemItem, None]:
-    query = """
-        WITH RECURSIVE cte AS (
-            SELECT i1.id, i1.url, i1."parentId", i1.type, i1.size, i1.date
-                FROM items i1 WHERE i1.id = :id
-            UNION
-            SELECT i2.id, i2.url, i2."parentId", i2.type, i2.size, i2.date
-                FROM items i2 INNER JOIN cte rec ON rec.id = i2."parentId"
-        ) SELECT * FROM cte;
-    """
-    rows = await db.fetch_all(query=query, values={'id': item_id})
+    rows = await db.raw_connection.fetch(SUBTREE_QUERY, item_id)
     if not rows:
         return None
 
@@ -134,46 +640,352 @@ async def get_item(db: Connection, item_id: str) -> Union[schemas.SystemItem, No
     return obj_map[item_id]
 
 
-async def get_item_history(
-    db: Connection, item_id: str, date_start: Union[datetime, None],
-    date_end: Union[datetime, None]
-) -> schemas.SystemItemHistoryResponse:
+class SubtreeTooLarge(Exception):
+    """Поддерево больше лимита строк, его надо отдавать потоком (iter_item_json)"""
+
+
+# поддерево не глубже depth уровней: рекурсия по parentId останавливается на
+# этом уровне, так что Postgres не читает то, что все равно будет отброшено
+SUBTREE_DEPTH_QUERY = """
+    WITH RECURSIVE subtree AS (
+        SELECT id, url, "parentId", type, size, date, 0 AS level
+            FROM items WHERE id = $1
+        UNION ALL
+        SELECT i.id, i.url, i."parentId", i.type, i.size, i.date, s.level + 1
+            FROM items i
+                INNER JOIN subtree s ON i."parentId" = s.id
+            WHERE s.level < $2 AND s.type = 'FOLDER'
+    )
+    SELECT id, url, "parentId", type, size, date, level FROM subtree
+"""
+
+# варианты с LIMIT - отдельные запросы, чтобы их тоже можно было подготовить заранее
+SUBTREE_LIMIT_QUERY = SUBTREE_QUERY + ' LIMIT $2'
+SUBTREE_DEPTH_LIMIT_QUERY = SUBTREE_DEPTH_QUERY + ' LIMIT $3'
+
+
+async def get_item_json(
+    db: Connection, item_id: str, max_rows: Union[int, None] = None,
+    depth: Union[int, None] = None, fields: Union[Collection[str], None] = None
+) -> Union[bytes, None]:
+    """
+    Быстрый вариант get_item для ответа клиенту: дерево собирается из сырых
+    записей asyncpg в обычные dict и сразу сериализуется orjson, без создания
+    и повторной валидации pydantic-моделей. Результат побайтно совпадает с
+    сериализацией schemas.SystemItem из get_item.
+
+    Если в поддереве больше max_rows элементов, бросает SubtreeTooLarge, прочитав
+    из базы не больше max_rows + 1 строк.
+
+    depth ограничивает глубину дерева (0 - только сам элемент), у папок на
+    последнем уровне children равно null. fields оставляет в узлах только
+    перечисленные поля (children остается всегда).
+    """
+    args: List[Any] = [item_id] if depth is None else [item_id, depth]
+    if max_rows:
+        query = SUBTREE_LIMIT_QUERY if depth is None else SUBTREE_DEPTH_LIMIT_QUERY
+        args.append(max_rows + 1)
+    else:
+        query = SUBTREE_QUERY if depth is None else SUBTREE_DEPTH_QUERY
+    with CRUD_DURATION.time('subtree_fetch'):
+        rows = await db.raw_connection.fetch(query, *args)
+    if max_rows and len(rows) > max_rows:
+        raise SubtreeTooLarge(item_id)
+    if not rows:
+        return None
+    return orjson.dumps(_build_tree(rows, item_id, depth=depth, fields=fields))
+
+
+# поддеревья сразу нескольких элементов одним запросом: каждая строка
+# читается один раз, даже если поддеревья вложены друг в друга. LIMIT NULL - без лимита
+NODES_BATCH_QUERY = """
+    SELECT id, url, "parentId", type, size, date
+        FROM items WHERE id = ANY($1) OR path && CAST($1 AS varchar[])
+        LIMIT $2
+"""
+
+# то же, но только элементы не глубже $2 уровней хотя бы от одного из запрошенных
+NODES_BATCH_DEPTH_QUERY = """
+    SELECT id, url, "parentId", type, size, date
+        FROM items i
+        WHERE id = ANY($1) OR (path && CAST($1 AS varchar[]) AND EXISTS (
+            SELECT 1 FROM unnest(i.path) WITH ORDINALITY AS a(id, n)
+                WHERE a.id = ANY($1) AND cardinality(i.path) - a.n < $2
+        ))
+        LIMIT $3
+"""
+
+
+async def get_items_json(
+    db: Connection, item_ids: Sequence[str], max_rows: Union[int, None] = None, depth: Union[int, None] = None
+) -> bytes:
+    """
+    Ответ POST /nodes:batch: {"items": [...]} с деревом каждого из item_ids в
+    том же порядке и формате, что и get_item_json, для ненайденного id -
+    маркер {"id", "code": 404, "message"}. Все поддеревья читаются одним
+    запросом по множеству id без повторов.
+
+    Если всего в поддеревьях больше max_rows элементов, бросает SubtreeTooLarge.
+    """
+    unique_ids = list(dict.fromkeys(item_ids))
+    limit = max_rows + 1 if max_rows else None
+    with CRUD_DURATION.time('subtree_fetch'):
+        if depth is None:
+            rows = await db.raw_connection.fetch(NODES_BATCH_QUERY, unique_ids, limit)
+        else:
+            rows = await db.raw_connection.fetch(NODES_BATCH_DEPTH_QUERY, unique_ids, depth, limit)
+    if max_rows and len(rows) > max_rows:
+        raise SubtreeTooLarge(unique_ids)
+
+    row_map: Dict[str, Sequence[Any]] = {}
+    children: Dict[str, List[Sequence[Any]]] = {}
+    for row in rows:
+        row_map[row[0]] = row
+        if row[2] is not None:
+            children.setdefault(row[2], []).append(row)
+    trees: Dict[str, Dict[str, Any]] = {}
+    for item_id in unique_ids:
+        if item_id in row_map:
+            trees[item_id] = _build_subtree(row_map[item_id], children, depth)
+        else:
+            trees[item_id] = {'id': item_id, 'code': 404, 'message': 'Item not found'}
+    return orjson.dumps({'items': [trees[item_id] for item_id in item_ids]})
+
+
+def _build_subtree(
+    root: Sequence[Any], children: Dict[str, List[Sequence[Any]]], depth: Union[int, None]
+) -> Dict[str, Any]:
+    """
+    Дерево от строки root по индексу детей (parentId -> строки). Узлы у каждого
+    дерева свои, т.к. при depth одна и та же папка может быть обрезана в одном
+    дереве и раскрыта в другом. Обход без рекурсии, глубина дерева не ограничена.
+    """
+    def node(row: Sequence[Any], level: int) -> Dict[str, Any]:
+        id_, url, parent_id, type_, size, date = row
+        truncated = depth is not None and level == depth
+        return {
+            'id': id_,
+            'url': url,
+            'parentId': parent_id,
+            'type': type_,
+            'size': size,
+            'date': date,
+            'children': None if type_ == 'FILE' or truncated else [],
+        }
+
+    tree = node(root, 0)
+    stack = [(tree, 0)]
+    while stack:
+        parent, level = stack.pop()
+        if parent['children'] is None:
+            continue
+        for row in children.get(parent['id'], []):
+            child = node(row, level + 1)
+            parent['children'].append(child)
+            stack.append((child, level + 1))
+    return tree
+
+
+async def iter_item_json(
+    db: Connection, item_id: str, chunk_size: int = 64 * 1024,
+    depth: Union[int, None] = None, fields: Union[Collection[str], None] = None
+) -> AsyncIterator[bytes]:
+    """
+    Потоковый вариант get_item_json для очень больших поддеревьев: строки
+    читаются серверным курсором в порядке обхода в глубину (сортировка по
+    path || id), а JSON отдается кусками по мере обхода. В памяти держится
+    только стек открытых папок и текущий кусок ответа.
+
+    Порядок children здесь по id, а не произвольный, формат узлов тот же.
+    """
     query = """
-        SELECT id, url, "parentId", type, size, date
-            FROM items_history
-                WHERE id = :id {} {};
+        SELECT id, url, "parentId", type, size, date, cardinality(path) AS depth
+            FROM items
+            WHERE (id = $1 OR path @> ARRAY[CAST($1 AS varchar)]) {}
+            ORDER BY path || id;
     """.format(
-        'AND date >= :date_start' if date_start is not None else '',
-        'AND date < :date_end' if date_end is not None else ''
+        '' if depth is None else 'AND cardinality(path) <= (SELECT cardinality(path) FROM items WHERE id = $1) + $2'
     )
-    values: Dict[str, Union[str, datetime]] = {'id': item_id}
-    if date_start is not None:
-        values['date_start'] = date_start
-    if date_end is not None:
-        values['date_end'] = date_end
-
-    rows = await db.fetch_all(query=query, values=values)
-    history_response = schemas.SystemItemHistoryResponse()
-    for row in rows:
-        history_response.items.append(
-            schemas.SystemItemHistoryUnit(**dict(row))
-        )
-    return history_response
+    args: List[Any] = [item_id] if depth is None else [item_id, depth]
+    hidden = _hidden_fields(fields)
+    buffer: List[bytes] = []
+    buffered = 0
+    # для каждой открытой папки: были ли уже выведены дети (нужна запятая)
+    open_folders: List[bool] = []
+    root_depth = None
+    async with db.transaction():
+        async for id_, url, parent_id, type_, size, date, path_depth in db.raw_connection.cursor(
+            query, *args, prefetch=1000
+        ):
+            if root_depth is None:
+                root_depth = path_depth
+            while len(open_folders) > path_depth - root_depth:
+                open_folders.pop()
+                buffer.append(b']}')
+            if open_folders:
+                if open_folders[-1]:
+                    buffer.append(b',')
+                open_folders[-1] = True
+
+            node = {
+                'id': id_,
+                'url': url,
+                'parentId': parent_id,
+                'type': type_,
+                'size': size,
+                'date': date,
+            }
+            for key in hidden:
+                del node[key]
+            node_json = orjson.dumps(node)
+            buffer.append(node_json[:-1] + (b',"children":' if node else b'"children":'))
+            if type_ == 'FILE' or (depth is not None and path_depth - root_depth == depth):
+                buffer.append(b'null}')
+            else:
+                buffer.append(b'[')
+                open_folders.append(False)
+
+            buffered += len(node_json) + 16
+            if buffered >= chunk_size:
+                yield b''.join(buffer)
+                buffer, buffered = [], 0
+
+    if root_depth is None:
+        # элемент успели удалить между проверкой и началом потока
+        buffer.append(b'null')
+    buffer.append(b']}' * len(open_folders))
+    yield b''.join(buffer)
+
+
+def _build_tree(
+    rows: Iterable[Sequence[Any]], root_id: str, depth: Union[int, None] = None,
+    fields: Union[Collection[str], None] = None
+) -> Dict[str, Any]:
+    """
+    Собирает дерево из строк (id, url, parentId, type, size, date[, level]) в
+    dict'ы с теми же полями и в том же порядке, что и schemas.SystemItem: для
+    пустой папки children равно [], для файла - null.
+    """
+    node_map: Dict[str, Dict[str, Any]] = {}
+    for id_, url, parent_id, type_, size, date, *level in rows:
+        truncated = depth is not None and level[0] == depth
+        node_map[id_] = {
+            'id': id_,
+            'url': url,
+            'parentId': parent_id,
+            'type': type_,
+            'size': size,
+            'date': date,
+            'children': None if type_ == 'FILE' or truncated else [],
+        }
+    for id_, node in node_map.items():
+        if node['parentId'] is not None and id_ != root_id:
+            node_map[node['parentId']]['children'].append(node)
+    hidden = _hidden_fields(fields)
+    if hidden:
+        # связи уже построены, лишние поля можно убирать прямо из узлов
+        for node in node_map.values():
+            for key in hidden:
+                del node[key]
+    return node_map[root_id]
+
+
+# поля узла дерева в ответе /nodes/{id}, кроме children
+NODE_FIELDS = ('id', 'url', 'parentId', 'type', 'size', 'date')
+
+
+def _hidden_fields(fields: Union[Collection[str], None]) -> List[str]:
+    if fields is None:
+        return []
+    return [key for key in NODE_FIELDS if key not in fields]
+
+
+async def get_item_history(
+    db: Connection, item_id: str, date_start: Union[datetime, None],
+    date_end: Union[datetime, None], limit: Union[int, None] = None,
+    after: Union[Tuple[datetime, str], None] = None
+) -> schemas.SystemItemHistoryResponse:
+    """
+    История элемента. С limit история отдается страницами в порядке (date, id),
+    следующая страница начинается строго после ключа after (keyset pagination).
+    """
+    query = _history_query(_item_history_conditions(date_start is not None, date_end is not None), limit, after)
+    args = [item_id] + [date for date in (date_start, date_end) if date is not None]
+    with CRUD_DURATION.time('history_fetch'):
+        rows = await db.raw_connection.fetch(query, *args, *_keyset_page_args(limit, after))
+    return _history_response(rows)
 
 
 async def get_history_daterange(
-    db: Connection, date_start: datetime, date_end: datetime
+    db: Connection, date_start: datetime, date_end: datetime, limit: Union[int, None] = None,
+    after: Union[Tuple[datetime, str], None] = None
 ) -> schemas.SystemItemHistoryResponse:
-    # Без сортировки, в описании модели указано: история в произвольном порядке.
-    query = """
-        SELECT id, url, "parentId", type, size, date
-            FROM items_history
-                WHERE date >= :date_start AND date <= :date_end AND type = 'FILE';
+    # Без limit - без сортировки, в описании модели указано: история в произвольном порядке.
+    # С limit - страницы в порядке (date, id) по индексу items_history_date_id_idx.
+    units = recent_updates.query(date_start, date_end, limit=limit, after=after)
+    if units is not None:
+        history_response = schemas.SystemItemHistoryResponse()
+        history_response.items.extend(units)
+        return history_response
+
+    query = _history_query(UPDATES_CONDITIONS, limit, after)
+    with CRUD_DURATION.time('history_fetch'):
+        rows = await db.raw_connection.fetch(query, date_start, date_end, *_keyset_page_args(limit, after))
+    return _history_response(rows)
+
+
+# условия выборки из items_history, {} - место очередного параметра
+UPDATES_CONDITIONS = ('date >= {}', 'date <= {}', "type = 'FILE'")
+
+
+def _item_history_conditions(has_start: bool, has_end: bool) -> List[str]:
+    return ['id = {}'] + (['date >= {}'] if has_start else []) + (['date < {}'] if has_end else [])
+
+
+def _history_query(conditions: Sequence[str], limit: Union[int, None], after: Union[Tuple[datetime, str], None]) -> str:
     """
-    rows = await db.fetch_all(query=query, values={'date_start': date_start, 'date_end': date_end})
-    history_response = schemas.SystemItemHistoryResponse()
-    for row in rows:
-        history_response.items.append(
-            schemas.SystemItemHistoryUnit(**dict(row))
-        )
-    return history_response
+    Текст запроса истории: параметры нумеруются $1, $2... по порядку условий,
+    за ними идут параметры страницы из _keyset_page_args. Для одних и тех же
+    условий текст всегда одинаковый, так что запрос подготавливается один раз.
+    """
+    parts = list(conditions)
+    if limit is not None and after is not None:
+        parts.append('(date, id) > ({}, {})')
+    query = 'SELECT id, url, "parentId", type, size, date FROM items_history WHERE ' + ' AND '.join(parts)
+    if limit is not None:
+        query += ' ORDER BY date, id LIMIT {}'
+    return query.format(*('${}'.format(number) for number in range(1, query.count('{}') + 1)))
+
+
+def _keyset_page_args(limit: Union[int, None], after: Union[Tuple[datetime, str], None]) -> List[Any]:
+    if limit is None:
+        return []
+    return ([] if after is None else list(after)) + [limit]
+
+
+def _history_response(rows: Iterable[Any]) -> schemas.SystemItemHistoryResponse:
+    # строки из базы уже корректны, модели собираются без валидации
+    # (ответ все равно проверяется по response_model роутера)
+    return schemas.SystemItemHistoryResponse.construct(
+        items=[schemas.SystemItemHistoryUnit.construct(**row) for row in rows]
+    )
+
+
+def _hot_queries() -> List[str]:
+    """Все варианты горячих запросов, которые соединения пула готовят заранее (см. prepared.py)"""
+    queries = [
+        SUBTREE_QUERY, SUBTREE_LIMIT_QUERY, SUBTREE_DEPTH_QUERY, SUBTREE_DEPTH_LIMIT_QUERY,
+        NODES_BATCH_QUERY, NODES_BATCH_DEPTH_QUERY,
+        UPSERT_QUERY, RECOUNT_ANCESTORS_QUERY, RECOUNT_LEVEL_QUERY, invalidation.NOTIFY_QUERY,
+    ]
+    after = (datetime.min, '')
+    pages: List[Tuple[Union[int, None], Union[Tuple[datetime, str], None]]] = [(None, None), (1, None), (1, after)]
+    for limit, page_after in pages:
+        for has_start in (False, True):
+            for has_end in (False, True):
+                queries.append(_history_query(_item_history_conditions(has_start, has_end), limit, page_after))
+        queries.append(_history_query(UPDATES_CONDITIONS, limit, page_after))
+    return queries
+
+
+HOT_QUERIES = _hot_queries()
@@ -1,44 +1,94 @@
-from typing import AsyncGenerator, Union
+from typing import Any, AsyncGenerator, Dict, Union, cast
 from sys import modules
 
 from databases import Database
 from databases.core import Connection
 import asyncpg.exceptions
+from fastapi import HTTPException, Request
 
+from yadiskapi import crud, jobs, partitioning
+from yadiskapi.pool import PoolExhausted, PoolMonitor
+from yadiskapi.prepared import PreparedConnection, statement_preparer
+from yadiskapi.replicas import Replica, ReplicaSet, read_lsn
+from yadiskapi.tracing import TracedConnection
 from yadiskapi.config import settings
 
 
 # https://www.encode.io/databases/
-def configure_database(my_force_rollback: Union[None, bool] = None) -> Database:
+def configure_database(my_force_rollback: Union[None, bool] = None, dsn: Union[None, str] = None) -> Database:
     """
     Хелпер для создания конфигурации БД. Нужен, т.к. есть 3 варианта использования:
     1) к реальной БД, не использует принудительный откат транзакций в конце,
     2) к тестовой БД во время тестов - использует,
     3) к тестовой БД для первоначального создания таблиц перед тестами - НЕ использует.
+    Явный dsn нужен бенчмаркам, которые работают со своей базой.
     """
     if my_force_rollback is not None:
         force_rollback = my_force_rollback
     else:
         force_rollback = True if 'pytest' in modules else False
 
+    if dsn is None:
+        dsn = settings.db_test_dsn if 'pytest' in modules else settings.db_dsn
+    prepared_options: Dict[str, Any] = {}
+    if settings.db_prepare_hot_statements:
+        # горячие запросы crud готовятся сразу при открытии соединения, см. prepared.py
+        prepared_options = {'connection_class': PreparedConnection, 'init': statement_preparer(crud.HOT_QUERIES)}
     return Database(
-        settings.db_test_dsn if 'pytest' in modules else settings.db_dsn,
+        dsn,
         force_rollback=force_rollback,
-        # TODO: tweak this pool settings and check that they correspond to pg docker container settings
-        min_size=2,
-        max_size=5
+        # параметры asyncpg.create_pool
+        min_size=settings.db_pool_min_size,
+        max_size=settings.db_pool_max_size,
+        max_queries=settings.db_pool_max_queries,
+        max_inactive_connection_lifetime=settings.db_pool_max_inactive_lifetime,
+        **prepared_options,
     )
 
 
 database = configure_database()
+db_pool = PoolMonitor(
+    database,
+    min_size=settings.db_pool_min_size,
+    max_size=settings.db_pool_max_size,
+    acquire_timeout=settings.db_pool_acquire_timeout,
+    adaptive=settings.db_pool_adaptive,
+    adaptive_target_wait=settings.db_pool_adaptive_target_wait,
+    adaptive_interval=settings.db_pool_adaptive_interval,
+)
+# у реплик свои пулы тех же размеров, в тестах откат транзакций на них не нужен: они только читают
+read_replicas = ReplicaSet(db_pool, [
+    Replica(PoolMonitor(
+        configure_database(my_force_rollback=False, dsn=dsn.strip()),
+        min_size=settings.db_pool_min_size,
+        max_size=settings.db_pool_max_size,
+        acquire_timeout=settings.db_pool_acquire_timeout,
+    ))
+    for dsn in settings.db_replica_dsns.split(',') if dsn.strip()
+])
 
 
 async def get_db_conn() -> AsyncGenerator[Connection, None]:
-    async with database.connection() as db_con:
-        yield db_con
-
-
-async def init_models(delete_all=False):
+    try:
+        async with db_pool.connection() as db_con:
+            # crud работает с оберткой как с обычным Connection, см. tracing.py
+            yield cast(Connection, TracedConnection(db_con))
+    except PoolExhausted:
+        raise HTTPException(status_code=503, detail="Database is overloaded")
+
+
+async def get_read_db_conn(request: Request) -> AsyncGenerator[Connection, None]:
+    """get_db_conn для GET-запросов, которые можно отдать с реплики (см. replicas.py)"""
+    try:
+        async with read_replicas.connection(read_lsn(request)) as (db_con, replica):
+            # ответы с реплики могут отставать, их не кэшируют (см. get_nodes_id)
+            request.state.db_replica = replica
+            yield cast(Connection, TracedConnection(db_con))
+    except PoolExhausted:
+        raise HTTPException(status_code=503, detail="Database is overloaded")
+
+
+async def init_models(delete_all=False, dsn: Union[None, str] = None):
     """
     Функция для создания (и опциально для удаления старых) таблиц приложения
     в тестовой и обычной БД. Вызывается: 1) из консольной команде перед запуском
@@ -47,11 +97,12 @@ async def init_models(delete_all=False):
     Использует отдельный коннект к базе, чтобы даже из тестовой среды обойти
     ограничение на откат всех транзакций в конце соединения.
     """
-    one_time_db_conn = configure_database(my_force_rollback=False)
+    one_time_db_conn = configure_database(my_force_rollback=False, dsn=dsn)
     await one_time_db_conn.connect()
     async with one_time_db_conn.connection() as conn:
         async with conn.transaction():
             if delete_all:
+                await conn.execute(query="DROP TABLE IF EXISTS import_jobs;")
                 await conn.execute(query="DROP TABLE IF EXISTS items_history;")
                 await conn.execute(query="DROP TABLE IF EXISTS items;")
                 await conn.execute(query="DROP TYPE IF EXISTS type;")
@@ -76,6 +127,7 @@ async def init_models(delete_all=False):
                     type type NOT NULL,
                     size bigint,
                     date timestamp with time zone NOT NULL,
+                    path character varying[] NOT NULL DEFAULT '{}',
                     CONSTRAINT items_pkey PRIMARY KEY (id),
                     CONSTRAINT "items_parentId_fkey" FOREIGN KEY ("parentId")
                         REFERENCES items (id) MATCH SIMPLE
@@ -88,25 +140,56 @@ async def init_models(delete_all=False):
             query = """CREATE INDEX IF NOT EXISTS items_parentId_fkey_idx ON items ("parentId");"""
             await one_time_db_conn.execute(query=query)
 
+            # materialized path: массив id всех предков элемента от корня до родителя.
+            # Таблицы, созданные до появления колонки, мигрируем и строим path с нуля.
             query = """
-                CREATE TABLE IF NOT EXISTS items_history
-                (
-                    id character varying NOT NULL,
-                    url character varying(255),
-                    "parentId" character varying,
-                    type type NOT NULL,
-                    size bigint,
-                    date timestamp with time zone NOT NULL,
-                    CONSTRAINT items_history_pkey PRIMARY KEY (id, date),
-                    CONSTRAINT items_history_id_fkey FOREIGN KEY (id)
-                        REFERENCES items (id) MATCH SIMPLE
-                        ON UPDATE CASCADE
-                        ON DELETE CASCADE
-                        DEFERRABLE INITIALLY IMMEDIATE
-                );
+                SELECT COUNT(*) FROM information_schema.columns
+                    WHERE table_name = 'items' AND column_name = 'path';
             """
+            if not await conn.fetch_val(query=query):
+                query = """ALTER TABLE items ADD COLUMN path character varying[] NOT NULL DEFAULT '{}';"""
+                await conn.execute(query=query)
+                await crud._items_rebuild_paths(conn)
+            query = """CREATE INDEX IF NOT EXISTS items_path_idx ON items USING gin (path);"""
             await one_time_db_conn.execute(query=query)
-            query = """CREATE INDEX IF NOT EXISTS items_date_idx ON items_history (date);"""
-            await one_time_db_conn.execute(query=query)
 
+            # если таблица уже есть в другом виде, ее не трогаем: в партиционированную
+            # она переводится отдельной командой migrate-history
+            await partitioning.create_history_table(conn, partitioned=settings.history_partitioning)
+            if settings.history_partitioning and await partitioning.is_history_partitioned(conn):
+                await partitioning.maintain_history_partitions(conn)
+
+            await jobs.create_jobs_table(conn)
+
+    await one_time_db_conn.disconnect()
+
+
+async def repair_folders_stat():
+    """
+    Полный пересчет размеров и дат всех папок (режим починки). При обычной
+    работе приложения папки пересчитываются инкрементально.
+    """
+    one_time_db_conn = configure_database(my_force_rollback=False)
+    await one_time_db_conn.connect()
+    async with one_time_db_conn.connection() as conn:
+        # через TracedConnection: медленные шаги полного пересчета видны в логе
+        await crud._folders_recount_stat(cast(Connection, TracedConnection(conn)))
+    await one_time_db_conn.disconnect()
+
+
+async def migrate_history_partitions():
+    """Перевод существующей items_history в партиционированную по date таблицу"""
+    one_time_db_conn = configure_database(my_force_rollback=False)
+    await one_time_db_conn.connect()
+    async with one_time_db_conn.connection() as conn:
+        await partitioning.migrate_history_to_partitions(conn)
+    await one_time_db_conn.disconnect()
+
+
+async def maintain_history_partitions():
+    """Создание будущих и удаление устаревших партиций items_history (например, из cron)"""
+    one_time_db_conn = configure_database(my_force_rollback=False)
+    await one_time_db_conn.connect()
+    async with one_time_db_conn.connection() as conn:
+        await partitioning.maintain_history_partitions(conn)
     await one_time_db_conn.disconnect()
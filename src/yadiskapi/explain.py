@@ -0,0 +1,79 @@
+"""
+Выборочный захват планов запросов: для доли sample_rate выполнений запрос
+перед настоящим выполнением прогоняется под EXPLAIN (ANALYZE, BUFFERS,
+FORMAT JSON) в savepoint (или отдельной транзакции), который всегда
+откатывается, так что изменяющие запросы ничего не меняют. Планы копятся в
+ограниченном кольцевом буфере и отдаются через GET /admin/explain.
+"""
+import logging
+import random
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Union
+
+import orjson
+from databases.core import Connection
+
+from yadiskapi.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_PREFIX = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+# EXPLAIN ANALYZE поддерживает только такие запросы
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+class PlanSampler:
+    def __init__(self, sample_rate: float, buffer_size: int) -> None:
+        self.sample_rate = sample_rate
+        self.plans: Deque[Dict[str, Any]] = deque(maxlen=buffer_size)
+        self.captured = 0
+        self.failed = 0
+
+    def should_sample(self, query: Any) -> bool:
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return False
+        return isinstance(query, str) and query.lstrip().upper().startswith(EXPLAINABLE)
+
+    async def capture(self, connection: Connection, query: str, run: Callable[[str], Awaitable[Any]]) -> None:
+        """
+        run(explain_query) выполняет EXPLAIN с теми же параметрами, что и
+        исходный запрос. Ошибка EXPLAIN не должна ломать сам запрос: она
+        откатывается вместе с savepoint и только считается.
+        """
+        try:
+            async with connection.transaction(force_rollback=True):
+                result = await run(EXPLAIN_PREFIX + query)
+        except Exception:
+            self.failed += 1
+            logger.debug('EXPLAIN failed for %s', query, exc_info=True)
+            return
+        # asyncpg отдает json как строку
+        plan = orjson.loads(result) if isinstance(result, (str, bytes)) else result
+        top = plan[0]
+        self.plans.append({
+            'captured_at': datetime.now(timezone.utc).isoformat(),
+            'query': ' '.join(query.split()),
+            'execution_time_ms': top.get('Execution Time'),
+            'planning_time_ms': top.get('Planning Time'),
+            'plan': top['Plan'],
+        })
+        self.captured += 1
+
+    def entries(self, limit: Union[int, None] = None) -> List[Dict[str, Any]]:
+        """Последние планы, новые первыми"""
+        plans = list(reversed(self.plans))
+        return plans[:limit] if limit is not None else plans
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'sample_rate': self.sample_rate,
+            'buffered': len(self.plans),
+            'buffer_size': self.plans.maxlen,
+            'captured': self.captured,
+            'failed': self.failed,
+        }
+
+
+plan_sampler = PlanSampler(settings.explain_sample_rate, settings.explain_buffer_size)
@@ -0,0 +1,107 @@
+"""
+Group commit небольших импортов: параллельные POST /imports по нескольку
+элементов каждый открывали свою транзакцию и пересчитывали одни и те же
+цепочки папок. Здесь первый пришедший импорт запускает группу:
+она ждет import_group_commit_ms, забирает все импорты, пришедшие за это время, и
+применяет их одной транзакцией (crud.bulk_create_item_groups) в отдельной
+задаче на своем соединении из пула. Каждый импорт ждет результат своего батча.
+"""
+import asyncio
+import contextvars
+from datetime import datetime
+from typing import Any, Dict, List, Sequence, Set, Tuple, Union, cast
+
+from databases.core import Connection
+
+from yadiskapi import crud, jobs, schemas
+from yadiskapi.config import settings
+from yadiskapi.database import db_pool
+from yadiskapi.tracing import TracedConnection
+
+
+_Pending = Tuple[Sequence[schemas.ImportItem], datetime, 'asyncio.Future[None]']
+
+
+class ImportGroupCommit:
+    def __init__(self, window_ms: float, max_items: int, max_batches: int) -> None:
+        self.window = window_ms / 1000
+        self.max_items = max_items
+        self.max_batches = max_batches
+        self._pending: List[_Pending] = []
+        self._full: Union[asyncio.Event, None] = None
+        # ссылки на задачи групп, чтобы их не собрал сборщик мусора
+        self._tasks: Set['asyncio.Task[None]'] = set()
+        self.groups = 0
+        self.batches = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def accepts(self, items: Sequence[schemas.ImportItem]) -> bool:
+        """Группируются только небольшие импорты, большие выгоднее писать отдельно (в т.ч. через COPY)"""
+        return self.enabled and len(items) <= self.max_items
+
+    async def submit(self, items: Sequence[schemas.ImportItem], date: datetime) -> None:
+        """Импорт в составе группы, ошибка именно этого батча выбрасывается вызвавшему"""
+        future: 'asyncio.Future[None]' = asyncio.get_running_loop().create_future()
+        self._pending.append((items, date, future))
+        if len(self._pending) == 1:
+            self._full = asyncio.Event()
+            # группа применяется отдельной задачей на своем соединении, а не в
+            # запросе первого импорта: обрыв его клиента не отменяет импорты
+            # остальных. Пустой контекст - чтобы databases не отдал задаче
+            # соединение запроса из contextvar
+            task = contextvars.Context().run(asyncio.ensure_future, self._run(self._full))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif len(self._pending) >= self.max_batches and self._full is not None:
+            self._full.set()
+        # отмена вызвавшего не отменяет применение его батча в группе
+        await asyncio.shield(future)
+
+    async def _run(self, full: asyncio.Event) -> None:
+        try:
+            await asyncio.wait_for(full.wait(), timeout=self.window)
+        except asyncio.TimeoutError:
+            pass
+        # следующие импорты начинают новую группу
+        group, self._pending, self._full = self._pending, [], None
+        try:
+            async with db_pool.connection() as connection:
+                db = cast(Connection, TracedConnection(connection))
+                # порядок с асинхронными импортами как у одиночного импорта, по самой поздней дате группы
+                async with jobs.queue_turn(db, max(date for _, date, _ in group)):
+                    results = await crud.bulk_create_item_groups(db, [(items, date) for items, date, _ in group])
+        except Exception as e:
+            # упала вся группа (соединение, пересчет, коммит): ошибка у всех
+            for _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            # остановка приложения
+            for _, _, future in group:
+                future.cancel()
+            raise
+        self.groups += 1
+        self.batches += len(group)
+        for (_, _, future), error in zip(group, results):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'groups': self.groups,
+            'batches': self.batches,
+            'avg_group_size': round(self.batches / self.groups, 2) if self.groups else 0,
+        }
+
+
+import_group_commit = ImportGroupCommit(
+    settings.import_group_commit_ms, settings.import_group_commit_max_items, settings.import_group_commit_max_batches
+)
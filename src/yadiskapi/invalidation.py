@@ -0,0 +1,158 @@
+"""
+Межпроцессная инвалидация кэша GET /nodes/{id}. Кэш живет внутри процесса,
+а писать в базу могут и другие процессы: воркеры uvicorn, другие экземпляры
+приложения, воркеры очереди импорта, `python main.py recount-folders`.
+Поэтому каждая запись внутри своей транзакции шлет NOTIFY в канал CHANNEL со
+списком измененных id: Postgres доставляет его слушателям только после
+коммита (и не доставляет при откате). Каждый процесс слушает канал отдельным
+соединением (ChangeListener) и сбрасывает у себя эти записи кэша, свои
+уведомления пропускает - их он уже применил сам.
+
+Пока соединение слушателя потеряно, уведомления пропадают, поэтому после
+переподключения кэш сбрасывается целиком.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, Dict, Iterable, Optional, Union
+
+import asyncpg
+from databases.core import Connection
+import orjson
+
+from yadiskapi.cache import nodes_cache
+from yadiskapi.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'yadiskapi_changes'
+NOTIFY_QUERY = 'SELECT pg_notify($1, $2);'
+# payload NOTIFY ограничен 8000 байтами, больший список id заменяется сбросом всего кэша
+MAX_PAYLOAD_BYTES = 7900
+
+_process_ids: Dict[int, str] = {}
+
+
+def process_id() -> str:
+    """id процесса в уведомлениях; после fork (gunicorn --preload) у каждого воркера свой"""
+    return _process_ids.setdefault(os.getpid(), uuid.uuid4().hex)
+
+
+def changes_payload(item_ids: Union[Iterable[str], None]) -> str:
+    """Текст уведомления: измененные id или None - сбросить все"""
+    ids = list(dict.fromkeys(item_ids)) if item_ids is not None else None
+    payload = orjson.dumps({'process': process_id(), 'ids': ids})
+    if len(payload) > MAX_PAYLOAD_BYTES:
+        payload = orjson.dumps({'process': process_id(), 'ids': None})
+    return payload.decode()
+
+
+async def notify_changes(db: Connection, item_ids: Union[Iterable[str], None]) -> None:
+    """Вызывается внутри транзакции записи, None - изменено неизвестно что (поток, полный пересчет)"""
+    if settings.cache_invalidation:
+        await db.raw_connection.execute(NOTIFY_QUERY, CHANNEL, changes_payload(item_ids))
+
+
+class ChangeListener:
+    """Слушает CHANNEL и применяет к кэшам процесса изменения, сделанные другими процессами"""
+
+    def __init__(self, check_interval: float) -> None:
+        self.check_interval = check_interval
+        self.notifications = 0
+        self.reconnects = 0
+        self._dsn = ''
+        self._connection: Optional[asyncpg.Connection] = None
+        self._queue: 'asyncio.Queue[Optional[str]]' = asyncio.Queue()
+
+    async def start(self, dsn: str) -> None:
+        """
+        Подключается и начинает слушать канал. Вызывается при старте до
+        прогрева кэшей, иначе изменения между прогревом и LISTEN пропали бы.
+        """
+        self._dsn = dsn
+        await self._listen()
+
+    async def run(self) -> None:
+        """Фоновая задача: применяет уведомления и переподключается при потере соединения"""
+        try:
+            while True:
+                if self._connection is None:
+                    try:
+                        await self._listen()
+                    except Exception as e:
+                        logger.warning("Change listener can't connect: %s", e)
+                        await asyncio.sleep(self.check_interval)
+                        continue
+                    self.reconnects += 1
+                    # пока соединения не было, уведомления могли пропасть
+                    nodes_cache.clear()
+                try:
+                    payload = await asyncio.wait_for(self._queue.get(), self.check_interval)
+                except asyncio.TimeoutError:
+                    # полуоткрытое TCP-соединение само не закрывается, проверяем его
+                    if not await self._alive():
+                        self._drop()
+                    continue
+                if payload is None:
+                    self._drop()
+                    continue
+                self.apply(payload)
+        finally:
+            self._drop()
+
+    def apply(self, payload: str) -> None:
+        try:
+            message = orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            logger.warning("Bad change notification: %r", payload)
+            message = {'process': None, 'ids': None}
+        if message['process'] == process_id():
+            return
+        self.notifications += 1
+        if message['ids'] is None:
+            nodes_cache.clear()
+        else:
+            nodes_cache.invalidate(message['ids'])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'listening': self._connection is not None,
+            'notifications': self.notifications,
+            'reconnects': self.reconnects,
+        }
+
+    async def _listen(self) -> None:
+        # у каждого соединения своя очередь: None от закрытия прежнего ее не касается
+        queue: 'asyncio.Queue[Optional[str]]' = asyncio.Queue()
+        self._queue = queue
+        connection = await asyncpg.connect(self._dsn)
+        try:
+            # None в очереди - соединение закрылось
+            connection.add_termination_listener(lambda _connection: queue.put_nowait(None))
+            await connection.add_listener(
+                CHANNEL, lambda _connection, _pid, _channel, payload: queue.put_nowait(payload)
+            )
+        except BaseException:
+            connection.terminate()
+            raise
+        self._connection = connection
+
+    async def _alive(self) -> bool:
+        if self._connection is None:
+            return False
+        try:
+            await asyncio.wait_for(self._connection.fetchval('SELECT 1;'), self.check_interval)
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+            logger.warning("Change listener connection is lost: %s", e)
+            return False
+        return True
+
+    def _drop(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is not None and not connection.is_closed():
+            connection.terminate()
+
+
+change_listener = ChangeListener(settings.cache_invalidation_check_interval)
@@ -0,0 +1,212 @@
+"""
+Асинхронные импорты: POST /imports с заголовком Prefer: respond-async
+проверяет батч, кладет его в таблицу import_jobs и сразу отвечает 202 с id
+задачи. Фоновые воркеры (import_jobs_workers на процесс) применяют задачи по
+одной в порядке (updateDate, id) обычным crud.bulk_create_items, статус и
+время видны в GET /imports/{job_id}.
+
+Порядок держит сессионный advisory lock: задачу применяет только его
+владелец, поэтому задача в статусе running без владельца lock'а - это
+задача упавшего воркера, она берется заново (ее транзакция откатилась).
+Синхронный импорт при наличии более ранних задач сначала применяет их сам
+под тем же lock'ом, так что даты не идут назад ни в каком режиме.
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional, Sequence, Union, cast
+
+import orjson
+from databases import Database
+from databases.core import Connection
+from databases.interfaces import Record
+
+from yadiskapi import crud, schemas
+from yadiskapi.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# произвольная константа для pg_advisory_lock очереди импортов
+QUEUE_LOCK_KEY = 7_412_002
+
+JOBS_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS import_jobs
+    (
+        id bigserial PRIMARY KEY,
+        status character varying NOT NULL DEFAULT 'queued',
+        update_date timestamp with time zone NOT NULL,
+        items_count integer NOT NULL,
+        payload bytea,
+        error text,
+        created_at timestamp with time zone NOT NULL DEFAULT clock_timestamp(),
+        started_at timestamp with time zone,
+        finished_at timestamp with time zone
+    );
+"""
+
+# событие для мгновенного пробуждения воркеров этого процесса после постановки задачи
+_wakeup: Union[asyncio.Event, None] = None
+
+
+async def create_jobs_table(db: Connection) -> None:
+    await db.execute(query=JOBS_TABLE_DDL)
+    # очередь - это только незавершенные задачи, частичный индекс остается маленьким
+    query = """
+        CREATE INDEX IF NOT EXISTS import_jobs_pending_idx ON import_jobs (update_date, id)
+            WHERE status IN ('queued', 'running');
+    """
+    await db.execute(query=query)
+
+
+def _wake_workers() -> None:
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+async def enqueue(db: Connection, items: Sequence[schemas.ImportItem], date: datetime) -> Record:
+    """Сохраняет проверенный батч задачей очереди, возвращает строку задачи"""
+    # компактно: элемент - массив полей в порядке SystemItemImportRecord
+    payload = orjson.dumps([[item.id, item.url, item.parentId, item.type, item.size] for item in items])
+    query = """
+        INSERT INTO import_jobs(update_date, items_count, payload)
+            VALUES (:date, :count, :payload)
+            RETURNING *;
+    """
+    row = await db.fetch_one(query=query, values={'date': date, 'count': len(items), 'payload': payload})
+    _wake_workers()
+    return cast(Record, row)
+
+
+async def get_job(db: Connection, job_id: int) -> Union[Record, None]:
+    query = """
+        SELECT id, status, update_date, items_count, error, created_at, started_at, finished_at
+            FROM import_jobs WHERE id = :id;
+    """
+    return await db.fetch_one(query=query, values={'id': job_id})
+
+
+async def _apply_next(db: Connection, until: Optional[datetime] = None) -> Optional[int]:
+    """
+    Применяет самую раннюю задачу (не позже until). Вызывать только под
+    QUEUE_LOCK_KEY. Возвращает id задачи или None, если очередь пуста.
+    """
+    query = """
+        SELECT id, update_date, payload FROM import_jobs
+            WHERE status IN ('queued', 'running') AND (CAST(:until AS timestamptz) IS NULL OR update_date <= :until)
+            ORDER BY update_date, id
+            LIMIT 1;
+    """
+    row = await db.fetch_one(query=query, values={'until': until})
+    if row is None:
+        return None
+    job_id = row['id']
+    query = "UPDATE import_jobs SET status = 'running', started_at = clock_timestamp() WHERE id = :id;"
+    await db.execute(query=query, values={'id': job_id})
+
+    items = [schemas.SystemItemImportRecord(*item) for item in orjson.loads(row['payload'])]
+    try:
+        async with db.transaction():
+            await crud.bulk_create_items(db, items, row['update_date'])
+            # отметка done в той же транзакции, что и сам импорт
+            query = """
+                UPDATE import_jobs SET status = 'done', payload = NULL, finished_at = clock_timestamp()
+                    WHERE id = :id;
+            """
+            await db.execute(query=query, values={'id': job_id})
+    except Exception as e:
+        logger.warning("Import job %s failed: %s", job_id, e)
+        query = """
+            UPDATE import_jobs SET status = 'failed', error = :error, payload = NULL, finished_at = clock_timestamp()
+                WHERE id = :id;
+        """
+        await db.execute(query=query, values={'id': job_id, 'error': str(e) or type(e).__name__})
+    return cast(int, job_id)
+
+
+async def _lock(db: Connection, wait: bool) -> bool:
+    if wait:
+        await db.execute(query="SELECT pg_advisory_lock(:key);", values={'key': QUEUE_LOCK_KEY})
+        return True
+    return bool(await db.fetch_val(query="SELECT pg_try_advisory_lock(:key);", values={'key': QUEUE_LOCK_KEY}))
+
+
+async def _unlock(db: Connection) -> None:
+    await db.execute(query="SELECT pg_advisory_unlock(:key);", values={'key': QUEUE_LOCK_KEY})
+
+
+async def _drain(db: Connection, until: Optional[datetime]) -> List[int]:
+    applied: List[int] = []
+    while True:
+        job_id = await _apply_next(db, until)
+        if job_id is None:
+            return applied
+        applied.append(job_id)
+
+
+async def apply_pending(db: Connection, until: Optional[datetime] = None, wait: bool = True) -> List[int]:
+    """
+    Применяет все задачи очереди (с update_date не позже until) по порядку.
+    wait=False - не ждать lock, если очередь уже разбирает кто-то другой.
+    """
+    if not await _lock(db, wait):
+        return []
+    try:
+        return await _drain(db, until)
+    finally:
+        await _unlock(db)
+
+
+@asynccontextmanager
+async def queue_turn(db: Connection, date: datetime) -> AsyncIterator[None]:
+    """
+    Синхронный импорт в асинхронном режиме: под lock'ом очереди сначала
+    применяются задачи с датой не позже date, потом сам импорт, так что
+    воркер не применит более позднюю задачу раньше него.
+    """
+    if not settings.import_jobs_workers:
+        yield
+        return
+    await _lock(db, wait=True)
+    try:
+        await _drain(db, date)
+        yield
+    finally:
+        await _unlock(db)
+
+
+async def import_worker(database: Database, number: int) -> None:
+    """Фоновая задача приложения: разбирает очередь, между проходами ждет новых задач"""
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    while True:
+        try:
+            async with database.connection() as db:
+                applied = await apply_pending(db, wait=False)
+            if applied:
+                logger.info("Import worker %s applied jobs %s", number, applied)
+        except Exception:
+            logger.exception("Import worker %s failed", number)
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=settings.import_jobs_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def job_response(row: Any) -> schemas.ImportJob:
+    started, finished = row['started_at'], row['finished_at']
+    return schemas.ImportJob(
+        id=row['id'],
+        status=row['status'],
+        updateDate=row['update_date'],
+        items=row['items_count'],
+        error=row['error'],
+        createdAt=row['created_at'],
+        startedAt=started,
+        finishedAt=finished,
+        queueSeconds=(started - row['created_at']).total_seconds() if started else None,
+        applySeconds=(finished - started).total_seconds() if started and finished else None,
+    )
@@ -1,17 +1,30 @@
-from typing import Any, Dict
+import asyncio
+from secrets import compare_digest
+from typing import Any, Dict, List, Optional
 
+from asyncpg.exceptions import DeadlockDetectedError
 from databases.core import Connection
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Header, HTTPException, Query
 from fastapi.exceptions import RequestValidationError
+from fastapi.openapi.utils import get_openapi
+from pydantic.schema import schema as pydantic_schema
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import ORJSONResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, JSONResponse, Response
 from starlette import status
 
 from yadiskapi.routers import base, additional
+from yadiskapi.cache import nodes_cache
 from yadiskapi.config import settings
-from yadiskapi.database import get_db_conn, database
-from yadiskapi import schemas
+from yadiskapi.database import get_db_conn, database, db_pool, read_replicas
+from yadiskapi.explain import plan_sampler
+from yadiskapi.group_commit import import_group_commit
+from yadiskapi.invalidation import change_listener
+from yadiskapi.jobs import import_worker
+from yadiskapi.partitioning import history_maintenance_loop
+from yadiskapi.updates_index import recent_updates
+from yadiskapi.tracing import QueryStatsMiddleware, configure_sql_logging
+from yadiskapi import metrics, schemas
 
 
 app = FastAPI(
@@ -24,13 +37,74 @@ app.include_router(base.router)
 app.include_router(additional.router)
 
 
+def openapi() -> Dict[str, Any]:
+    """
+    Тело POST /imports разбирается вручную (base.import_request_body), поэтому
+    FastAPI сам не кладет SystemItemImportRequest в components, добавляем.
+    """
+    if app.openapi_schema is None:
+        openapi_schema = get_openapi(
+            title=app.title, version=app.version, description=app.description, routes=app.routes
+        )
+        components = openapi_schema.setdefault('components', {}).setdefault('schemas', {})
+        definitions = pydantic_schema([schemas.SystemItemImportRequest], ref_prefix='#/components/schemas/')
+        for name, definition in definitions['definitions'].items():
+            components.setdefault(name, jsonable_encoder(definition, by_alias=True, exclude_none=True))
+        app.openapi_schema = openapi_schema
+    return app.openapi_schema
+
+
+app.openapi = openapi  # type: ignore[method-assign]
+app.add_middleware(QueryStatsMiddleware)
+if settings.metrics_enabled:
+    app.add_middleware(metrics.MetricsMiddleware)
+configure_sql_logging()
+
+# состояние пула и кэшей читается только в момент запроса /metrics
+metrics.CallbackMetric(
+    'yadiskapi_db_pool_connections', 'Database pool connections by state.', ('state',),
+    lambda: {(state,): db_pool.stats()[state] or 0 for state in ('size', 'idle', 'in_use', 'waiters', 'limit')}
+)
+metrics.CallbackMetric(
+    'yadiskapi_cache_events_total', 'Hits and misses of in-process caches.', ('cache', 'event'),
+    lambda: {
+        **{('nodes', event): nodes_cache.stats()[event] for event in ('hits', 'misses', 'evictions')},
+        **{('updates_index', event): recent_updates.stats()[event] for event in ('hits', 'misses')},
+    },
+    kind='counter'
+)
+
+
+background_tasks: List[asyncio.Task] = []  # type: ignore[type-arg]
+
+
 @app.on_event("startup")
 async def startup():
     await database.connect()
+    # databases хранит соединение в contextvar, задачи наследуют контекст при
+    # создании: воркеры запускаются до первого database.connection(), иначе
+    # у них было бы одно соединение на всех
+    for number in range(settings.import_jobs_workers):
+        background_tasks.append(asyncio.create_task(import_worker(database, number)))
+    if settings.cache_invalidation and nodes_cache.enabled:
+        # слушаем изменения других процессов до прогрева кэшей, см. invalidation.py
+        await change_listener.start(str(database.url).replace('+asyncpg', '', 1))
+        background_tasks.append(asyncio.create_task(change_listener.run()))
+    async with database.connection() as db:
+        await recent_updates.warm_up(db)
+    if read_replicas.enabled:
+        await read_replicas.connect()
+        background_tasks.append(asyncio.create_task(read_replicas.health_loop()))
+    if settings.history_partitioning:
+        background_tasks.append(asyncio.create_task(history_maintenance_loop(database)))
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await read_replicas.disconnect()
     await database.disconnect()
 
 
@@ -61,6 +135,17 @@ async def http_exception_handler(request, exc) -> JSONResponse:
     )
 
 
+@app.exception_handler(DeadlockDetectedError)
+async def deadlock_exception_handler(request, exc) -> JSONResponse:
+    # запись столкнулась с параллельной и откатилась (crud повторяет ее сам,
+    # но не бесконечно и не для потокового импорта): запрос можно повторить
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=jsonable_encoder(schemas.Error(code=503, message="Concurrent write conflict, retry the request")),
+        headers={'Retry-After': '1'},
+    )
+
+
 @app.get("/check", tags=["Сервисные endpoint"])
 async def check_alive(db: Connection = Depends(get_db_conn)) -> Dict[str, Any]:
     result = await db.fetch_one("SELECT 1 AS alive")
@@ -69,13 +154,37 @@ async def check_alive(db: Connection = Depends(get_db_conn)) -> Dict[str, Any]:
         'title': app.title,
         'version': app.version,
         'db_server_alive': db_alive,
+        'db_pool': db_pool.stats(),
+        'nodes_cache': nodes_cache.stats(),
+        'updates_index': recent_updates.stats(),
+        'cache_invalidation': change_listener.stats(),
+        'import_group_commit': import_group_commit.stats(),
+        'db_replicas': read_replicas.stats(),
     }
 
 
+@app.get("/metrics", tags=["Сервисные endpoint"], response_class=Response)
+async def get_metrics() -> Response:
+    """Метрики в текстовом формате Prometheus"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def check_admin_token(x_admin_token: Optional[str] = Header(None)) -> None:
+    if settings.admin_token and not compare_digest(x_admin_token or '', settings.admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get("/admin/explain", tags=["Сервисные endpoint"], dependencies=[Depends(check_admin_token)])
+async def get_explain_plans(limit: Optional[int] = Query(None, ge=1)) -> Dict[str, Any]:
+    """Последние планы запросов, снятые EXPLAIN ANALYZE (см. EXPLAIN_SAMPLE_RATE), новые первыми"""
+    return {'stats': plan_sampler.stats(), 'plans': plan_sampler.entries(limit)}
+
+
 if __name__ == "__main__":
-    import asyncio
     from typer import Typer
-    from yadiskapi.database import init_models
+    from yadiskapi.database import (
+        init_models, repair_folders_stat, migrate_history_partitions, maintain_history_partitions
+    )
 
     cli = Typer()
 
@@ -87,4 +196,28 @@ if __name__ == "__main__":
         asyncio.run(init_models(drop_all))
         print("DB tables created.")
 
+    @cli.command()
+    def recount_folders():
+        """
+        cli command to repair sizes and dates of all folders with a full recount
+        """
+        asyncio.run(repair_folders_stat())
+        print("Folders recounted.")
+
+    @cli.command()
+    def migrate_history():
+        """
+        cli command to convert existing items_history table into a table partitioned by date
+        """
+        asyncio.run(migrate_history_partitions())
+        print("History table partitioned.")
+
+    @cli.command()
+    def maintain_history():
+        """
+        cli command to create future and drop expired items_history partitions (e.g. from cron)
+        """
+        asyncio.run(maintain_history_partitions())
+        print("History partitions maintained.")
+
     cli()
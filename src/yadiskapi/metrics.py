@@ -0,0 +1,191 @@
+"""
+Метрики приложения в текстовом формате Prometheus для GET /metrics.
+
+Своя минимальная реализация вместо prometheus_client: приложение работает в
+одном event loop, поэтому счетчикам не нужны блокировки, а наблюдение в
+гистограмму - это bisect по границам корзин и пара сложений.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10_000, 100_000)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def collect(self) -> Iterator[str]:
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+        yield from self._samples()
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        for labels, value in self._values.items():
+            yield '{}{} {}'.format(self.name, _labels(self.labelnames, labels), _number(value))
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # на каждый набор меток: счетчики корзин (последняя - +Inf), сумма
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1][0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, *labels)
+
+    def _samples(self) -> Iterator[str]:
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else _number(bound))
+                yield '{}_bucket{} {}'.format(self.name, _labels(self.labelnames, labels, le), cumulative)
+            yield '{}_sum{} {}'.format(self.name, _labels(self.labelnames, labels), _number(total[0]))
+            yield '{}_count{} {}'.format(self.name, _labels(self.labelnames, labels), cumulative)
+
+
+class CallbackMetric(Metric):
+    """
+    Gauge или counter, значения которого читаются функцией в момент запроса
+    /metrics в виде {значения меток: число}. Для счетчиков, которые и так
+    ведут другие объекты (пул, кэши).
+    """
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str],
+        func: Callable[[], Dict[Tuple[str, ...], float]], kind: str = 'gauge'
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+        self.kind = kind
+
+    def _samples(self) -> Iterator[str]:
+        for labels, value in self.func().items():
+            yield '{}{} {}'.format(self.name, _labels(self.labelnames, labels), _number(value))
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    'yadiskapi_http_request_duration_seconds', 'HTTP request latency.', ('method', 'route', 'status')
+)
+HTTP_RESPONSE_SIZE = Histogram(
+    'yadiskapi_http_response_size_bytes', 'HTTP response body size.', ('method', 'route'), buckets=SIZE_BUCKETS
+)
+CRUD_DURATION = Histogram(
+    'yadiskapi_crud_duration_seconds', 'Duration of database operations.', ('operation',)
+)
+IMPORT_ITEMS = Histogram(
+    'yadiskapi_import_items', 'Number of items per import.', buckets=ROWS_BUCKETS
+)
+RECOUNT_FOLDERS = Counter(
+    'yadiskapi_recount_folders_total', 'Folders updated by size/date recount.'
+)
+DEADLOCK_RETRIES = Counter(
+    'yadiskapi_deadlock_retries_total', 'Write transactions retried after a deadlock.', ('operation',)
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware (без BaseHTTPMiddleware, чтобы не копировать тело ответа):
+    время запроса до конца отправки ответа, статус и размер тела. Метка route -
+    шаблон пути (/nodes/{id}), а не сам путь, чтобы число рядов было конечным.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = perf_counter()
+        response: Dict[str, Any] = {'status': 500, 'size': 0}
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['size'] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            route_path = getattr(route, 'path', None) or 'unmatched'
+            method = scope['method']
+            HTTP_REQUEST_DURATION.observe(perf_counter() - started, method, route_path, str(response['status']))
+            HTTP_RESPONSE_SIZE.observe(response['size'], method, route_path)
@@ -0,0 +1,227 @@
+"""
+Декларативное партиционирование items_history по date (RANGE).
+
+Партиции называются items_history_pYYYYMMDD_YYYYMMDD по своим границам
+[from, to) в UTC, все, что не попало ни в одну из них (например, импорт с
+очень старой датой), ложится в items_history_default. Устаревшие партиции
+удаляются целиком (DROP TABLE) вместо DELETE по истории.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple, Union
+
+from databases import Database
+from databases.core import Connection
+
+from yadiskapi.config import settings
+from yadiskapi.updates_index import recent_updates
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TABLE = 'items_history'
+DEFAULT_PARTITION = 'items_history_default'
+PARTITION_PREFIX = 'items_history_p'
+# произвольная константа для pg_try_advisory_xact_lock, чтобы обслуживание
+# партиций не запускалось параллельно с нескольких реплик приложения
+MAINTENANCE_LOCK_KEY = 7_412_001
+
+HISTORY_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS {name}
+    (
+        id character varying NOT NULL,
+        url character varying(255),
+        "parentId" character varying,
+        type type NOT NULL,
+        size bigint,
+        date timestamp with time zone NOT NULL,
+        CONSTRAINT {name}_pkey PRIMARY KEY (id, date),
+        CONSTRAINT {name}_id_fkey FOREIGN KEY (id)
+            REFERENCES items (id) MATCH SIMPLE
+            ON UPDATE CASCADE
+            ON DELETE CASCADE
+            DEFERRABLE INITIALLY IMMEDIATE
+    ) {partition_by};
+"""
+
+
+def partition_bounds(moment: datetime, interval: str) -> Tuple[datetime, datetime]:
+    """Границы [from, to) партиции, в которую попадает moment"""
+    moment = moment.astimezone(timezone.utc) if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+    if interval == 'day':
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        return start, start + timedelta(days=1)
+    if interval == 'month':
+        start = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        if start.month == 12:
+            return start, start.replace(year=start.year + 1, month=1)
+        return start, start.replace(month=start.month + 1)
+    raise ValueError("Unknown history partition interval: {}".format(interval))
+
+
+def partition_name(start: datetime, end: datetime) -> str:
+    return '{}{:%Y%m%d}_{:%Y%m%d}'.format(PARTITION_PREFIX, start, end)
+
+
+def parse_partition_name(name: str) -> Union[Tuple[datetime, datetime], None]:
+    try:
+        start, end = name[len(PARTITION_PREFIX):].split('_')
+        return (
+            datetime.strptime(start, '%Y%m%d').replace(tzinfo=timezone.utc),
+            datetime.strptime(end, '%Y%m%d').replace(tzinfo=timezone.utc),
+        )
+    except ValueError:
+        return None
+
+
+async def is_history_partitioned(db: Connection) -> bool:
+    query = "SELECT relkind = 'p' FROM pg_class WHERE relname = :name AND relkind IN ('r', 'p');"
+    return bool(await db.fetch_val(query=query, values={'name': HISTORY_TABLE}))
+
+
+async def create_history_table(db: Connection, partitioned: bool) -> None:
+    """Создает items_history (обычную или партиционированную) и ее индексы"""
+    partition_by = 'PARTITION BY RANGE (date)' if partitioned else ''
+    await db.execute(query=HISTORY_TABLE_DDL.format(name=HISTORY_TABLE, partition_by=partition_by))
+    if partitioned:
+        query = "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;".format(DEFAULT_PARTITION, HISTORY_TABLE)
+        await db.execute(query=query)
+
+    # (date, id) - ключ для keyset-пагинации /updates, заменяет старый индекс по date.
+    # Партиции пишутся только в конец по времени, и для них можно вместо btree
+    # взять компактный BRIN: страницы /updates тогда досортировываются в 1-2 партициях.
+    if partitioned and settings.history_brin_index:
+        query = "CREATE INDEX IF NOT EXISTS items_history_date_brin_idx ON items_history USING brin (date);"
+    else:
+        query = "CREATE INDEX IF NOT EXISTS items_history_date_id_idx ON items_history (date, id);"
+    await db.execute(query=query)
+    await db.execute(query="DROP INDEX IF EXISTS items_date_idx;")
+
+
+async def list_history_partitions(db: Connection) -> List[str]:
+    query = """
+        SELECT c.relname
+            FROM pg_inherits i
+                INNER JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:name AS regclass)
+            ORDER BY c.relname;
+    """
+    rows = await db.fetch_all(query=query, values={'name': HISTORY_TABLE})
+    return [row['relname'] for row in rows]
+
+
+async def ensure_history_partitions(db: Connection, date_from: datetime, date_to: datetime) -> List[str]:
+    """
+    Создает недостающие партиции, покрывающие [date_from, date_to]. Если в
+    default-партиции уже есть строки из диапазона новой партиции, они
+    переносятся в нее. Возвращает имена созданных партиций.
+    """
+    interval = settings.history_partition_interval
+    existing = set(await list_history_partitions(db))
+    created = []
+    start, end = partition_bounds(date_from, interval)
+    while start <= date_to:
+        name = partition_name(start, end)
+        if name not in existing:
+            await _create_history_partition(db, name, start, end)
+            created.append(name)
+        start, end = partition_bounds(end, interval)
+    return created
+
+
+async def _create_history_partition(db: Connection, name: str, start: datetime, end: datetime) -> None:
+    # отдельная таблица + ATTACH, а не CREATE ... PARTITION OF, т.к. строки из
+    # default-партиции сначала нужно перенести, иначе Postgres не даст ее создать
+    async with db.transaction():
+        query = "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);".format(name, HISTORY_TABLE)
+        await db.execute(query=query)
+        query = """
+            WITH moved AS (
+                DELETE FROM {default} WHERE date >= :start AND date < :end RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved;
+        """.format(default=DEFAULT_PARTITION, name=name)
+        await db.execute(query=query, values={'start': start, 'end': end})
+        # границы партиции в DDL нельзя передать параметрами, но они всегда
+        # сформированы нами из datetime
+        query = "ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ('{}') TO ('{}');".format(
+            HISTORY_TABLE, name, start.isoformat(), end.isoformat()
+        )
+        await db.execute(query=query)
+    logger.info("History partition %s created", name)
+
+
+async def drop_expired_history_partitions(db: Connection, before: datetime) -> List[str]:
+    """
+    Удаляет партиции, целиком лежащие раньше before (DROP TABLE вместо DELETE).
+    Из default-партиции устаревшие строки удаляются обычным DELETE.
+    """
+    dropped = []
+    for name in await list_history_partitions(db):
+        bounds = parse_partition_name(name) if name.startswith(PARTITION_PREFIX) else None
+        if bounds is not None and bounds[1] <= before:
+            await db.execute(query="DROP TABLE {};".format(name))
+            dropped.append(name)
+            logger.info("History partition %s dropped by retention policy", name)
+    query = "DELETE FROM {} WHERE date < :before;".format(DEFAULT_PARTITION)
+    await db.execute(query=query, values={'before': before})
+    return dropped
+
+
+async def maintain_history_partitions(db: Connection, now: Union[datetime, None] = None) -> None:
+    """
+    Создает партиции на history_partitions_ahead интервалов вперед и удаляет
+    партиции старше history_retention_days (если задан). Безопасно вызывать
+    одновременно с нескольких реплик: работает только та, что взяла lock.
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    async with db.transaction():
+        query = "SELECT pg_try_advisory_xact_lock(:key);"
+        if not await db.fetch_val(query=query, values={'key': MAINTENANCE_LOCK_KEY}):
+            return
+        date_to = now
+        for _ in range(settings.history_partitions_ahead):
+            date_to = partition_bounds(date_to, settings.history_partition_interval)[1]
+        await ensure_history_partitions(db, now, date_to)
+        if settings.history_retention_days:
+            await drop_expired_history_partitions(db, now - timedelta(days=settings.history_retention_days))
+
+
+async def migrate_history_to_partitions(db: Connection) -> None:
+    """
+    Переводит существующую обычную таблицу items_history в партиционированную:
+    создает партиции под все имеющиеся даты и переливает в них историю.
+    """
+    async with db.transaction():
+        if await is_history_partitioned(db):
+            return
+        await db.execute(query="ALTER TABLE items_history RENAME TO items_history_old;")
+        await db.execute(query="ALTER INDEX items_history_pkey RENAME TO items_history_old_pkey;")
+        await db.execute(query="DROP INDEX IF EXISTS items_history_date_id_idx;")
+        await db.execute(query="DROP INDEX IF EXISTS items_date_idx;")
+        await create_history_table(db, partitioned=True)
+
+        query = "SELECT MIN(date) AS date_from, MAX(date) AS date_to FROM items_history_old;"
+        row = await db.fetch_one(query=query)
+        if row is not None and row['date_from'] is not None:
+            await ensure_history_partitions(db, row['date_from'], row['date_to'])
+        await db.execute(query="INSERT INTO items_history SELECT * FROM items_history_old;")
+        await db.execute(query="DROP TABLE items_history_old;")
+        await maintain_history_partitions(db)
+
+
+async def history_maintenance_loop(database: Database) -> None:
+    """Фоновая задача приложения: периодически обслуживает партиции истории"""
+    while True:
+        try:
+            async with database.connection() as db:
+                await maintain_history_partitions(db)
+            if settings.history_retention_days:
+                # удаленная по retention история не должна отдаваться из индекса /updates
+                now = datetime.now(timezone.utc)
+                recent_updates.evict_before(now - timedelta(days=settings.history_retention_days))
+        except Exception:
+            logger.exception("History partitions maintenance failed")
+        await asyncio.sleep(settings.history_maintenance_interval)
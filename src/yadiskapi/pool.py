@@ -0,0 +1,152 @@
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic, perf_counter
+from typing import Any, AsyncIterator, Dict, List, Union
+
+from databases import Database
+from databases.core import Connection
+
+
+class PoolExhausted(Exception):
+    """Соединение из пула не удалось получить за acquire_timeout"""
+
+
+class PoolMonitor:
+    """
+    Обертка над пулом соединений databases/asyncpg, через которую приложение
+    берет соединения: считает ожидающих, время ожидания соединения (гистограмма)
+    и ограничивает ожидание acquire_timeout.
+
+    В адаптивном режиме число одновременно выданных соединений ограничено
+    limit, который каждые adaptive_interval секунд подстраивается между
+    min_size и max_size по среднему времени ожидания: растет, если ждут дольше
+    adaptive_target_wait, и уменьшается, если соединения простаивают. Лишние
+    соединения asyncpg закрывает сам после max_inactive_connection_lifetime.
+    """
+
+    # верхние границы корзин гистограммы времени ожидания, секунды
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+    def __init__(
+        self, database: Database, min_size: int, max_size: int, acquire_timeout: float = 0,
+        adaptive: bool = False, adaptive_target_wait: float = 0.01, adaptive_interval: float = 5
+    ) -> None:
+        self.database = database
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout or None
+        self.adaptive = adaptive
+        self.adaptive_target_wait = adaptive_target_wait
+        self.adaptive_interval = adaptive_interval
+
+        self.limit = max_size if not adaptive else min_size
+        self.held = 0
+        self.waiters = 0
+        self.timeouts = 0
+        self.bucket_counts: List[int] = [0] * len(self.BUCKETS)
+        self.wait_count = 0
+        self.wait_sum = 0.0
+        # создается при первом использовании, чтобы привязаться к работающему event loop
+        self._condition: Union[asyncio.Condition, None] = None
+        # статистика текущего окна адаптации
+        self._window_started = monotonic()
+        self._window_count = 0
+        self._window_sum = 0.0
+        self._window_max_held = 0
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Connection]:
+        started = perf_counter()
+        self.waiters += 1
+        try:
+            conn = await asyncio.wait_for(self._acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise PoolExhausted("No free database connection in {} seconds.".format(self.acquire_timeout))
+        finally:
+            self.waiters -= 1
+        self._observe(perf_counter() - started)
+        try:
+            yield conn
+        finally:
+            await self._release(conn)
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def _acquire(self) -> Connection:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.held < self.limit)
+            self.held += 1
+        self._window_max_held = max(self._window_max_held, self.held)
+        conn = self.database.connection()
+        try:
+            await conn.__aenter__()
+        except BaseException:
+            await self._release_slot()
+            raise
+        return conn
+
+    async def _release(self, conn: Connection) -> None:
+        try:
+            await conn.__aexit__(None, None, None)  # type: ignore[arg-type]
+        finally:
+            await self._release_slot()
+
+    async def _release_slot(self) -> None:
+        async with self.condition:
+            self.held -= 1
+            self.condition.notify()
+
+    def _observe(self, wait: float) -> None:
+        for i, bound in enumerate(self.BUCKETS):
+            if wait <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.wait_count += 1
+        self.wait_sum += wait
+        self._window_count += 1
+        self._window_sum += wait
+        if self.adaptive and monotonic() - self._window_started >= self.adaptive_interval:
+            self._adapt()
+
+    def _adapt(self) -> None:
+        avg_wait = self._window_sum / self._window_count if self._window_count else 0
+        if avg_wait > self.adaptive_target_wait and self.limit < self.max_size:
+            self.limit = min(self.max_size, self.limit + max(1, self.limit // 2))
+            # новые слоты сразу отдаем ожидающим
+            asyncio.ensure_future(self._notify_all())
+        elif avg_wait < self.adaptive_target_wait / 4 and self._window_max_held < self.limit \
+                and self.limit > self.min_size:
+            self.limit -= 1
+        self._window_started = monotonic()
+        self._window_count = 0
+        self._window_sum = 0.0
+        self._window_max_held = self.held
+
+    async def _notify_all(self) -> None:
+        async with self.condition:
+            self.condition.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        pool = self.database._backend._pool  # type: ignore[attr-defined]
+        size: Union[int, None] = pool.get_size() if pool is not None else None
+        idle: Union[int, None] = pool.get_idle_size() if pool is not None else None
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.BUCKETS, self.bucket_counts):
+            cumulative += count
+            buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+        return {
+            'size': size,
+            'idle': idle,
+            'in_use': self.held,
+            'waiters': self.waiters,
+            'limit': self.limit,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'acquire_timeouts': self.timeouts,
+            'acquire_seconds': {'buckets': buckets, 'count': self.wait_count, 'sum': self.wait_sum},
+        }
@@ -0,0 +1,90 @@
+"""
+Подготовленные горячие запросы: поддерево /nodes, история, окно /updates,
+upsert импорта и пересчет папок. Все они готовятся (PREPARE) один раз при
+открытии соединения пула и дальше выполняются готовыми, без разбора и
+кэша выражений asyncpg. crud передает их в db.raw_connection обычным
+текстом с $n, подмену на подготовленное выражение делает класс соединения,
+поэтому трассировка, explain и реплики работают как раньше.
+"""
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, cast
+
+import asyncpg
+from asyncpg.exceptions import InvalidCachedStatementError
+from asyncpg.prepared_stmt import PreparedStatement
+
+
+logger = logging.getLogger(__name__)
+
+
+class PreparedConnection(asyncpg.Connection):
+    """asyncpg-соединение, которое выполняет известные ему запросы подготовленными"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.hot_statements: Dict[str, PreparedStatement] = {}
+
+    def _on_release(self, stacklevel: int = 1) -> None:
+        super()._on_release(stacklevel=stacklevel + 1)
+        # asyncpg считает подготовленные выражения недействительными после возврата
+        # соединения в пул (защита от чужих ссылок). Наши живут вместе с соединением
+        # и вызываются только через него, поэтому остаются рабочими.
+        for statement in self.hot_statements.values():
+            statement._con_release_ctr = self._pool_release_ctr
+
+    async def _run_hot(
+        self, query: str, run: Callable[[PreparedStatement], Awaitable[Any]], fallback: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        statement = self.hot_statements.get(query)
+        if statement is None:
+            return await fallback()
+        try:
+            return await run(statement)
+        except InvalidCachedStatementError:
+            # таблицу поменяли (например, migrate-history): дальше запрос идет обычным путем,
+            # вне транзакции его можно сразу повторить, внутри транзакция уже прервана
+            del self.hot_statements[query]
+            if self.is_in_transaction():
+                raise
+            return await fallback()
+
+    async def fetch(self, query: str, *args: Any, timeout: Any = None, record_class: Any = None) -> List[Any]:
+        if record_class is not None:
+            return cast(List[Any], await super().fetch(query, *args, timeout=timeout, record_class=record_class))
+        return cast(List[Any], await self._run_hot(
+            query, lambda statement: statement.fetch(*args, timeout=timeout),
+            lambda: super(PreparedConnection, self).fetch(query, *args, timeout=timeout)
+        ))
+
+    async def fetchval(self, query: str, *args: Any, column: int = 0, timeout: Any = None) -> Any:
+        return await self._run_hot(
+            query, lambda statement: statement.fetchval(*args, column=column, timeout=timeout),
+            lambda: super(PreparedConnection, self).fetchval(query, *args, column=column, timeout=timeout)
+        )
+
+    async def execute(self, query: str, *args: Any, timeout: Any = None) -> str:
+        async def run(statement: PreparedStatement) -> str:
+            await statement.fetch(*args, timeout=timeout)
+            return cast(str, statement.get_statusmsg())
+
+        return cast(str, await self._run_hot(
+            query, run, lambda: super(PreparedConnection, self).execute(query, *args, timeout=timeout)
+        ))
+
+
+def statement_preparer(queries: Iterable[str]) -> Callable[[PreparedConnection], Awaitable[None]]:
+    """Callback init для asyncpg.create_pool: готовит queries на каждом новом соединении пула"""
+    queries = list(queries)
+
+    async def prepare(connection: PreparedConnection) -> None:
+        for query in queries:
+            try:
+                # PREPARE берет lock'и таблиц запроса, транзакция отпускает их сразу,
+                # иначе открытие пула мешает DDL (init-db) на соседнем соединении
+                async with connection.transaction():
+                    connection.hot_statements[query] = await connection.prepare(query)
+            except asyncpg.PostgresError as e:
+                # таблиц еще нет (init-db, пустая база): запрос пойдет обычным путем
+                logger.debug("Statement is not prepared: %s", e)
+
+    return prepare
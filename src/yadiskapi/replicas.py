@@ -0,0 +1,185 @@
+"""
+Чтение с реплик: GET /nodes, /updates, /node/{id}/history берут соединение
+из пулов реплик (settings.db_replica_dsns) по кругу, запись и все остальное
+остаются на основной базе. Реплики периодически проверяются: недоступные и
+отстающие больше db_replica_max_lag_seconds не используются, пока не
+вернутся в строй. Без живых реплик чтение идет в основную базу.
+
+Read-your-writes: после импорта или удаления клиент получает cookie с
+позицией WAL основной базы, его чтения идут на реплику, только если она уже
+проиграла WAL дальше этой позиции, иначе - в основную базу.
+"""
+import asyncio
+import logging
+import re
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+from databases.core import Connection
+from fastapi import Request, Response
+
+from yadiskapi.config import settings
+from yadiskapi.pool import PoolMonitor
+
+
+logger = logging.getLogger(__name__)
+
+LSN_COOKIE = 'yadiskapi_lsn'
+_LSN_RE = re.compile(r'^[0-9A-F]{1,8}/[0-9A-F]{1,8}$')
+
+
+class Replica:
+    def __init__(self, pool: PoolMonitor) -> None:
+        self.pool = pool
+        self.connected = False
+        self.healthy = False
+        self.lag: Union[float, None] = None
+        self.reads = 0
+        self.errors = 0
+
+    @property
+    def host(self) -> Union[str, None]:
+        # dsn целиком не показываем, в нем пароль
+        return urlsplit(str(self.pool.database.url)).hostname
+
+    async def check(self, max_lag: float) -> None:
+        try:
+            if not self.connected:
+                await self.pool.database.connect()
+                self.connected = True
+            async with self.pool.connection() as db:
+                # без новых транзакций на основной базе replay_timestamp стоит на месте,
+                # поэтому если все полученное уже проиграно, отставания нет
+                query = """
+                    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                           END AS lag;
+                """
+                lag = await db.fetch_val(query=query)
+        except Exception as e:
+            if self.healthy:
+                logger.warning("Replica %s is down: %s", self.host, e)
+            self.healthy = False
+            self.errors += 1
+            return
+        self.lag = float(lag) if lag is not None else 0.0
+        healthy = not max_lag or self.lag <= max_lag
+        if healthy != self.healthy:
+            logger.warning("Replica %s is %s, lag %.1f s", self.host, 'up' if healthy else 'lagging', self.lag)
+        self.healthy = healthy
+
+
+class ReplicaSet:
+    def __init__(self, primary: PoolMonitor, replicas: List[Replica]) -> None:
+        self.primary = primary
+        self.replicas = replicas
+        self.primary_reads = 0
+        self._next = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    async def connect(self) -> None:
+        await self.check_health()
+
+    async def disconnect(self) -> None:
+        for replica in self.replicas:
+            if replica.connected:
+                await replica.pool.database.disconnect()
+                replica.connected = False
+
+    async def check_health(self) -> None:
+        await asyncio.gather(*(replica.check(settings.db_replica_max_lag_seconds) for replica in self.replicas))
+
+    async def health_loop(self) -> None:
+        """Фоновая задача приложения: периодически проверяет реплики"""
+        while True:
+            await asyncio.sleep(settings.db_replica_health_interval)
+            try:
+                await self.check_health()
+            except Exception:
+                logger.exception("Replicas health check failed")
+
+    def _choose(self) -> Union[Replica, None]:
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        self._next = (self._next + 1) % len(healthy)
+        return healthy[self._next]
+
+    @asynccontextmanager
+    async def connection(
+        self, min_lsn: Optional[str] = None
+    ) -> AsyncIterator[Tuple[Connection, Union[Replica, None]]]:
+        """
+        Соединение для чтения: с реплики, если есть живая и догнавшая min_lsn,
+        иначе с основной базы (тогда вторым значением None).
+        """
+        async with AsyncExitStack() as stack:
+            replica = self._choose()
+            db = await self._enter_replica(stack, replica, min_lsn) if replica is not None else None
+            if db is None:
+                replica = None
+                self.primary_reads += 1
+                db = await stack.enter_async_context(self.primary.connection())
+            yield db, replica
+
+    async def _enter_replica(
+        self, stack: AsyncExitStack, replica: Replica, min_lsn: Optional[str]
+    ) -> Union[Connection, None]:
+        replica_stack = AsyncExitStack()
+        try:
+            db = await replica_stack.enter_async_context(replica.pool.connection())
+            if min_lsn is not None:
+                # на основной базе (не в recovery) replay_lsn пустой, она всегда "догнала"
+                query = """
+                    SELECT COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn())
+                        >= CAST(CAST(:lsn AS text) AS pg_lsn);
+                """
+                if not await db.fetch_val(query=query, values={'lsn': min_lsn}):
+                    await replica_stack.aclose()
+                    return None
+        except Exception as e:
+            await replica_stack.aclose()
+            logger.warning("Replica %s failed, reading from primary: %s", replica.host, e)
+            replica.healthy = False
+            replica.errors += 1
+            return None
+        await stack.enter_async_context(replica_stack)
+        replica.reads += 1
+        return db
+
+    async def remember_write(self, db: Connection, response: Response) -> None:
+        """После записи: cookie с позицией WAL основной базы для read-your-writes"""
+        if not self.enabled or not settings.db_read_your_writes:
+            return
+        lsn = await db.fetch_val(query="SELECT CAST(pg_current_wal_lsn() AS text);")
+        response.set_cookie(
+            LSN_COOKIE, lsn, max_age=settings.db_read_your_writes_cookie_max_age, httponly=True, samesite='lax'
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'primary_reads': self.primary_reads,
+            'replicas': [
+                {
+                    'host': replica.host,
+                    'healthy': replica.healthy,
+                    'lag_seconds': replica.lag,
+                    'reads': replica.reads,
+                    'errors': replica.errors,
+                } for replica in self.replicas
+            ],
+        }
+
+
+def read_lsn(request: Request) -> Union[str, None]:
+    """Позиция WAL последней записи клиента из cookie, если read-your-writes включен"""
+    if not settings.db_read_your_writes:
+        return None
+    lsn = request.cookies.get(LSN_COOKIE)
+    if lsn is None or not _LSN_RE.match(lsn):
+        return None
+    return lsn
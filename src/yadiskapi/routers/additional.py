@@ -1,12 +1,14 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timedelta
-from typing import Optional, Union
+from typing import Any, Dict, Optional, Tuple, Union
 
-from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi import APIRouter, Query, Depends, HTTPException, Response
 from fastapi.responses import ORJSONResponse
 from databases.core import Connection
+import orjson
 
 from yadiskapi import schemas, crud
-from yadiskapi.database import get_db_conn
+from yadiskapi.database import get_read_db_conn
 
 
 router = APIRouter(
@@ -14,6 +16,45 @@ router = APIRouter(
     default_response_class=ORJSONResponse
 )
 
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+# постраничная выдача истории включается параметром limit, без него ответ как в спецификации
+LIMIT_QUERY = Query(None, ge=1, le=10000, description='Размер страницы истории (по умолчанию вся история).')
+CURSOR_QUERY = Query(None, description='Курсор следующей страницы из заголовка X-Next-Cursor.')
+PAGINATION_HEADERS: Dict[str, Any] = {
+    NEXT_CURSOR_HEADER: {
+        'description': 'Курсор следующей страницы, если запрошен limit и есть еще записи.',
+        'schema': {'type': 'string'}
+    }
+}
+
+
+def _encode_cursor(item: schemas.SystemItemHistoryUnit) -> str:
+    raw = orjson.dumps([item.date.isoformat(), item.id])
+    return urlsafe_b64encode(raw).decode()
+
+
+def _decode_cursor(cursor: Union[str, None], limit: Union[int, None]) -> Union[Tuple[datetime, str], None]:
+    if cursor is None:
+        return None
+    try:
+        if limit is None:
+            raise ValueError('cursor requires limit')
+        date, item_id = orjson.loads(urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(date), str(item_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Validation Failed")
+
+
+def _paginate(
+    history_response: schemas.SystemItemHistoryResponse, limit: Union[int, None], response: Response
+) -> schemas.SystemItemHistoryResponse:
+    """crud отдает limit + 1 запись, лишняя означает, что есть следующая страница"""
+    if limit is not None and len(history_response.items) > limit:
+        del history_response.items[limit:]
+        response.headers[NEXT_CURSOR_HEADER] = _encode_cursor(history_response.items[-1])
+    return history_response
+
 
 @router.get(
     '/updates',
@@ -22,7 +63,8 @@ router = APIRouter(
     responses={
         '200': {
             'model': schemas.SystemItemHistoryResponse,
-            'description': 'Информация об элементе.'
+            'description': 'Информация об элементе.',
+            'headers': PAGINATION_HEADERS
         },
         '400': {
             'model': schemas.Error,
@@ -31,10 +73,17 @@ router = APIRouter(
     }
 )
 async def get_updates(
-    date: datetime, db: Connection = Depends(get_db_conn)
+    date: datetime,
+    response: Response,
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    db: Connection = Depends(get_read_db_conn)
 ) -> Union[schemas.SystemItemHistoryResponse, schemas.Error]:
-    history_response = await crud.get_history_daterange(db, date - timedelta(hours=24), date)
-    return history_response
+    after = _decode_cursor(cursor, limit)
+    history_response = await crud.get_history_daterange(
+        db, date - timedelta(hours=24), date, limit=None if limit is None else limit + 1, after=after
+    )
+    return _paginate(history_response, limit, response)
 
 
 @router.get(
@@ -44,7 +93,8 @@ async def get_updates(
     responses={
         '200': {
             'model': schemas.SystemItemHistoryResponse,
-            'description': 'История по элементу.'
+            'description': 'История по элементу.',
+            'headers': PAGINATION_HEADERS
         },
         '400': {
             'model': schemas.Error,
@@ -58,15 +108,22 @@ async def get_updates(
 )
 async def get_node_id_history(
     id: str,
+    response: Response,
     date_start: Optional[datetime] = Query(None, alias='dateStart'),
     date_end: Optional[datetime] = Query(None, alias='dateEnd'),
-    db: Connection = Depends(get_db_conn)
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    db: Connection = Depends(get_read_db_conn)
 ) -> Union[schemas.SystemItemHistoryResponse, schemas.Error]:
     if date_start and date_end and date_start >= date_end:
         raise HTTPException(status_code=400, detail="Validation Failed")
+    after = _decode_cursor(cursor, limit)
 
-    history_response = await crud.get_item_history(db, id, date_start, date_end)
-    if len(history_response.items) == 0:
+    history_response = await crud.get_item_history(
+        db, id, date_start, date_end, limit=None if limit is None else limit + 1, after=after
+    )
+    # пустая страница после курсора - это просто конец истории, а не 404
+    if len(history_response.items) == 0 and after is None:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    return history_response
+    return _paginate(history_response, limit, response)
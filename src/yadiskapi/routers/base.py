@@ -1,12 +1,23 @@
+import email.message
+import json
 from datetime import datetime
-from typing import Union
+from typing import Any, AsyncIterator, FrozenSet, List, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import ORJSONResponse
+import orjson
+from asyncpg.exceptions import DeadlockDetectedError
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from databases.core import Connection
+from pydantic import ValidationError
 
-from yadiskapi import schemas, crud
-from yadiskapi.database import get_db_conn
+from yadiskapi import schemas, crud, jobs
+from yadiskapi.cache import nodes_cache
+from yadiskapi.config import settings
+from yadiskapi.database import get_db_conn, get_read_db_conn, read_replicas
+from yadiskapi.group_commit import import_group_commit
+from yadiskapi.pool import PoolExhausted
+from yadiskapi.replicas import read_lsn
 
 
 router = APIRouter(
@@ -33,37 +44,283 @@ router = APIRouter(
         }
     },
 )
-async def delete_delete_id(id: str, date: datetime, db: Connection = Depends(get_db_conn)):
+async def delete_delete_id(id: str, date: datetime, response: Response, db: Connection = Depends(get_db_conn)):
     deleted = await crud.delete_item(db, id)
     if not deleted:
         raise HTTPException(status_code=404, detail="Item not found")
     else:
+        await read_replicas.remember_write(db, response)
         return schemas.OkResponse(message="Deleted successfully")
 
 
+@router.post(
+    '/delete:batch',
+    response_model=schemas.SystemItemDeleteBatchResponse,
+    status_code=200,
+    responses={
+        '200': {
+            'model': schemas.SystemItemDeleteBatchResponse,
+            'description': 'Результат удаления по каждому id.'
+        },
+        '400': {
+            'model': schemas.Error,
+            'description': 'Невалидная схема документа или входные данные не верны.'
+        }
+    },
+)
+async def post_delete_batch(
+    batch: schemas.SystemItemDeleteBatchRequest,
+    date: datetime,
+    response: Response,
+    db: Connection = Depends(get_db_conn)
+):
+    """Несколько /delete/{id} одной транзакцией с одним пересчетом папок"""
+    deleted = await crud.delete_items(db, batch.ids)
+    if deleted:
+        await read_replicas.remember_write(db, response)
+    return schemas.SystemItemDeleteBatchResponse(items=[
+        schemas.ItemDeleted(id=item_id) if item_id in deleted else schemas.NodeNotFound(id=item_id)
+        for item_id in batch.ids
+    ])
+
+
+def _is_json_content_type(content_type: Optional[str]) -> bool:
+    """Как в FastAPI: без заголовка или application/json, application/*+json"""
+    if not content_type:
+        return True
+    message = email.message.Message()
+    message['content-type'] = content_type
+    if message.get_content_maintype() != 'application':
+        return False
+    subtype = message.get_content_subtype()
+    return subtype == 'json' or subtype.endswith('+json')
+
+
+async def import_request_body(request: Request) -> schemas.ImportBatch:
+    """
+    Тело POST /imports: orjson и однопроходная проверка
+    (schemas.validate_import_request) вместо построения модели pydantic на
+    каждый элемент. Чтение тела повторяет FastAPI, так что ответы 400
+    совпадают с ответами для параметра-модели.
+    """
+    body = await request.body()
+    if not body:
+        raise RequestValidationError([{'loc': ('body',), 'msg': 'field required', 'type': 'value_error.missing'}])
+    data: Any = body
+    if _is_json_content_type(request.headers.get('content-type')):
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # json из stdlib мягче (NaN, большие числа) и дает те же ошибки, что FastAPI
+            try:
+                data = json.loads(body)
+            except json.JSONDecodeError as e:
+                raise RequestValidationError([{
+                    'type': 'json_invalid',
+                    'loc': ('body', e.pos),
+                    'msg': 'JSON decode error',
+                    'input': {},
+                    'ctx': {'error': e.msg},
+                }], body=e.doc)
+    if data is None:
+        raise RequestValidationError([{'loc': ('body',), 'msg': 'field required', 'type': 'value_error.missing'}])
+    try:
+        return schemas.validate_import_request(data)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [dict(error, loc=('body',) + error['loc']) for error in e.errors()], body=data
+        )
+
+
 @router.post(
     '/imports',
     response_model=None,
     status_code=200,
+    # тело разбирает import_request_body, схема для openapi прежняя
+    openapi_extra={
+        'requestBody': {
+            'content': {
+                'application/json': {'schema': {'$ref': '#/components/schemas/SystemItemImportRequest'}}
+            },
+            'required': True,
+        }
+    },
     responses={
         '200': {
             'model': schemas.OkResponse,
             'description': 'Вставка или обновление прошли успешно.'
         },
+        '202': {
+            'model': schemas.ImportJob,
+            'description': 'Импорт проверен и поставлен в очередь (Prefer: respond-async), '
+                           'статус по ссылке из заголовка Location.'
+        },
         '400': {
             'model': schemas.Error,
             'description': 'Невалидная схема документа или входные данные не верны.'
         }
     },
 )
-async def post_imports(request: schemas.SystemItemImportRequest, db: Connection = Depends(get_db_conn)):
+async def post_imports(
+    response: Response,
+    request: schemas.ImportBatch = Depends(import_request_body),
+    prefer: Optional[str] = Header(
+        None, description='respond-async - применить импорт в фоне (если включены IMPORT_JOBS_WORKERS).'
+    ),
+    db: Connection = Depends(get_db_conn)
+):
     update_date = request.updateDate
+    if settings.import_jobs_workers and _prefers_async(prefer):
+        row = await jobs.enqueue(db, request.items, update_date)
+        return ORJSONResponse(
+            status_code=202,
+            content=jobs.job_response(row).dict(),
+            headers={'Location': f"/imports/{row['id']}"},
+        )
     try:
-        await crud.bulk_create_items(db, request.items, update_date)
-        return schemas.OkResponse(message="Import was successful")
+        if import_group_commit.accepts(request.items):
+            await import_group_commit.submit(request.items, update_date)
+        else:
+            async with jobs.queue_turn(db, update_date):
+                await crud.bulk_create_items(db, request.items, update_date)
+    except PoolExhausted:
+        # группа не дождалась своего соединения
+        raise HTTPException(status_code=503, detail="Database is overloaded")
+    except DeadlockDetectedError:
+        # импорт верный, его можно повторить (ответ 503, см. main.py)
+        raise
     except Exception:
         # TODO: async logger needed to log this exception
         raise HTTPException(status_code=400, detail="Validation Failed")
+    await read_replicas.remember_write(db, response)
+    return schemas.OkResponse(message="Import was successful")
+
+
+def _prefers_async(prefer: Optional[str]) -> bool:
+    if not prefer:
+        return False
+    return any(token.split(';')[0].strip().lower() == 'respond-async' for token in prefer.split(','))
+
+
+@router.get(
+    '/imports/{job_id}',
+    response_model=schemas.ImportJob,
+    status_code=200,
+    responses={
+        '200': {
+            'model': schemas.ImportJob,
+            'description': 'Статус задачи асинхронного импорта.'
+        },
+        '404': {
+            'model': schemas.Error,
+            'description': 'Задача не найдена.'
+        }
+    },
+)
+async def get_imports_job_id(job_id: int, db: Connection = Depends(get_db_conn)):
+    row = await jobs.get_job(db, job_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return jobs.job_response(row)
+
+
+def _parse_ndjson_item(line: bytes, index: int) -> schemas.ImportItem:
+    """Элемент из строки NDJSON, ошибки в формате 400 от /imports с номером элемента в loc"""
+    try:
+        data = orjson.loads(line)
+    except orjson.JSONDecodeError as e:
+        raise RequestValidationError([{
+            'type': 'json_invalid',
+            'loc': ('body', index),
+            'msg': 'JSON decode error',
+            'input': {},
+            'ctx': {'error': str(e)},
+        }])
+    try:
+        return schemas.validate_import_item(data)
+    except ValidationError as e:
+        raise RequestValidationError([dict(error, loc=('body', index) + error['loc']) for error in e.errors()])
+
+
+async def _ndjson_import_chunks(request: Request) -> AsyncIterator[List[schemas.ImportItem]]:
+    """
+    Элементы из тела NDJSON (JSON-объект на строку, пустые строки пропускаются)
+    кусками по settings.import_stream_chunk_size по мере того, как приходит тело.
+    """
+    chunk: List[schemas.ImportItem] = []
+    index = 0
+    tail = b''
+    async for data in request.stream():
+        lines = (tail + data).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            chunk.append(_parse_ndjson_item(line, index))
+            index += 1
+            if len(chunk) >= settings.import_stream_chunk_size:
+                yield chunk
+                chunk = []
+    if tail.strip():
+        chunk.append(_parse_ndjson_item(tail, index))
+    if chunk:
+        yield chunk
+
+
+@router.post(
+    '/imports/stream',
+    response_model=None,
+    status_code=200,
+    openapi_extra={
+        'requestBody': {
+            'description': 'Элементы импорта в формате NDJSON: по одному SystemItemImport на строку.',
+            'content': {
+                'application/x-ndjson': {'schema': {'$ref': '#/components/schemas/SystemItemImport'}}
+            },
+            'required': True,
+        }
+    },
+    responses={
+        '200': {
+            'model': schemas.OkResponse,
+            'description': 'Вставка или обновление прошли успешно.'
+        },
+        '400': {
+            'model': schemas.Error,
+            'description': 'Невалидная схема документа или входные данные не верны.'
+        }
+    },
+)
+async def post_imports_stream(
+    request: Request,
+    response: Response,
+    update_date: datetime = Header(
+        ..., alias='Update-Date', description='Время обновления добавляемых элементов (updateDate в /imports).'
+    ),
+    db: Connection = Depends(get_db_conn)
+):
+    """
+    То же, что /imports, для батчей, которые не стоит держать в памяти целиком:
+    элементы пишутся в БД кусками по мере прихода тела, все одной транзакцией.
+    """
+    try:
+        async with jobs.queue_turn(db, update_date):
+            await crud.stream_create_items(db, _ndjson_import_chunks(request), update_date)
+    except (RequestValidationError, DeadlockDetectedError):
+        raise
+    except ValueError as e:
+        # правила на весь поток (уникальность id, родитель-файл, циклы)
+        raise RequestValidationError([{'loc': ('body',), 'msg': str(e), 'type': 'value_error'}])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Validation Failed")
+    await read_replicas.remember_write(db, response)
+    return schemas.OkResponse(message="Import was successful")
+
+
+DEPTH_QUERY = Query(
+    None, ge=0,
+    description='Глубина дерева (0 - только сам элемент), у папок на последнем уровне children равно null.'
+)
 
 
 @router.get(
@@ -86,9 +343,86 @@ async def post_imports(request: schemas.SystemItemImportRequest, db: Connection
     },
 )
 async def get_nodes_id(
-    id: str, db: Connection = Depends(get_db_conn)
-) -> Union[schemas.SystemItem, schemas.Error]:
-    item = await crud.get_item(db, id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+    id: str,
+    request: Request,
+    depth: Optional[int] = DEPTH_QUERY,
+    fields: Optional[str] = Query(
+        None, description='Поля узлов через запятую, например id,size. Поле children выводится всегда.'
+    ),
+    db: Connection = Depends(get_read_db_conn)
+) -> Union[schemas.SystemItem, schemas.Error, Response]:
+    # response_model остается ради схемы openapi, а тело ответа (уже в формате
+    # schemas.SystemItem) собирает crud.get_item_json без pydantic
+    field_set = _parse_fields(fields)
+    # кэшируются только полные ответы и только с основной базы: реплика может отставать
+    cacheable = nodes_cache.enabled and depth is None and field_set is None
+    cacheable_read = cacheable and request.state.db_replica is None
+    body = nodes_cache.get(id) if cacheable else None
+    if body is None:
+        generation = nodes_cache.generation
+        try:
+            body = await crud.get_item_json(
+                db, id, max_rows=settings.nodes_stream_threshold_rows, depth=depth, fields=field_set
+            )
+        except crud.SubtreeTooLarge:
+            # огромные поддеревья не кэшируем и не собираем в памяти целиком
+            return StreamingResponse(
+                _stream_item_json(id, depth, field_set, read_lsn(request)), media_type=ORJSONResponse.media_type
+            )
+        if body is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        if cacheable_read:
+            nodes_cache.put(id, body, generation)
+    return Response(content=body, media_type=ORJSONResponse.media_type)
+
+
+@router.post(
+    '/nodes:batch',
+    response_model=schemas.SystemItemBatchResponse,
+    status_code=200,
+    responses={
+        '200': {
+            'model': schemas.SystemItemBatchResponse,
+            'description': 'Деревья элементов, для ненайденных - маркер с кодом 404.'
+        },
+        '400': {
+            'model': schemas.Error,
+            'description': 'Невалидная схема документа или входные данные не верны.'
+        },
+        '413': {
+            'model': schemas.Error,
+            'description': 'Поддеревья слишком большие: запросите меньше id, '
+                           'ограничьте depth или используйте /nodes/{id}.'
+        }
+    },
+)
+async def post_nodes_batch(
+    batch: schemas.SystemItemBatchRequest,
+    depth: Optional[int] = DEPTH_QUERY,
+    db: Connection = Depends(get_read_db_conn)
+) -> Union[schemas.SystemItemBatchResponse, schemas.Error, Response]:
+    """Несколько /nodes/{id} за один запрос: все поддеревья читаются одним запросом к БД"""
+    try:
+        body = await crud.get_items_json(db, batch.ids, max_rows=settings.nodes_stream_threshold_rows, depth=depth)
+    except crud.SubtreeTooLarge:
+        raise HTTPException(status_code=413, detail="Too many items")
+    return Response(content=body, media_type=ORJSONResponse.media_type)
+
+
+def _parse_fields(fields: Union[str, None]) -> Union[FrozenSet[str], None]:
+    if fields is None:
+        return None
+    field_set = frozenset(field.strip() for field in fields.split(','))
+    if not field_set <= set(crud.NODE_FIELDS) | {'children'}:
+        raise HTTPException(status_code=400, detail="Validation Failed")
+    return field_set
+
+
+async def _stream_item_json(
+    item_id: str, depth: Union[int, None], fields: Union[FrozenSet[str], None], min_lsn: Union[str, None]
+) -> AsyncIterator[bytes]:
+    # соединение из Depends(get_read_db_conn) освобождается до отправки ответа,
+    # поэтому поток берет свое
+    async with read_replicas.connection(min_lsn) as (db, _):
+        async for chunk in crud.iter_item_json(db, item_id, depth=depth, fields=fields):
+            yield chunk
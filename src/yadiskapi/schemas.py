@@ -2,9 +2,12 @@ from __future__ import annotations
 
 from datetime import datetime
 from enum import Enum, unique
-from typing import Any, List, Optional, Dict
+from typing import Any, List, NamedTuple, Optional, Dict, Sequence, Union
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, ValidationError, validator
+from pydantic.datetime_parse import parse_datetime
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import DictError
 
 
 def datetime_from_isoformat_helper(iso_datetime: str) -> datetime:
@@ -15,6 +18,10 @@ def datetime_from_isoformat_helper(iso_datetime: str) -> datetime:
     return datetime.fromisoformat(iso_datetime)
 
 
+URL_MAX_LENGTH = 255
+BATCH_MAX_IDS = 1000
+
+
 @unique
 class SystemItemType(Enum):
     FILE = 'FILE'
@@ -24,7 +31,9 @@ class SystemItemType(Enum):
 class SystemItemBase(BaseModel):
     """Виртуальная модель только для наследования"""
     id: str = Field(..., description='Уникальный идентфикатор', example='элемент_1_4')
-    url: Optional[str] = Field(None, max_length=255, description='Ссылка на файл. Для папок поле равнно null.')
+    url: Optional[str] = Field(
+        None, max_length=URL_MAX_LENGTH, description='Ссылка на файл. Для папок поле равнно null.'
+    )
     parentId: Optional[str] = Field(None, description='id родительской папки', example='элемент_1_1')
     type: SystemItemType
 
@@ -165,6 +174,129 @@ class SystemItemImportRequest(BaseModel):
     #     return v
 
 
+class SystemItemImportRecord(NamedTuple):
+    """Элемент импорта после быстрой проверки: поля как у SystemItemImport, но без модели pydantic"""
+    id: str
+    url: Optional[str]
+    parentId: Optional[str]
+    type: str
+    size: Optional[int]
+
+
+ImportItem = Union[SystemItemImport, SystemItemImportRecord]
+
+
+class ImportBatch(NamedTuple):
+    """Проверенный импорт, те же атрибуты, что у SystemItemImportRequest"""
+    items: Sequence[ImportItem]
+    updateDate: datetime
+
+
+def validate_import_request(data: Any) -> ImportBatch:
+    """
+    Проверка уже разобранного JSON импорта. Каноничные данные (строки там, где
+    строки, int для size и т.д.) проверяются всеми правилами
+    SystemItemImportRequest за один проход по обычным dict. Все остальное -
+    приведение типов и любые ошибки - отдается самой модели, так что ошибки
+    (pydantic.ValidationError) и их порядок остаются прежними.
+    """
+    batch = _validate_import_request_fast(data)
+    if batch is None:
+        try:
+            request = SystemItemImportRequest.validate(data)
+        except DictError as e:
+            # так эту ошибку оборачивает поле-модель (тело запроса в FastAPI)
+            raise ValidationError([ErrorWrapper(e, loc=())], SystemItemImportRequest)
+        batch = ImportBatch(request.items, request.updateDate)
+    return batch
+
+
+def _validate_import_request_fast(data: Any) -> Optional[ImportBatch]:
+    """None, если данные не каноничные или нарушают хоть одно правило"""
+    if type(data) is not dict:
+        return None
+    items, update_date = data.get('items'), data.get('updateDate')
+    if type(items) is not list or type(update_date) is not str:
+        return None
+    try:
+        date = parse_datetime(update_date)
+    except (ValueError, OverflowError):
+        return None
+
+    records: List[ImportItem] = []
+    # тип каждого уже встреченного id: и проверка уникальности, и родители-файлы
+    types: Dict[str, str] = {}
+    # родители, которые встретятся в батче позже ребенка
+    forward_parents: List[str] = []
+    for item in items:
+        record = _import_record_fast(item)
+        if record is None or record.id in types:
+            return None
+        if record.parentId is not None:
+            parent_type = types.get(record.parentId)
+            if parent_type is None:
+                forward_parents.append(record.parentId)
+            elif parent_type == 'FILE':
+                return None
+        types[record.id] = record.type
+        records.append(record)
+
+    for parent_id in forward_parents:
+        if types.get(parent_id) == 'FILE':
+            return None
+    return ImportBatch(records, date)
+
+
+def validate_import_item(data: Any) -> ImportItem:
+    """
+    Проверка одного элемента импорта (потоковый импорт): типы полей и правила
+    SystemItemImportRequest, которые касаются только самого элемента. Ошибки -
+    pydantic.ValidationError с теми же сообщениями, что у модели батча.
+    """
+    record = _import_record_fast(data)
+    if record is not None:
+        return record
+    try:
+        item = SystemItemImport.validate(data)
+    except DictError as e:
+        raise ValidationError([ErrorWrapper(e, loc=())], SystemItemImport)
+    item_type: str = item.type  # type: ignore[assignment]  # use_enum_values: в модели строка
+    message = None
+    if item.id == item.parentId:
+        message = "Item {} can't be self-parent.".format(item.id)
+    elif item_type == 'FOLDER' and item.url is not None:
+        message = "url field for folder {} should be null.".format(item.id)
+    elif item_type == 'FOLDER' and item.size is not None:
+        message = "size field for folder {} should be null.".format(item.id)
+    if message is not None:
+        raise ValidationError([ErrorWrapper(ValueError(message), loc=())], SystemItemImport)
+    return item
+
+
+def _import_record_fast(item: Any) -> Optional[SystemItemImportRecord]:
+    """Запись из каноничного dict элемента, None - если нужна полная проверка моделью"""
+    if type(item) is not dict:
+        return None
+    item_id, url, parent_id, item_type, size = (
+        item.get('id'), item.get('url'), item.get('parentId'), item.get('type'), item.get('size')
+    )
+    if type(item_id) is not str:
+        return None
+    if item_type == 'FILE':
+        if url is not None and (type(url) is not str or len(url) > URL_MAX_LENGTH):
+            return None
+        if size is not None and (type(size) is not int or size <= 0):
+            return None
+    elif item_type == 'FOLDER':
+        if url is not None or size is not None:
+            return None
+    else:
+        return None
+    if parent_id is not None and (type(parent_id) is not str or parent_id == item_id):
+        return None
+    return SystemItemImportRecord(item_id, url, parent_id, item_type, size)
+
+
 class SystemItemHistoryUnit(SystemItemBase):
     size: Optional[int] = Field(0, ge=0, description='Целое число, для папки - это суммарный размер всех элеметов.')
     date: datetime = Field(..., description='Время последнего обновления элемента.')
@@ -188,6 +320,28 @@ class SystemItemHistoryResponse(BaseModel):
     )
 
 
+@unique
+class ImportJobStatus(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class ImportJob(BaseModel):
+    """Задача асинхронного импорта (POST /imports с Prefer: respond-async)"""
+    id: int
+    status: ImportJobStatus
+    updateDate: datetime = Field(..., description='updateDate импорта, задачи применяются в порядке этой даты.')
+    items: int = Field(..., description='Количество элементов в импорте.')
+    createdAt: datetime
+    startedAt: Optional[datetime] = None
+    finishedAt: Optional[datetime] = None
+    queueSeconds: Optional[float] = Field(None, description='Сколько задача ждала в очереди.')
+    applySeconds: Optional[float] = Field(None, description='Сколько задача применялась.')
+    error: Optional[str] = Field(None, description='Причина ошибки для статуса failed.')
+
+
 class Error(BaseModel):
     """Модель стандартного ответа с ошибкой"""
     code: int
@@ -203,3 +357,40 @@ class OkResponse(BaseModel):
     """Базовый ответ, когда всё хорошо"""
     code: int = 200
     message: str = "OK"
+
+
+class SystemItemBatchRequest(BaseModel):
+    """Тело POST /nodes:batch"""
+    ids: List[str] = Field(
+        ..., min_items=1, max_items=BATCH_MAX_IDS, description='id элементов, чьи поддеревья нужно вернуть.'
+    )
+
+
+class NodeNotFound(Error):
+    """Маркер ненайденного элемента в ответе POST /nodes:batch"""
+    id: str
+    code: int = 404
+    message: str = "Item not found"
+
+
+class SystemItemBatchResponse(BaseModel):
+    items: List[Union[SystemItem, NodeNotFound]] = Field(
+        ..., description='Деревья элементов в порядке запрошенных id, для ненайденных - маркер с кодом 404.'
+    )
+
+
+class SystemItemDeleteBatchRequest(BaseModel):
+    """Тело POST /delete:batch"""
+    ids: List[str] = Field(..., min_items=1, max_items=BATCH_MAX_IDS, description='id удаляемых элементов.')
+
+
+class ItemDeleted(OkResponse):
+    """Удаленный элемент в ответе POST /delete:batch"""
+    id: str
+    message: str = "Deleted successfully"
+
+
+class SystemItemDeleteBatchResponse(BaseModel):
+    items: List[Union[ItemDeleted, NodeNotFound]] = Field(
+        ..., description='Результат по каждому id в порядке запроса: 200 - удален, 404 - не найден.'
+    )
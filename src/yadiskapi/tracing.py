@@ -0,0 +1,198 @@
+"""
+Трассировка SQL: тонкая обертка над databases.Connection, которая замеряет
+каждый запрос, пишет медленные (и все при db_echo_flag) в лог без значений
+параметров и копит число запросов и время в БД за HTTP-запрос. Итог запроса
+middleware отдает в заголовке Server-Timing. Через нее же выборочно
+снимаются планы запросов (explain.py).
+"""
+import logging
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, AsyncGenerator, Dict, List, Union
+
+from databases.core import Connection, Transaction
+from databases.interfaces import Record
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from yadiskapi.config import settings
+from yadiskapi.explain import plan_sampler
+
+
+logger = logging.getLogger('yadiskapi.sql')
+
+
+class QueryStats:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+
+
+# статистика текущего HTTP-запроса, объект кладет QueryStatsMiddleware
+request_query_stats: ContextVar[Union[QueryStats, None]] = ContextVar('request_query_stats', default=None)
+
+
+def _redact(values: Any) -> Any:
+    """Вместо значений параметров в лог попадают только их типы (и длина списков)"""
+    if isinstance(values, dict):
+        return {key: _redact(value) for key, value in values.items()}
+    if isinstance(values, (list, tuple)):
+        return '<{}[{}]>'.format(type(values).__name__, len(values))
+    return '<{}>'.format(type(values).__name__)
+
+
+def _observe(query: Any, values: Any, seconds: float) -> None:
+    stats = request_query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += seconds
+    slow = settings.db_slow_query_ms and seconds * 1000 >= settings.db_slow_query_ms
+    if slow or settings.db_echo_flag:
+        text = ' '.join(str(query).split())
+        logger.log(
+            logging.WARNING if slow else logging.INFO, '%s%.1f ms: %s; params: %s',
+            'slow query ' if slow else '', seconds * 1000, text, _redact(values) if values is not None else None
+        )
+
+
+class _TracedRawConnection:
+    """Прокси к asyncpg-соединению (db.raw_connection) с замером основных методов"""
+
+    def __init__(self, raw: Any, connection: Connection) -> None:
+        self._raw = raw
+        self._connection = connection
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._raw, name)
+
+    async def _call(self, method: str, query: Any, args: Any, kwargs: Dict[str, Any]) -> Any:
+        if plan_sampler.should_sample(query):
+            await plan_sampler.capture(self._connection, query, lambda explain: self._raw.fetchval(explain, *args))
+        started = perf_counter()
+        try:
+            return await getattr(self._raw, method)(query, *args, **kwargs)
+        finally:
+            _observe(query, list(args) or None, perf_counter() - started)
+
+    async def fetch(self, query: str, *args: Any, **kwargs: Any) -> List[Any]:
+        return await self._call('fetch', query, args, kwargs)  # type: ignore[no-any-return]
+
+    async def fetchval(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._call('fetchval', query, args, kwargs)
+
+    async def execute(self, query: str, *args: Any, **kwargs: Any) -> str:
+        return await self._call('execute', query, args, kwargs)  # type: ignore[no-any-return]
+
+    async def copy_records_to_table(self, table_name: str, **kwargs: Any) -> str:
+        started = perf_counter()
+        try:
+            return await self._raw.copy_records_to_table(table_name, **kwargs)  # type: ignore[no-any-return]
+        finally:
+            _observe('COPY {}'.format(table_name), None, perf_counter() - started)
+
+
+class TracedConnection:
+    """
+    Обертка над databases.Connection с тем же интерфейсом, crud работает с ней
+    как с обычным Connection. Транзакции открываются на исходном соединении.
+    """
+
+    def __init__(self, connection: Connection) -> None:
+        self._connection = connection
+
+    async def __aenter__(self) -> 'TracedConnection':
+        await self._connection.__aenter__()
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self._connection.__aexit__(*args)
+
+    async def _call(self, method: str, query: Any, values: Any, **kwargs: Any) -> Any:
+        if plan_sampler.should_sample(query):
+            await plan_sampler.capture(
+                self._connection, query, lambda explain: self._connection.fetch_val(explain, values)
+            )
+        started = perf_counter()
+        try:
+            return await getattr(self._connection, method)(query, values, **kwargs)
+        finally:
+            _observe(query, values, perf_counter() - started)
+
+    async def fetch_all(self, query: Any, values: Any = None) -> List[Record]:
+        return await self._call('fetch_all', query, values)  # type: ignore[no-any-return]
+
+    async def fetch_one(self, query: Any, values: Any = None) -> Union[Record, None]:
+        return await self._call('fetch_one', query, values)  # type: ignore[no-any-return]
+
+    async def fetch_val(self, query: Any, values: Any = None, column: Any = 0) -> Any:
+        return await self._call('fetch_val', query, values, column=column)
+
+    async def execute(self, query: Any, values: Any = None) -> Any:
+        return await self._call('execute', query, values)
+
+    async def execute_many(self, query: Any, values: List[Dict[str, Any]]) -> None:
+        started = perf_counter()
+        try:
+            await self._connection.execute_many(query, values)
+        finally:
+            _observe(query, values, perf_counter() - started)
+
+    async def iterate(self, query: Any, values: Any = None) -> AsyncGenerator[Any, None]:
+        started = perf_counter()
+        try:
+            async for record in self._connection.iterate(query, values):
+                yield record
+        finally:
+            _observe(query, values, perf_counter() - started)
+
+    def transaction(self, *, force_rollback: bool = False, **kwargs: Any) -> Transaction:
+        return self._connection.transaction(force_rollback=force_rollback, **kwargs)
+
+    @property
+    def raw_connection(self) -> Any:
+        return _TracedRawConnection(self._connection.raw_connection, self._connection)
+
+
+class QueryStatsMiddleware:
+    """
+    Считает запросы к БД за HTTP-запрос и добавляет к ответу заголовок
+    Server-Timing: db;dur=<мс>;desc="<N> queries" (виден в devtools браузера).
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = request_query_stats.set(stats)
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing', 'db;dur={:.2f};desc="{} queries"'.format(
+                    stats.seconds * 1000, stats.count
+                ))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_query_stats.reset(token)
+            logger.debug('%s %s: %d queries, %.1f ms in db', scope['method'], scope['path'], stats.count,
+                         stats.seconds * 1000)
+
+
+def configure_sql_logging() -> None:
+    """При db_echo_flag все запросы пишутся в консоль на уровне INFO"""
+    if settings.db_echo_flag:
+        logger.setLevel(logging.INFO)
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+            logger.addHandler(handler)
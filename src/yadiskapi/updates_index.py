@@ -0,0 +1,165 @@
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+from databases.core import Connection
+from databases.interfaces import Record
+
+from yadiskapi import schemas
+from yadiskapi.config import settings
+
+
+# даты в Postgres хранятся с точностью до микросекунды
+RESOLUTION = timedelta(microseconds=1)
+
+Key = Tuple[datetime, str]
+
+
+class RecentUpdatesIndex:
+    """
+    Отсортированный по (date, id) индекс свежей истории файлов внутри процесса,
+    из которого отвечает /updates без сканирования items_history.
+
+    Индекс полностью покрывает историю файлов начиная с covered_from (None -
+    вся история): окно отсчитывается от самой новой даты импорта, поэтому при
+    новых импортах старые записи вытесняются, а covered_from сдвигается вперед.
+    Запросы, начинающиеся раньше covered_from, идут в SQL. Индекс наполняется
+    при старте приложения и после коммита импортов, удаления из него убираются
+    так же после коммита.
+    """
+
+    def __init__(self, window: timedelta, max_rows: int) -> None:
+        self.window = window
+        self.max_rows = max_rows
+        self.ready = False
+        self.covered_from: Union[datetime, None] = None
+        self._keys: List[Key] = []
+        self._units: Dict[Key, schemas.SystemItemHistoryUnit] = {}
+        self._dates_by_id: Dict[str, List[datetime]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rows > 0
+
+    def reset(self) -> None:
+        self.ready = False
+        self.covered_from = None
+        self._keys = []
+        self._units = {}
+        self._dates_by_id = {}
+
+    async def warm_up(self, db: Connection) -> None:
+        """Загружает из БД историю файлов за окно от самой новой даты"""
+        self.reset()
+        if not self.enabled:
+            return
+        newest = await db.fetch_val(query="SELECT MAX(date) FROM items_history WHERE type = 'FILE';")
+        if newest is not None:
+            self.covered_from = newest - self.window
+            # самые новые max_rows + 1 строк: лишняя строка сдвинет covered_from в _trim()
+            query = """
+                SELECT id, url, "parentId", type, size, date
+                    FROM items_history
+                        WHERE date >= :date_from AND type = 'FILE'
+                        ORDER BY date DESC, id DESC
+                        LIMIT :limit;
+            """
+            values = {'date_from': self.covered_from, 'limit': self.max_rows + 1}
+            self._add(await db.fetch_all(query=query, values=values))
+        self.ready = True
+
+    def accepts(self, date: datetime) -> bool:
+        """Попадают ли в индекс записи истории с такой датой"""
+        return self.enabled and self.ready and (self.covered_from is None or date >= self.covered_from)
+
+    def add(self, rows: Iterable[Record]) -> None:
+        if self.enabled and self.ready:
+            self._add(rows)
+
+    def discard(self, item_ids: Iterable[str]) -> None:
+        """Убирает всю историю удаленных элементов"""
+        removed = []
+        for item_id in item_ids:
+            for date in self._dates_by_id.pop(item_id, ()):
+                del self._units[(date, item_id)]
+                removed.append((date, item_id))
+        if len(removed) > 32:
+            self._keys = [key for key in self._keys if key in self._units]
+        else:
+            for key in removed:
+                del self._keys[bisect_left(self._keys, key)]
+
+    def evict_before(self, moment: datetime) -> None:
+        """Забывает все записи раньше moment, они больше не покрываются индексом"""
+        if self.covered_from is not None and moment <= self.covered_from:
+            return
+        self.covered_from = moment
+        border = bisect_left(self._keys, (moment,))
+        for date, item_id in self._keys[:border]:
+            del self._units[(date, item_id)]
+            dates = self._dates_by_id[item_id]
+            dates.remove(date)
+            if not dates:
+                del self._dates_by_id[item_id]
+        del self._keys[:border]
+
+    def query(
+        self, date_start: datetime, date_end: datetime, limit: Union[int, None] = None,
+        after: Union[Key, None] = None
+    ) -> Union[List[schemas.SystemItemHistoryUnit], None]:
+        """
+        История файлов c date_start <= date <= date_end в порядке (date, id)
+        или None, если интервал не покрывается индексом и нужен запрос в БД.
+        """
+        dates = [date_start, date_end] + ([after[0]] if after is not None else [])
+        if not self.enabled or not self.ready or any(date.tzinfo is None for date in dates) or (
+            self.covered_from is not None and date_start < self.covered_from
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        start = bisect_left(self._keys, (date_start,))
+        if after is not None:
+            start = max(start, bisect_right(self._keys, after))
+        end = bisect_left(self._keys, (date_end + RESOLUTION,))
+        if limit is not None:
+            end = min(end, start + limit)
+        return [self._units[key] for key in self._keys[start:end]]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rows': len(self._keys),
+            'max_rows': self.max_rows,
+            'covered_from': self.covered_from.isoformat() if self.covered_from else None,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _add(self, rows: Iterable[Record]) -> None:
+        for row in rows:
+            unit = schemas.SystemItemHistoryUnit(**dict(row))
+            key = (unit.date, unit.id)
+            if self.covered_from is not None and unit.date < self.covered_from:
+                continue
+            if key not in self._units:
+                # импорты идут по времени, так что вставка почти всегда в конец
+                insort(self._keys, key)
+                self._dates_by_id.setdefault(unit.id, []).append(unit.date)
+            self._units[key] = unit
+        self._trim()
+
+    def _trim(self) -> None:
+        if not self._keys:
+            return
+        self.evict_before(self._keys[-1][0] - self.window)
+        if len(self._keys) > self.max_rows:
+            # вытесняем самую старую дату целиком, иначе она покрывалась бы частично
+            self.evict_before(self._keys[len(self._keys) - self.max_rows - 1][0] + RESOLUTION)
+
+
+recent_updates = RecentUpdatesIndex(
+    timedelta(hours=settings.updates_index_window_hours), settings.updates_index_max_rows
+)
@@ -1,4 +1,4 @@
-from typing import Dict, Union, Any
+from typing import Dict, Iterator, List, Tuple, Union, Any
 from datetime import datetime, timedelta
 from random import randint
 from uuid import uuid4
@@ -54,3 +54,50 @@ def _give_2_folder_tree_import_batch(files_num: int = 1):
     for _ in range(files_num):
         batch['items'].append(_give_item_import(type='FILE', parent_id=second_id))
     return batch
+
+
+def _give_tree_import_batches(
+    total: int,
+    *,
+    depth: int = 3,
+    fan_out: int = 10,
+    batch_size: int = 1000,
+    added_timedelta: Union[timedelta, None] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Хелпер для нагрузочных тестов и бенчмарков: дерево до total элементов под
+    одной корневой папкой, у каждой папки fan_out детей, папки до уровня depth
+    (корень - уровень 0), на уровне depth - файлы. Дерево строится обходом в
+    глубину, пока не наберется total элементов (или дерево не кончится), и отдается батчами по
+    batch_size в порядке обхода (родитель всегда в том же или более раннем
+    батче). Даты батчей идут по возрастанию с шагом в секунду.
+    """
+    if added_timedelta is None:
+        added_timedelta = timedelta()
+    root = _give_item_import(type='FOLDER')
+    items = [root]
+    batch_num = 0
+    # стек (id папки, ее уровень, сколько детей еще создать)
+    stack: List[Tuple[str, int, int]] = [(root['id'], 0, fan_out)]
+    produced = 1
+    while stack and produced < total:
+        parent_id, level, left = stack.pop()
+        if left == 0:
+            continue
+        stack.append((parent_id, level, left - 1))
+        item = _give_item_import(type='FOLDER' if level + 1 < depth else 'FILE', parent_id=parent_id)
+        items.append(item)
+        produced += 1
+        if item['type'] == 'FOLDER':
+            stack.append((item['id'], level + 1, fan_out))
+        if len(items) == batch_size:
+            yield _tree_batch(items, added_timedelta + timedelta(seconds=batch_num))
+            items, batch_num = [], batch_num + 1
+    if items:
+        yield _tree_batch(items, added_timedelta + timedelta(seconds=batch_num))
+
+
+def _tree_batch(items: List[Dict[str, Any]], added_timedelta: timedelta) -> Dict[str, Any]:
+    batch = _give_item_import_batch(0, added_timedelta=added_timedelta)
+    batch['items'] = items
+    return batch
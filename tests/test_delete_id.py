@@ -57,3 +57,31 @@ async def test_delete_date_in_query_required(async_client):
 
     response = await async_client.get(f"/nodes/{item_id}")
     assert response.status_code in range(200, 300), "Item should be available since deletion failed."
+
+
+@pytest.mark.asyncio
+async def test_delete_batch(async_client):
+    """POST /delete:batch удаляет элементы с поддеревьями и пересчитывает папки над ними."""
+    # /fld1/fld2/file1,file2 и отдельный файл
+    batch = _give_2_folder_tree_import_batch(files_num=2)
+    await async_client.post("/imports", json=batch)
+    root_id, folder_id, file1_id, file2_id = [item['id'] for item in batch['items']]
+    single = _give_item_import_batch(size=5)
+    single_id = single['items'][0]['id']
+    await async_client.post("/imports", json=single)
+
+    ids = [file1_id, single_id, 'нет такого', folder_id]
+    response = await async_client.post("/delete:batch", json={'ids': ids}, params=TEST_DATE_QS)
+    assert response.status_code == 200
+    assert [(item['id'], item['code']) for item in response.json()['items']] == [
+        (file1_id, 200), (single_id, 200), ('нет такого', 404), (folder_id, 200)
+    ]
+    for item_id in (folder_id, file1_id, file2_id, single_id):
+        assert (await async_client.get(f"/nodes/{item_id}")).status_code == 404
+    root = (await async_client.get(f"/nodes/{root_id}")).json()
+    assert root['children'] == [] and root['size'] == 0
+
+    response = await async_client.post("/delete:batch", json={'ids': [single_id]}, params=TEST_DATE_QS)
+    assert response.json()['items'] == [{'code': 404, 'message': 'Item not found', 'id': single_id}]
+    response = await async_client.post("/delete:batch", json={'ids': [root_id]})
+    assert response.status_code == 400
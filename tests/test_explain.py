@@ -0,0 +1,33 @@
+import pytest
+
+from yadiskapi.config import settings
+from yadiskapi.explain import plan_sampler
+
+from . import _give_2_folder_tree_import_batch
+
+
+@pytest.mark.asyncio
+async def test_explain_sampling_does_not_change_data(async_client, monkeypatch):
+    """Планы снимаются в откатываемом savepoint: импорт с EXPLAIN ANALYZE каждого запроса дает те же данные."""
+    monkeypatch.setattr(plan_sampler, 'sample_rate', 1.0)
+    batch = _give_2_folder_tree_import_batch(files_num=2)
+    root_id = batch['items'][0]['id']
+    response = await async_client.post("/imports", json=batch)
+    assert response.status_code == 200
+
+    response = await async_client.get(f"/nodes/{root_id}")
+    assert response.json()['size'] == sum(item['size'] or 0 for item in batch['items'])
+    response = await async_client.get(f"/node/{batch['items'][2]['id']}/history")
+    assert len(response.json()['items']) == 1
+    monkeypatch.setattr(plan_sampler, 'sample_rate', 0.0)
+
+    response = await async_client.get("/admin/explain", params={'limit': 100})
+    assert response.status_code == 200
+    plans = response.json()['plans']
+    assert any(plan['query'].startswith('UPDATE items') for plan in plans)  # пересчет папок
+    assert all(plan['plan']['Node Type'] for plan in plans)
+    assert response.json()['stats']['failed'] == 0
+
+    monkeypatch.setattr(settings, 'admin_token', 'secret')
+    assert (await async_client.get("/admin/explain")).status_code == 403
+    assert (await async_client.get("/admin/explain", headers={'X-Admin-Token': 'secret'})).status_code == 200
@@ -1,10 +1,17 @@
+import asyncio
 from datetime import timedelta
 
+import orjson
 import pytest
+from asyncpg.exceptions import DeadlockDetectedError
 
+from yadiskapi import crud, jobs, schemas
+from yadiskapi.config import settings
+from yadiskapi.database import database
+from yadiskapi.group_commit import import_group_commit
 from yadiskapi.schemas import datetime_from_isoformat_helper
 
-from . import _give_item_import, _give_item_import_batch
+from . import _give_2_folder_tree_import_batch, _give_item_import, _give_item_import_batch, _give_tree_import_batches
 
 
 @pytest.mark.asyncio
@@ -232,3 +239,315 @@ async def test_import_item_size_int64_max(async_client):
     response = await async_client.get(f"/nodes/{item_id}")
     assert response.status_code in range(200, 300)
     assert response.json()['size'] == max_filesize
+
+
+@pytest.mark.asyncio
+async def test_import_move_folder_with_subtree(async_client):
+    """Папка переносится к новому родителю вместе со всем поддеревом."""
+    # /fld1/fld2/file1 и отдельная /fld3
+    batch = _give_2_folder_tree_import_batch(files_num=1)
+    root_id, second_item, file_id = batch['items'][0]['id'], batch['items'][1], batch['items'][2]['id']
+    batch['items'].append(_give_item_import(type='FOLDER'))
+    new_root_id = batch['items'][3]['id']
+    response = await async_client.post("/imports", json=batch)
+    assert response.status_code in range(200, 300)
+
+    second_item['parentId'] = new_root_id  # /fld3/fld2/file1
+    response = await async_client.post("/imports", json={'items': [second_item], 'updateDate': batch['updateDate']})
+    assert response.status_code in range(200, 300)
+
+    response = await async_client.get(f"/nodes/{root_id}")
+    assert response.json()['children'] == []
+    response = await async_client.get(f"/nodes/{new_root_id}")
+    assert response.json()['children'][0]['children'][0]['id'] == file_id
+    assert response.json()['size'] == batch['items'][2]['size']
+
+
+@pytest.mark.asyncio
+async def test_import_no_parent_cycle(async_client):
+    """Папка не может оказаться внутри самой себя."""
+    batch = _give_2_folder_tree_import_batch(files_num=0)
+    root_item, second_id = batch['items'][0], batch['items'][1]['id']
+    response = await async_client.post("/imports", json=batch)
+    assert response.status_code in range(200, 300)
+
+    root_item['parentId'] = second_id
+    response = await async_client.post("/imports", json={'items': [root_item], 'updateDate': batch['updateDate']})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_import_large_batch_copy_update(async_client):
+    """Большой батч (импорт через COPY) вставляет и повторно обновляет элементы, размер папки считается."""
+    batch = _give_2_folder_tree_import_batch(files_num=1200)
+    root_id = batch['items'][0]['id']
+    response = await async_client.post("/imports", json=batch)
+    assert response.status_code in range(200, 300)
+
+    for item in batch['items'][2:]:
+        item['size'] += 1
+    response = await async_client.post("/imports", json=batch)
+    assert response.status_code in range(200, 300)
+
+    response = await async_client.get(f"/nodes/{root_id}")
+    assert response.json()['size'] == sum(item['size'] for item in batch['items'][2:])
+
+
+@pytest.mark.asyncio
+async def test_import_deep_tree_in_batches(async_client):
+    """Глубокое дерево, импортированное несколькими батчами: размер корня равен сумме всех файлов."""
+    batches = list(_give_tree_import_batches(300, depth=40, fan_out=2, batch_size=70))
+    assert len(batches) > 1
+    for batch in batches:
+        response = await async_client.post("/imports", json=batch)
+        assert response.status_code == 200
+
+    root_id = batches[0]['items'][0]['id']
+    files_size = sum(item['size'] for batch in batches for item in batch['items'] if item['type'] == 'FILE')
+    response = await async_client.get(f"/nodes/{root_id}", params={'fields': 'size', 'depth': 0})
+    assert response.json()['size'] == files_size
+    assert response.json()['size'] > 0
+
+
+@pytest.mark.asyncio
+async def test_import_validation_errors_match_model(async_client):
+    """Однопроходная проверка импорта отдает те же ошибки 400, что и модель SystemItemImportRequest."""
+    batch = _give_2_folder_tree_import_batch(files_num=2)
+    file_item = batch['items'][2]
+    cases = [
+        (dict(file_item), [], "ID of imported elements should be unique."),
+        (dict(_give_item_import(type='FILE'), parentId=file_item['id']), [], "can't be file."),
+        (dict(_give_item_import(type='FOLDER'), url='/folder'), [], "url field for folder"),
+        (dict(_give_item_import(type='FILE'), size=0), [len(batch['items']), 'size'], "greater than 0"),
+    ]
+    for bad_item, loc, message in cases:
+        response = await async_client.post(
+            "/imports", json={'items': batch['items'] + [bad_item], 'updateDate': batch['updateDate']}
+        )
+        assert response.status_code == 400
+        error = response.json()['detail'][0]
+        assert error['loc'] == ['body', 'items'] + loc
+        assert message in error['msg']
+
+    response = await async_client.post("/imports", content=b'{"items": [', headers={'content-type': 'application/json'})
+    assert response.status_code == 400
+    assert response.json()['detail'][0]['type'] == 'json_invalid'
+
+    # ребенок раньше родителя в батче и приводимые моделью типы (int id) проходят
+    batch['items'].reverse()
+    batch['items'].append(dict(_give_item_import(type='FILE'), id=42))
+    response = await async_client.post("/imports", json=batch)
+    assert response.status_code == 200
+    response = await async_client.get("/nodes/42")
+    assert response.status_code == 200
+
+
+def _ndjson(items):
+    return b''.join(orjson.dumps(item) + b'\n' for item in items)
+
+
+async def _in_pieces(body, size=100):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+@pytest.mark.asyncio
+async def test_import_stream(async_client, monkeypatch):
+    """Потоковый NDJSON-импорт кусками: дети раньше родителей, проверки на весь поток."""
+    monkeypatch.setattr(settings, 'import_stream_chunk_size', 7)
+    batch = next(_give_tree_import_batches(60, depth=3, fan_out=4))
+    items = list(reversed(batch['items']))
+    headers = {'Update-Date': batch['updateDate'], 'content-type': 'application/x-ndjson'}
+
+    response = await async_client.post("/imports/stream", content=_in_pieces(_ndjson(items)), headers=headers)
+    assert response.status_code == 200
+    root_id = batch['items'][0]['id']
+    response = await async_client.get(f"/nodes/{root_id}", params={'fields': 'size', 'depth': 0})
+    assert response.json()['size'] == sum(item['size'] for item in items if item['type'] == 'FILE')
+    response = await async_client.get("/updates", params={'date': batch['updateDate']})
+    assert len(response.json()['items']) == sum(1 for item in items if item['type'] == 'FILE')
+
+    # переезд существующей папки (ее потомков в потоке нет) в новую папку, описанную позже
+    moved, new_folder = dict(batch['items'][1]), _give_item_import(type='FOLDER')
+    moved['parentId'] = new_folder['id']
+    response = await async_client.get(f"/nodes/{moved['id']}")
+    moved_size = response.json()['size']
+    moved_children = {child['id'] for child in response.json()['children']}
+    response = await async_client.post("/imports/stream", content=_ndjson([moved, new_folder]), headers=headers)
+    assert response.status_code == 200
+    response = await async_client.get(f"/nodes/{new_folder['id']}")
+    assert response.json()['size'] == moved_size
+    assert {child['id'] for child in response.json()['children'][0]['children']} == moved_children
+    response = await async_client.get(f"/nodes/{root_id}", params={'fields': 'size', 'depth': 0})
+    assert response.json()['size'] == sum(item['size'] for item in items if item['type'] == 'FILE') - moved_size
+
+    # повтор id в разных кусках и файл-родитель из другого куска
+    file_item = next(item for item in items if item['type'] == 'FILE')
+    for bad_items, message in [
+        (items + [file_item], 'should be unique'),
+        (items + [_give_item_import(type='FILE', parent_id=file_item['id'])], "can't be file"),
+    ]:
+        response = await async_client.post("/imports/stream", content=_ndjson(bad_items), headers=headers)
+        assert response.status_code == 400
+        assert message in response.json()['detail'][0]['msg']
+
+    response = await async_client.post(
+        "/imports/stream", content=_ndjson(items[:3]) + b'{"id": \n', headers=headers
+    )
+    assert response.status_code == 400
+    assert response.json()['detail'][0]['loc'] == ['body', 3]
+
+    response = await async_client.post("/imports/stream", content=_ndjson(items), headers={})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_import_jobs(async_client, monkeypatch):
+    """Асинхронный импорт: 202 и задача в очереди, синхронный импорт сначала применяет более ранние задачи."""
+    # воркеры при старте приложения не запущены, очередь разбирается явно
+    monkeypatch.setattr(settings, 'import_jobs_workers', 1)
+    prefer = {'Prefer': 'respond-async'}
+    batch = _give_item_import_batch(1, type='FOLDER')
+    folder_id = batch['items'][0]['id']
+
+    response = await async_client.post("/imports", json=batch, headers=prefer)
+    assert response.status_code == 202
+    job = response.json()
+    assert response.headers['Location'] == f"/imports/{job['id']}"
+    assert job['status'] == 'queued' and job['items'] == 1
+    response = await async_client.get(response.headers['Location'])
+    assert response.json()['status'] == 'queued'
+    response = await async_client.get(f"/nodes/{folder_id}")
+    assert response.status_code == 404
+
+    # файл в папку из очереди с более поздней датой: задача применяется раньше него
+    later = _give_item_import_batch(1, type='FILE', parent_id=folder_id, added_timedelta=timedelta(seconds=1))
+    response = await async_client.post("/imports", json=later)
+    assert response.status_code == 200
+    response = await async_client.get(f"/imports/{job['id']}")
+    assert response.json()['status'] == 'done'
+    assert response.json()['queueSeconds'] >= 0 and response.json()['applySeconds'] >= 0
+    response = await async_client.get(f"/nodes/{folder_id}")
+    assert response.json()['size'] == later['items'][0]['size']
+
+    # ошибка применения видна в статусе задачи
+    broken = _give_item_import_batch(1, type='FILE', parent_id='no-such-folder', added_timedelta=timedelta(seconds=2))
+    response = await async_client.post("/imports", json=broken, headers=prefer)
+    assert response.status_code == 202
+    async with database.connection() as db:
+        assert await jobs.apply_pending(db) == [response.json()['id']]
+    response = await async_client.get(response.headers['Location'])
+    assert response.json()['status'] == 'failed' and response.json()['error']
+
+    response = await async_client.get("/imports/0")
+    assert response.status_code == 404
+
+    # без воркеров заголовок Prefer игнорируется
+    monkeypatch.setattr(settings, 'import_jobs_workers', 0)
+    response = await async_client.post("/imports", json=_give_item_import_batch(1), headers=prefer)
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_import_group_commit(async_client, monkeypatch):
+    """Параллельные мелкие импорты применяются одной группой, ошибка одного не мешает остальным."""
+    monkeypatch.setattr(import_group_commit, 'window', 0.05)
+    folder = _give_item_import_batch(1, type='FOLDER')
+    folder_id = folder['items'][0]['id']
+    response = await async_client.post("/imports", json=folder)
+    assert response.status_code == 200
+    groups = import_group_commit.groups
+
+    first = _give_item_import_batch(2, type='FILE', parent_id=folder_id, added_timedelta=timedelta(seconds=1))
+    broken = _give_item_import_batch(1, type='FILE', parent_id='no-such-folder')
+    # папка и файл в ней из разных импортов одной группы
+    subfolder = _give_item_import_batch(1, type='FOLDER', parent_id=folder_id, added_timedelta=timedelta(seconds=2))
+    nested = _give_item_import_batch(
+        1, type='FILE', parent_id=subfolder['items'][0]['id'], added_timedelta=timedelta(seconds=3)
+    )
+    responses = await asyncio.gather(*(
+        async_client.post("/imports", json=batch) for batch in (first, broken, subfolder, nested)
+    ))
+    assert [response.status_code for response in responses] == [200, 400, 200, 200]
+    assert import_group_commit.groups == groups + 1
+
+    response = await async_client.get(f"/nodes/{folder_id}")
+    expected_size = sum(item['size'] for batch in (first, nested) for item in batch['items'])
+    assert response.json()['size'] == expected_size
+    assert response.json()['date'] == nested['updateDate'].replace('Z', '+00:00')
+    response = await async_client.get(f"/nodes/{broken['items'][0]['id']}")
+    assert response.status_code == 404
+    response = await async_client.get("/updates", params={'date': nested['updateDate']})
+    assert nested['items'][0]['id'] in {item['id'] for item in response.json()['items']}
+
+
+@pytest.mark.asyncio
+async def test_import_locks_affected_roots(async_client):
+    """Импорт берет advisory lock'и на корни всех затронутых деревьев, и старого, и нового."""
+    first, second = _give_2_folder_tree_import_batch(), _give_item_import_batch(1, type='FOLDER')
+    for batch in (first, second):
+        response = await async_client.post("/imports", json=batch)
+        assert response.status_code == 200
+    moved = dict(first['items'][1], parentId=second['items'][0]['id'])
+    query = """
+        SELECT COUNT(*) FROM pg_locks
+            WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND classid = :lock_class
+                AND objid = ANY(ARRAY(SELECT CAST(hashtext(root) AS oid) FROM unnest(CAST(:roots AS varchar[])) root));
+    """
+    async with database.connection() as db:
+        async with db.transaction(force_rollback=True):
+            item = schemas.SystemItemImportRecord(**moved)
+            await crud.bulk_create_items(db, [item], datetime_from_isoformat_helper(second['updateDate']))
+            roots = [first['items'][0]['id'], second['items'][0]['id']]
+            assert await db.fetch_val(query, {'lock_class': crud.ROOT_LOCK_CLASS, 'roots': roots}) == 2
+
+
+@pytest.mark.asyncio
+async def test_import_group_commit_survives_cancelled_caller(async_client, monkeypatch):
+    """Отмена первого импорта группы (обрыв клиента) не отменяет применение группы."""
+    monkeypatch.setattr(import_group_commit, 'window', 0.05)
+    first = schemas.validate_import_request(_give_item_import_batch(1, type='FOLDER'))
+    second = schemas.validate_import_request(_give_item_import_batch(1, type='FOLDER'))
+    leader = asyncio.ensure_future(import_group_commit.submit(first.items, first.updateDate))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(import_group_commit.submit(second.items, second.updateDate))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    await follower
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+    for batch in (first, second):
+        response = await async_client.get(f"/nodes/{batch.items[0].id}")
+        assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_import_retried_after_deadlock(async_client, monkeypatch):
+    """Импорт, прерванный deadlock'ом на lock'ах корней, повторяется, а если не вышло - ответ 503, а не 400."""
+    monkeypatch.setattr(import_group_commit, 'window', 0)
+    lock_roots = crud._items_lock_roots
+    # сколько еще раз взятие lock'ов закончится deadlock'ом
+    deadlocks = [crud.DEADLOCK_ATTEMPTS - 1]
+
+    async def deadlocked_lock_roots(*args, **kwargs):
+        if deadlocks[0]:
+            deadlocks[0] -= 1
+            raise DeadlockDetectedError('deadlock detected')
+        return await lock_roots(*args, **kwargs)
+
+    monkeypatch.setattr(crud, '_items_lock_roots', deadlocked_lock_roots)
+    batch = _give_item_import_batch(1, type='FOLDER')
+    response = await async_client.post("/imports", json=batch)
+    assert response.status_code == 200 and deadlocks[0] == 0
+    assert (await async_client.get(f"/nodes/{batch['items'][0]['id']}")).status_code == 200
+
+    deadlocks[0] = crud.DEADLOCK_ATTEMPTS
+    response = await async_client.post("/imports", json=_give_item_import_batch(1, type='FOLDER'))
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    # потоковый импорт не повторяется
+    deadlocks[0] = 1
+    response = await async_client.post(
+        "/imports/stream", content=orjson.dumps(_give_item_import(type='FOLDER')),
+        headers={'Update-Date': batch['updateDate']}
+    )
+    assert response.status_code == 503 and deadlocks[0] == 0
@@ -0,0 +1,25 @@
+import pytest
+
+from . import _give_2_folder_tree_import_batch
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(async_client):
+    """/metrics отдает гистограммы по шаблонам маршрутов и время операций crud в формате Prometheus."""
+    batch = _give_2_folder_tree_import_batch(files_num=2)
+    await async_client.post("/imports", json=batch)
+    await async_client.get("/nodes/{}".format(batch['items'][0]['id']))
+    await async_client.get("/nodes/not-existing-id")
+
+    response = await async_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    text = response.text
+    bucket = 'yadiskapi_http_request_duration_seconds_bucket{method="GET",route="/nodes/{id}",status="200",le="+Inf"}'
+    assert bucket in text
+    assert 'route="/nodes/{id}",status="404"' in text
+    assert 'not-existing-id' not in text
+    for operation in ('import_upsert', 'recount', 'subtree_fetch'):
+        assert 'yadiskapi_crud_duration_seconds_count{{operation="{}"}}'.format(operation) in text
+    assert '# TYPE yadiskapi_import_items histogram' in text
+    assert 'yadiskapi_db_pool_connections{state="in_use"}' in text
@@ -75,3 +75,25 @@ async def test_node_id_history_non_iso8601_date(async_client):
         }
     )
     assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_node_id_history_keyset_pagination(async_client):
+    """История элемента постранично: по одной записи, пока есть курсор."""
+    batch = _give_item_import_batch(1, type="FILE")
+    item = batch['items'][0]
+    await async_client.post("/imports", json=batch)
+    for seconds in (1, 2):
+        batch = _give_item_import_batch(0, added_timedelta=timedelta(seconds=seconds))
+        item['size'] += 1
+        batch['items'].append(item)
+        await async_client.post("/imports", json=batch)
+
+    sizes, params = [], {'limit': 1}
+    for _ in range(3):
+        response = await async_client.get("/node/{}/history".format(item['id']), params=params)
+        assert response.status_code in range(200, 300)
+        sizes += [unit['size'] for unit in response.json()['items']]
+        params['cursor'] = response.headers.get('x-next-cursor')
+    assert params['cursor'] is None, "No cursor after the last page"
+    assert sizes == [item['size'] - 2, item['size'] - 1, item['size']], "Pages go in date order"
@@ -0,0 +1,116 @@
+import asyncio
+
+import asyncpg
+import orjson
+import pytest
+
+from yadiskapi import crud
+from yadiskapi.cache import SubtreeCache, nodes_cache
+from yadiskapi.config import settings
+from yadiskapi.database import configure_database
+from yadiskapi.invalidation import CHANNEL, MAX_PAYLOAD_BYTES, change_listener, changes_payload, process_id
+
+from . import _give_2_folder_tree_import_batch, _give_item_import_batch
+
+
+@pytest.mark.asyncio
+async def test_nodes_cache_hit_and_ancestor_invalidation(async_client):
+    """Повторное чтение отдается из кэша, а изменение в глубине поддерева сбрасывает кэш предков."""
+    batch = _give_2_folder_tree_import_batch(files_num=1)
+    root_id, second_id = batch['items'][0]['id'], batch['items'][1]['id']
+    await async_client.post("/imports", json=batch)
+
+    first = await async_client.get(f"/nodes/{root_id}")
+    hits = nodes_cache.hits
+    second = await async_client.get(f"/nodes/{root_id}")
+    assert nodes_cache.hits == hits + 1
+    assert first.content == second.content
+
+    new_file = _give_item_import_batch(1, type='FILE', parent_id=second_id)
+    await async_client.post("/imports", json=new_file)
+    response = await async_client.get(f"/nodes/{root_id}")
+    assert response.json()['size'] == first.json()['size'] + new_file['items'][0]['size']
+
+    await async_client.delete(f"/delete/{second_id}", params={'date': batch['updateDate']})
+    response = await async_client.get(f"/nodes/{second_id}")
+    assert response.status_code == 404
+    response = await async_client.get(f"/nodes/{root_id}")
+    assert response.json()['size'] == 0
+
+
+def test_nodes_cache_lru_eviction_and_generation():
+    cache = SubtreeCache(max_bytes=3 * (SubtreeCache.ENTRY_OVERHEAD + 11))
+    for key in ('a', 'b', 'c'):
+        cache.put(key, b'x' * 10, cache.generation)
+    cache.get('a')  # 'b' становится самым старым
+    cache.put('d', b'x' * 10, cache.generation)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.evictions == 1
+
+    # ответ, прочитанный до инвалидации, в кэш не попадает
+    generation = cache.generation
+    cache.invalidate(['a'])
+    cache.put('a', b'stale', generation)
+    assert cache.get('a') is None
+
+
+async def _wait_for(condition) -> None:
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError('condition is not met in 5 seconds')
+
+
+@pytest.mark.asyncio
+async def test_nodes_cache_invalidated_by_other_process(async_client):
+    """NOTIFY записи из другого процесса сбрасывает кэш, после потери LISTEN-соединения кэш сбрасывается целиком."""
+    batch = _give_2_folder_tree_import_batch(files_num=1)
+    root_id, second_id = batch['items'][0]['id'], batch['items'][1]['id']
+    await async_client.post("/imports", json=batch)
+    await async_client.get(f"/nodes/{root_id}")
+    await async_client.get(f"/nodes/{second_id}")
+
+    other = await asyncpg.connect(settings.db_test_dsn.replace('+asyncpg', ''))
+    try:
+        notifications = change_listener.notifications
+        # свои уведомления процесс пропускает
+        own = orjson.dumps({'process': process_id(), 'ids': [root_id]}).decode()
+        await other.execute("SELECT pg_notify($1, $2);", CHANNEL, own)
+        foreign = orjson.dumps({'process': 'other', 'ids': [root_id]}).decode()
+        await other.execute("SELECT pg_notify($1, $2);", CHANNEL, foreign)
+        await _wait_for(lambda: change_listener.notifications == notifications + 1)
+        assert root_id not in nodes_cache._entries
+        assert second_id in nodes_cache._entries
+
+        reconnects = change_listener.reconnects
+        assert change_listener._connection is not None
+        await other.execute("SELECT pg_terminate_backend($1);", change_listener._connection.get_server_pid())
+        await _wait_for(lambda: change_listener.reconnects == reconnects + 1)
+        assert second_id not in nodes_cache._entries
+        assert change_listener.stats()['listening'] is True
+    finally:
+        await other.close()
+
+
+@pytest.mark.asyncio
+async def test_write_notifies_changed_ids_on_commit():
+    """Удаление шлет NOTIFY с удаленными id, слушатели получают его после коммита."""
+    received: 'asyncio.Queue[str]' = asyncio.Queue()
+    listener = await asyncpg.connect(settings.db_test_dsn.replace('+asyncpg', ''))
+    database = configure_database(my_force_rollback=False, dsn=settings.db_test_dsn)
+    await database.connect()
+    try:
+        await listener.add_listener(CHANNEL, lambda *args: received.put_nowait(args[-1]))
+        async with database.connection() as db:
+            assert await crud.delete_items(db, ['нет такого']) == set()
+        message = orjson.loads(await asyncio.wait_for(received.get(), 5))
+        assert message == {'process': process_id(), 'ids': []}
+    finally:
+        await database.disconnect()
+        await listener.close()
+
+    # слишком длинный список id заменяется сбросом всего кэша
+    ids = [str(number) for number in range(MAX_PAYLOAD_BYTES)]
+    assert orjson.loads(changes_payload(ids))['ids'] is None
@@ -1,6 +1,14 @@
+import orjson
 import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
 
-from . import _give_2_folder_tree_import_batch, _give_item_import_batch
+from yadiskapi import crud
+from yadiskapi.cache import nodes_cache
+from yadiskapi.config import settings
+from yadiskapi.database import database
+
+from . import _give_2_folder_tree_import_batch, _give_item_import, _give_item_import_batch
 
 
 @pytest.mark.asyncio
@@ -75,3 +83,137 @@ async def test_nodes_folder_size_change_on_file_size_change(async_client):
     assert file_size_initial != file_size_actual
     assert response.json()['size'] != file_size_initial
     assert response.json()['size'] == file_size_actual
+
+
+@pytest.mark.asyncio
+async def test_nodes_folder_size_change_on_file_move(async_client):
+    """При переносе файла в другую папку пересчитываются размеры и старой, и новой папки (и их предков)."""
+    # /fld1/fld2/file1 и отдельная /fld3
+    batch = _give_2_folder_tree_import_batch(files_num=1)
+    root_id, second_id, file_item = batch['items'][0]['id'], batch['items'][1]['id'], batch['items'][2]
+    batch['items'].append(_give_item_import(type='FOLDER'))
+    other_id = batch['items'][3]['id']
+    await async_client.post("/imports", json=batch)
+
+    file_item['parentId'] = other_id
+    await async_client.post("/imports", json={'items': [file_item], 'updateDate': batch['updateDate']})
+
+    for folder_id, expected_size in ((root_id, 0), (second_id, 0), (other_id, file_item['size'])):
+        response = await async_client.get("/nodes/{}".format(folder_id))
+        assert response.json()['size'] == expected_size
+
+
+@pytest.mark.asyncio
+async def test_nodes_folder_size_change_on_delete(async_client):
+    """При удалении файла размеры всех папок-предков уменьшаются."""
+    batch = _give_2_folder_tree_import_batch(files_num=2)
+    root_id, file_item = batch['items'][0]['id'], batch['items'][2]
+    await async_client.post("/imports", json=batch)
+
+    await async_client.delete("/delete/{}".format(file_item['id']), params={'date': batch['updateDate']})
+    response = await async_client.get("/nodes/{}".format(root_id))
+    assert response.json()['size'] == batch['items'][3]['size']
+
+
+@pytest.mark.asyncio
+async def test_nodes_fast_serialization_matches_pydantic(async_client):
+    """Ответ /nodes/{id} побайтно совпадает с сериализацией pydantic-модели SystemItem."""
+    batch = _give_2_folder_tree_import_batch(files_num=2)
+    batch['items'].append(_give_item_import(type='FOLDER', parent_id=batch['items'][0]['id']))  # пустая папка
+    batch['updateDate'] = batch['updateDate'][:-1] + '.123456Z'
+    root_id = batch['items'][0]['id']
+    await async_client.post("/imports", json=batch)
+
+    response = await async_client.get(f"/nodes/{root_id}")
+    async with database.connection() as db:
+        item = await crud.get_item(db, root_id)
+    assert response.content == ORJSONResponse(content=jsonable_encoder(item)).body
+
+
+def _sort_children(node):
+    if node['children']:
+        node['children'] = sorted((_sort_children(child) for child in node['children']), key=lambda n: n['id'])
+    return node
+
+
+@pytest.mark.asyncio
+async def test_nodes_large_subtree_streamed(async_client, monkeypatch):
+    """Поддерево больше порога отдается потоком, но с тем же содержимым, что и обычный ответ."""
+    batch = _give_2_folder_tree_import_batch(files_num=5)
+    batch['items'].append(_give_item_import(type='FOLDER', parent_id=batch['items'][0]['id']))  # пустая папка
+    root_id = batch['items'][0]['id']
+    await async_client.post("/imports", json=batch)
+    async with database.connection() as db:
+        expected = orjson.loads(await crud.get_item_json(db, root_id))
+
+    monkeypatch.setattr(settings, 'nodes_stream_threshold_rows', 3)
+    monkeypatch.setattr(nodes_cache, 'max_bytes', 0)
+    response = await async_client.get(f"/nodes/{root_id}")
+    assert response.status_code == 200
+    assert 'content-length' not in response.headers
+    assert _sort_children(response.json()) == _sort_children(expected)
+
+    # маленькие поддеревья и отсутствующие элементы отдаются как раньше
+    response = await async_client.get("/nodes/{}".format(batch['items'][2]['id']))
+    assert response.headers['content-length'] == str(len(response.content))
+    response = await async_client.get("/nodes/not-existing-id")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_nodes_depth_and_fields(async_client, monkeypatch):
+    """depth обрезает дерево (у папок на последнем уровне children равно null), fields оставляет только нужные поля."""
+    batch = _give_2_folder_tree_import_batch(files_num=2)
+    root_id, second_id = batch['items'][0]['id'], batch['items'][1]['id']
+    await async_client.post("/imports", json=batch)
+    full = (await async_client.get(f"/nodes/{root_id}")).json()
+
+    response = await async_client.get(f"/nodes/{root_id}", params={'depth': 0})
+    assert response.json() == dict(full, children=None)
+    response = await async_client.get(f"/nodes/{root_id}", params={'depth': 1})
+    assert response.json()['children'] == [dict(full['children'][0], children=None)]
+    response = await async_client.get(f"/nodes/{root_id}", params={'depth': 2})
+    assert _sort_children(response.json()) == _sort_children(full)
+
+    response = await async_client.get(f"/nodes/{root_id}", params={'fields': 'id,size', 'depth': 1})
+    assert response.json() == {
+        'id': root_id, 'size': full['size'], 'children': [{'id': second_id, 'size': full['size'], 'children': None}]
+    }
+    response = await async_client.get(f"/nodes/{root_id}", params={'fields': 'id,unknown'})
+    assert response.status_code == 400
+
+    # потоковая выдача поддерживает те же параметры
+    monkeypatch.setattr(settings, 'nodes_stream_threshold_rows', 1)
+    response = await async_client.get(f"/nodes/{root_id}", params={'fields': 'id,size', 'depth': 1})
+    assert 'content-length' not in response.headers
+    assert response.json()['children'] == [{'id': second_id, 'size': full['size'], 'children': None}]
+    response = await async_client.get(f"/nodes/{root_id}", params={'fields': 'children'})
+    assert response.json() == {'children': [{'children': [{'children': None}, {'children': None}]}]}
+
+
+@pytest.mark.asyncio
+async def test_nodes_batch(async_client, monkeypatch):
+    """POST /nodes:batch отдает те же деревья, что /nodes/{id}, в порядке id, для ненайденных - маркер 404."""
+    # /fld1/fld2/file1, поддерево fld2 вложено в поддерево fld1
+    batch = _give_2_folder_tree_import_batch(files_num=1)
+    await async_client.post("/imports", json=batch)
+    ids = [item['id'] for item in batch['items']]
+    requested = [ids[2], ids[0], 'нет такого', ids[1], ids[0]]
+
+    for params in ({}, {'depth': 0}, {'depth': 1}):
+        response = await async_client.post("/nodes:batch", json={'ids': requested}, params=params)
+        assert response.status_code == 200
+        items = response.json()['items']
+        assert len(items) == len(requested)
+        for item_id, item in zip(requested, items):
+            if item_id == 'нет такого':
+                assert item == {'id': item_id, 'code': 404, 'message': 'Item not found'}
+            else:
+                assert item == (await async_client.get(f"/nodes/{item_id}", params=params)).json()
+
+    response = await async_client.post("/nodes:batch", json={'ids': []})
+    assert response.status_code == 400
+
+    monkeypatch.setattr(settings, 'nodes_stream_threshold_rows', 2)
+    response = await async_client.post("/nodes:batch", json={'ids': [ids[0]]})
+    assert response.status_code == 413
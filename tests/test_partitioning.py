@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta, timezone
+
+from yadiskapi.partitioning import parse_partition_name, partition_bounds, partition_name
+
+
+def test_partition_bounds_month_and_day():
+    """Границы партиций истории считаются в UTC, в том числе на стыке лет."""
+    moment = datetime(2022, 12, 31, 23, 30, tzinfo=timezone(timedelta(hours=-3)))  # 2023-01-01T02:30 UTC
+    assert partition_bounds(moment, 'month') == (
+        datetime(2023, 1, 1, tzinfo=timezone.utc), datetime(2023, 2, 1, tzinfo=timezone.utc)
+    )
+    assert partition_bounds(datetime(2022, 12, 31, 12), 'month')[1] == datetime(2023, 1, 1, tzinfo=timezone.utc)
+    assert partition_bounds(moment, 'day') == (
+        datetime(2023, 1, 1, tzinfo=timezone.utc), datetime(2023, 1, 2, tzinfo=timezone.utc)
+    )
+
+
+def test_partition_name_roundtrip():
+    start, end = partition_bounds(datetime(2022, 5, 28, tzinfo=timezone.utc), 'month')
+    name = partition_name(start, end)
+    assert name == 'items_history_p20220501_20220601'
+    assert parse_partition_name(name) == (start, end)
+    assert parse_partition_name('items_history_default') is None
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from yadiskapi.database import database
+from yadiskapi.pool import PoolExhausted, PoolMonitor
+
+
+@pytest.mark.asyncio
+async def test_pool_stats_in_check(async_client):
+    """Статистика пула видна в /check, каждый запрос к API учитывается в гистограмме ожидания."""
+    stats = (await async_client.get("/check")).json()['db_pool']
+    response = await async_client.get("/check")
+    new_stats = response.json()['db_pool']
+    assert new_stats['acquire_seconds']['count'] == stats['acquire_seconds']['count'] + 1
+    assert new_stats['acquire_seconds']['buckets']['+Inf'] == new_stats['acquire_seconds']['count']
+    assert new_stats['in_use'] == 1 and new_stats['waiters'] == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_acquire_timeout_and_adaptive_growth(async_client):
+    """Ожидание соединения ограничено acquire_timeout, а адаптивный лимит растет при долгом ожидании."""
+    pool = PoolMonitor(database, min_size=1, max_size=3, acquire_timeout=0.05, adaptive=True, adaptive_interval=0)
+    async with pool.connection():
+        with pytest.raises(PoolExhausted):
+            async with pool.connection():
+                pass
+    assert pool.timeouts == 1 and pool.held == 0
+
+    pool.acquire_timeout = None
+    release = asyncio.Event()
+
+    async def hold():
+        async with pool.connection():
+            await release.wait()
+
+    first = asyncio.ensure_future(hold())
+    await asyncio.sleep(0.02)
+    second = asyncio.ensure_future(hold())  # ждет, пока первый не отдаст соединение
+    await asyncio.sleep(0.02)
+    assert pool.waiters == 1
+    release.set()
+    await asyncio.gather(first, second)
+    assert pool.limit > 1
@@ -0,0 +1,54 @@
+import asyncpg
+import pytest
+from asyncpg.exceptions import InvalidCachedStatementError
+
+from yadiskapi import crud
+from yadiskapi.config import settings
+from yadiskapi.database import configure_database
+from yadiskapi.prepared import PreparedConnection, statement_preparer
+
+
+@pytest.mark.asyncio
+async def test_hot_statements_prepared_on_connect(monkeypatch):
+    """Соединения пула готовят все горячие запросы crud и выполняют их и после возврата в пул."""
+    monkeypatch.setattr(settings, 'db_pool_min_size', 1)
+    monkeypatch.setattr(settings, 'db_pool_max_size', 1)
+    database = configure_database(my_force_rollback=False, dsn=settings.db_test_dsn)
+    await database.connect()
+    try:
+        for _ in range(2):
+            async with database.connection() as db:
+                assert set(db.raw_connection.hot_statements) == set(crud.HOT_QUERIES)
+                history = await crud.get_item_history(db, 'нет такого', None, None, limit=10)
+                assert history.items == []
+                assert await crud.get_item_json(db, 'нет такого', max_rows=10) is None
+    finally:
+        await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_changed_table_falls_back_to_plain_query():
+    """После изменения таблицы подготовленное выражение забывается, вне транзакции запрос повторяется."""
+    query = 'SELECT * FROM prepared_test;'
+    dsn = settings.db_test_dsn.replace('+asyncpg', '')
+    connection = await asyncpg.connect(dsn, connection_class=PreparedConnection)
+    try:
+        await connection.execute('CREATE TEMP TABLE prepared_test (a integer);')
+        await connection.execute('INSERT INTO prepared_test VALUES (1);')
+        await statement_preparer([query, 'SELECT * FROM no_such_table;'])(connection)
+        assert list(connection.hot_statements) == [query]
+        assert await connection.fetchval(query) == 1
+
+        await connection.execute('ALTER TABLE prepared_test ADD COLUMN b integer DEFAULT 2;')
+        assert [tuple(row) for row in await connection.fetch(query)] == [(1, 2)]
+        assert query not in connection.hot_statements
+
+        # внутри транзакции повторить нельзя: она уже прервана ошибкой
+        await statement_preparer([query])(connection)
+        await connection.execute('ALTER TABLE prepared_test ADD COLUMN c integer;')
+        with pytest.raises(InvalidCachedStatementError):
+            async with connection.transaction():
+                await connection.fetch(query)
+        assert query not in connection.hot_statements
+    finally:
+        await connection.close()
@@ -0,0 +1,27 @@
+import logging
+
+import pytest
+
+from yadiskapi.config import settings
+
+from . import _give_2_folder_tree_import_batch
+
+
+@pytest.mark.asyncio
+async def test_server_timing_header(async_client):
+    """Число запросов к БД и время в БД за HTTP-запрос отдаются в заголовке Server-Timing."""
+    response = await async_client.get("/check")
+    assert response.headers['server-timing'].startswith('db;dur=')
+    assert response.headers['server-timing'].endswith('desc="1 queries"')
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log_redacts_parameters(async_client, monkeypatch, caplog):
+    """Медленные запросы попадают в лог без значений параметров."""
+    monkeypatch.setattr(settings, 'db_slow_query_ms', 0.000001)
+    batch = _give_2_folder_tree_import_batch(files_num=1)
+    with caplog.at_level(logging.WARNING, logger='yadiskapi.sql'):
+        await async_client.post("/imports", json=batch)
+    messages = [record.getMessage() for record in caplog.records if record.name == 'yadiskapi.sql']
+    assert any('slow query' in message and 'INSERT INTO items' in message for message in messages)
+    assert all(batch['items'][0]['id'] not in message for message in messages)
@@ -2,6 +2,7 @@ from datetime import timedelta
 import pytest
 
 from yadiskapi.schemas import datetime_from_isoformat_helper
+from yadiskapi.updates_index import recent_updates
 
 from . import _give_2_folder_tree_import_batch, _give_item_import_batch
 
@@ -35,3 +36,52 @@ async def test_updates_non_iso8601_date(async_client):
     await async_client.post("/imports", json=_give_item_import_batch(1, type="FILE"))
     response = await async_client.get("/updates", params={'date': 13})
     assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_updates_keyset_pagination(async_client):
+    """С limit история отдается страницами, курсор следующей страницы в заголовке X-Next-Cursor."""
+    batch = _give_item_import_batch(5, type='FILE')
+    dt_added = batch['updateDate']
+    await async_client.post("/imports", json=batch)
+
+    response = await async_client.get("/updates", params={'date': dt_added})
+    all_ids = {item['id'] for item in response.json()['items']}
+    assert 'x-next-cursor' not in response.headers
+
+    paged_ids, params = [], {'date': dt_added, 'limit': 2}
+    while True:
+        response = await async_client.get("/updates", params=params)
+        assert response.status_code == 200
+        assert len(response.json()['items']) <= 2
+        paged_ids += [item['id'] for item in response.json()['items']]
+        if 'x-next-cursor' not in response.headers:
+            break
+        params['cursor'] = response.headers['x-next-cursor']
+    assert len(paged_ids) == len(all_ids)
+    assert set(paged_ids) == all_ids
+
+    response = await async_client.get("/updates", params={'date': dt_added, 'limit': 2, 'cursor': 'broken'})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_updates_index_matches_history(async_client, monkeypatch):
+    """Ответ из индекса свежей истории совпадает с ответом по items_history."""
+    first = _give_item_import_batch(3, type='FILE')
+    second = _give_item_import_batch(2, type='FILE', added_timedelta=timedelta(hours=1))
+    second['items'].append(dict(first['items'][0], size=1))  # обновление уже импортированного файла
+    await async_client.post("/imports", json=first)
+    await async_client.post("/imports", json=second)
+    await async_client.post("/imports", json=second)  # повтор с той же датой историю не меняет
+    await async_client.delete(f"/delete/{first['items'][1]['id']}", params={'date': second['updateDate']})
+
+    hits = recent_updates.hits
+    response = await async_client.get("/updates", params={'date': second['updateDate']})
+    assert recent_updates.hits == hits + 1
+    from_index = sorted(response.json()['items'], key=lambda item: (item['date'], item['id']))
+    assert len(from_index) == 5
+
+    monkeypatch.setattr(recent_updates, 'max_rows', 0)
+    response = await async_client.get("/updates", params={'date': second['updateDate']})
+    assert sorted(response.json()['items'], key=lambda item: (item['date'], item['id'])) == from_index